@@ -0,0 +1,151 @@
+"""Asyncio API with micro-batching of concurrent tile requests."""
+
+import asyncio
+import weakref
+
+import numpy as np
+
+from .pipeline import get_pipeline
+
+
+def _apply_batch(pipeline, arrs, out_dtype):
+    """Run a pipeline once over several arrays with the same band count.
+
+    Every operation works pixel by pixel, so the arrays are flattened
+    and joined along the pixel axis into a single (bands, 1, pixels)
+    array, processed in one call and split back into the original
+    shapes.
+    """
+    count = arrs[0].shape[0]
+    if len(arrs) == 1 or pipeline.table(arrs[0].dtype, out_dtype, count) is not None:
+        # Table lookups have no per-call overhead worth amortizing
+        # over the cost of joining the arrays.
+        return [pipeline(arr, out_dtype) for arr in arrs]
+
+    stacked = np.concatenate([arr.reshape(count, 1, -1) for arr in arrs], axis=2)
+    out = pipeline(stacked, out_dtype)
+    offsets = np.cumsum([arr[0].size for arr in arrs])[:-1]
+    return [
+        part.reshape(arr.shape)
+        for part, arr in zip(np.split(out, offsets, axis=2), arrs)
+    ]
+
+
+def _apply_each(pipeline, arrs, out_dtype):
+    """Run a pipeline on each array separately, capturing errors."""
+    results = []
+    for arr in arrs:
+        try:
+            results.append(pipeline(arr, out_dtype))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class TileBatcher:
+    """Coalesces concurrent tile requests into batched pipeline calls.
+
+    Requests that arrive within ``delay`` seconds of each other and
+    share an operations string, dtypes and band count are joined into
+    one array, processed with a single pipeline call in an executor
+    and split back to each caller. If a batch fails, its tiles are
+    retried one by one so an error only reaches the request that
+    caused it.
+
+    Parameters
+    ----------
+    delay: float, seconds to wait for more requests before running a batch
+    max_batch: int, run a batch as soon as it has this many tiles
+    executor: concurrent.futures.Executor, default: the loop's executor
+
+    Example
+    -------
+    >>> batcher = TileBatcher()
+    >>> out = await batcher.apply(tile, "gamma rgb 1.2", out_dtype="uint8")
+    """
+
+    def __init__(self, delay=0.002, max_batch=64, executor=None):
+        """Create a new batcher."""
+        self.delay = delay
+        self.max_batch = max_batch
+        self.executor = executor
+        self._pending = {}
+        self._tasks = set()
+
+    async def apply(self, arr, ops_string, out_dtype=None):
+        """Apply an operations string to an integer array.
+
+        Parameters
+        ----------
+        arr: ndarray, integer dtype, shape (bands, rows, cols)
+        ops_string: str, operations, see ``parse_operations``
+        out_dtype: integer dtype of the result, default: same as arr
+
+        Returns
+        -------
+        ndarray of out_dtype with the same shape as arr
+        """
+        # Compile (and validate) the operations before queueing
+        get_pipeline(ops_string)
+        out_dtype = np.dtype(out_dtype or arr.dtype)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        key = (ops_string, arr.dtype, out_dtype, arr.shape[0])
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            loop.call_later(self.delay, self._flush, key, batch)
+        batch.append((arr, future))
+        if len(batch) >= self.max_batch:
+            self._flush(key, batch)
+
+        return await future
+
+    def _flush(self, key, batch):
+        # A batch is flushed by its timer or when it is full,
+        # whichever comes first.
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        task = asyncio.ensure_future(self._run(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, batch):
+        ops_string, _, out_dtype, _ = key
+        pipeline = get_pipeline(ops_string)
+        arrs = [arr for arr, _ in batch]
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, _apply_batch, pipeline, arrs, out_dtype
+            )
+        except Exception:
+            results = await loop.run_in_executor(
+                self.executor, _apply_each, pipeline, arrs, out_dtype
+            )
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+_batchers = weakref.WeakKeyDictionary()
+
+
+async def apply_async(arr, ops_string, out_dtype=None):
+    """Apply an operations string to an integer array without blocking.
+
+    Uses a TileBatcher shared by all calls on the running event loop,
+    so concurrent calls with the same operations are batched.
+    """
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = TileBatcher()
+    return await batcher.apply(arr, ops_string, out_dtype)
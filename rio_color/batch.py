@@ -0,0 +1,201 @@
+"""Batch color correction of many rasters with a shared worker pool."""
+
+import glob
+import os
+import time
+from collections import OrderedDict
+
+import rasterio
+from rasterio.transform import guard_transform
+
+from .palette import color_palette, has_palette, palette_colors, palette_profile
+from .pool import block_grid, imap_windows, result_bytes
+from .workers import color_worker
+
+
+def expand_inputs(inputs):
+    """Expand a list of paths and glob patterns into a list of paths.
+
+    Patterns are expanded in sorted order, plain paths are kept as-is
+    and duplicates are dropped while preserving order.
+    """
+    paths = []
+    for item in inputs:
+        if glob.has_magic(item):
+            paths.extend(sorted(glob.glob(item)))
+        else:
+            paths.append(item)
+    return list(OrderedDict.fromkeys(paths))
+
+
+def output_path(template, src_path):
+    """Render an output path template for a source path.
+
+    Available fields are ``{name}`` (file name), ``{stem}`` (file name
+    without extension), ``{ext}`` (extension including the dot) and
+    ``{dir}`` (directory of the source).
+    """
+    name = os.path.basename(src_path)
+    stem, ext = os.path.splitext(name)
+    return template.format(
+        name=name, stem=stem, ext=ext, dir=os.path.dirname(src_path) or "."
+    )
+
+
+def _plan(src_paths, dst_template, ops_string, out_dtype, creation_options):
+    """Gather profiles and windows for every input file."""
+    files = []
+    seen = set()
+    for path in src_paths:
+        dst_path = output_path(dst_template, path)
+        if dst_path in seen or os.path.abspath(dst_path) == os.path.abspath(path):
+            raise ValueError(
+                "Output template {!r} does not produce a unique output for "
+                "{}".format(dst_template, path)
+            )
+        seen.add(dst_path)
+
+        with rasterio.open(path) as src:
+            if has_palette(src):
+                files.append(
+                    _plan_paletted(
+                        src, dst_path, ops_string, out_dtype, creation_options
+                    )
+                )
+                continue
+            opts = src.profile.copy()
+            windows = block_grid(src)
+            colorinterp = src.colorinterp
+
+        opts.update(**(creation_options or {}))
+        opts["transform"] = guard_transform(opts["transform"])
+        opts["dtype"] = out_dtype if out_dtype else opts["dtype"]
+
+        files.append(
+            {
+                "src_path": path,
+                "dst_path": dst_path,
+                "opts": opts,
+                "windows": windows,
+                "colorinterp": colorinterp,
+                "args": {"ops_string": ops_string, "out_dtype": opts["dtype"]},
+                "palette": False,
+            }
+        )
+    return files
+
+
+def _plan_paletted(src, dst_path, ops_string, out_dtype, creation_options):
+    """Plan of a paletted raster, corrected through its colormap."""
+    if out_dtype and out_dtype != src.dtypes[0]:
+        raise ValueError(
+            "The indices of paletted raster {} can't be converted to {}".format(
+                src.name, out_dtype
+            )
+        )
+    # Raises ValueError for operations the colormap can't go through
+    palette_colors(src, ops_string)
+    opts = None
+    if creation_options:
+        opts = palette_profile(src, ops_string, creation_options)
+    return {
+        "src_path": src.name,
+        "dst_path": dst_path,
+        "opts": opts,
+        "windows": [],
+        "palette": True,
+    }
+
+
+def run_batch(
+    src_paths,
+    dst_template,
+    ops_string,
+    out_dtype=None,
+    creation_options=None,
+    jobs=1,
+    pool=None,
+):
+    """Color correct many rasters using one pool and one compiled pipeline.
+
+    Windows from all files are fed through a single task stream, so
+    workers move on to the next file while the last windows of the
+    previous one are still being written and small files do not leave
+    cores idle. Paletted rasters are corrected through their colormap
+    instead, see ``rio_color.palette.color_palette``, and keep their
+    indices.
+
+    Parameters
+    ----------
+    src_paths: list of str
+    dst_template: str, output path template, see ``output_path``
+    ops_string: str, operations to apply
+    out_dtype: str, output dtype, default: same as each input
+    creation_options: dict, creation options for the outputs
+    jobs: int, number of processes, ignored if pool is given
+    pool: multiprocessing.Pool, optional existing pool to reuse
+
+    Returns
+    -------
+    list of dict, a summary for each file with ``src_path``,
+    ``dst_path``, ``windows``, ``compute`` (summed worker seconds) and
+    ``elapsed`` (wall seconds from the file's first finished window
+    until it was closed).
+    """
+    files = _plan(src_paths, dst_template, ops_string, out_dtype, creation_options)
+    tasks = (
+        (index, color_worker, f["src_path"], window, ij, f["args"])
+        for index, f in enumerate(files)
+        for window, ij in f["windows"]
+    )
+
+    summary = [
+        {
+            "src_path": f["src_path"],
+            "dst_path": f["dst_path"],
+            "windows": len(f["windows"]),
+            "compute": 0.0,
+            "elapsed": 0.0,
+        }
+        for f in files
+    ]
+    remaining = [len(f["windows"]) for f in files]
+    started = {}
+    dests = {}
+
+    for index, f in enumerate(files):
+        if f["palette"]:
+            start = time.perf_counter()
+            color_palette(f["src_path"], f["dst_path"], ops_string, f["opts"])
+            summary[index]["elapsed"] = time.perf_counter() - start
+
+    size = max(
+        (
+            result_bytes(f["windows"], f["opts"]["count"], f["opts"]["dtype"])
+            for f in files
+            if not f["palette"]
+        ),
+        default=None,
+    )
+    results = imap_windows(tasks, jobs=jobs, pool=pool, result_size=size)
+    try:
+        for index, window, arr, seconds in results:
+            f = files[index]
+            if index not in dests:
+                started[index] = time.perf_counter()
+                dests[index] = rasterio.open(f["dst_path"], "w", **f["opts"])
+            dests[index].write(arr, window=window)
+            summary[index]["compute"] += seconds
+
+            remaining[index] -= 1
+            if remaining[index] == 0:
+                dest = dests.pop(index)
+                dest.colorinterp = f["colorinterp"]
+                dest.close()
+                summary[index]["elapsed"] = time.perf_counter() - started[index]
+    finally:
+        results.close()
+        for dest in dests.values():
+            dest.close()
+
+    return summary
@@ -0,0 +1,242 @@
+"""A persistent, size-bounded cache of compiled lookup tables.
+
+Tables are stored as ``.npy`` files named by a hash of what they were
+built from, next to a small JSON file describing them, and are
+memory-mapped when loaded so that processes using the same table
+share its pages. Whenever a table is used its modification time is
+updated, and the least recently used tables are removed once the
+cache grows over its size limit.
+
+The cache lives in ``$RIO_COLOR_CACHE_DIR``, or ``rio-color`` in the
+user cache directory, and is limited to ``$RIO_COLOR_CACHE_SIZE``
+(e.g. ``512M``, see ``memory.parse_size``). A size of 0 disables it.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import rio_color
+from .operations import _parse_operations, format_operations
+
+default_max_size = "256M"
+
+
+def canonical_operations(ops_string):
+    """A normalized operations string, equal for equivalent strings.
+
+    Case, commas, band order and number formatting are normalized, so
+    ``"Gamma RG 1.5"`` and ``"gamma 2,1 1.50"`` give the same string.
+    """
+    return format_operations(_parse_operations(ops_string))
+
+
+def _file_digests(ops_string):
+    """Digests of the files read by lut operations, in order."""
+    digests = []
+    for op in _parse_operations(ops_string):
+        if op.name == "lut" and op.kwargs.get("channel", 0) == 0:
+            with open(op.kwargs["path"], "rb") as f:
+                digests.append(hashlib.sha256(f.read()).hexdigest())
+    return digests
+
+
+def default_cache_dir():
+    """Directory of the cache, from the environment."""
+    path = os.environ.get("RIO_COLOR_CACHE_DIR")
+    if path:
+        return path
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "rio-color")
+
+
+def default_max_bytes():
+    """Size limit of the cache in bytes, from the environment."""
+    from .memory import parse_size
+
+    return parse_size(os.environ.get("RIO_COLOR_CACHE_SIZE") or default_max_size)
+
+
+class TableCache:
+    """Lookup tables stored on disk, see the module documentation.
+
+    Parameters
+    ----------
+    path: str, directory of the cache, default: ``default_cache_dir()``
+    max_bytes: int, size limit, default: ``default_max_bytes()``
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        """Use the cache in path, which is created when needed."""
+        self.path = path or default_cache_dir()
+        self.max_bytes = default_max_bytes() if max_bytes is None else max_bytes
+
+    def __repr__(self):
+        return "TableCache({!r}, max_bytes={})".format(self.path, self.max_bytes)
+
+    @staticmethod
+    def key(ops_string, kind, *params):
+        """Cache key of a table of some kind built from ops_string.
+
+        The key covers the canonical operations, the contents of the
+        files of ``lut`` operations, the kind of table, its parameters
+        such as dtypes and the versions of rio-color and numpy, whose
+        floating point functions the tables are built with.
+        """
+        description = json.dumps(
+            [
+                canonical_operations(ops_string),
+                _file_digests(ops_string),
+                kind,
+                [str(p) for p in params],
+                rio_color.__version__,
+                np.__version__,
+            ]
+        )
+        return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def get(self, key):
+        """The memory-mapped, read-only table stored for key, or None."""
+        path = self._file(key, ".npy")
+        try:
+            table = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (OSError, ValueError):
+            # Missing, evicted meanwhile or truncated
+            return None
+        return table
+
+    def put(self, key, table, **info):
+        """Store a table for key, with info describing it for ``entries``.
+
+        Tables are written to a temporary file and renamed, so that
+        concurrent writers of the same key never leave a partial file.
+        Returns the stored table, memory-mapped.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for ext, write in (
+            (".json", lambda f: f.write(json.dumps(info).encode())),
+            (".npy", lambda f: np.save(f, np.ascontiguousarray(table))),
+        ):
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    write(f)
+                os.replace(tmp, self._file(key, ext))
+            except BaseException:
+                os.remove(tmp)
+                raise
+        self.evict()
+        # A table larger than the cache is evicted right away
+        stored = self.get(key)
+        return table if stored is None else stored
+
+    def entries(self):
+        """Stored tables, most recently used first.
+
+        Returns
+        -------
+        list of dicts with ``key``, ``size`` in bytes, ``used`` (a
+        timestamp) and the info given to ``put``
+        """
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        for name in names:
+            key, ext = os.path.splitext(name)
+            if ext != ".npy":
+                continue
+            try:
+                stat = os.stat(self._file(key, ".npy"))
+            except FileNotFoundError:
+                continue
+            try:
+                with open(self._file(key, ".json")) as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                info = {}
+            entry = dict(info, key=key, size=stat.st_size, used=stat.st_mtime)
+            entries.append(entry)
+        return sorted(entries, key=lambda e: e["used"], reverse=True)
+
+    def remove(self, key):
+        """Remove the table stored for key, if any."""
+        for ext in (".npy", ".json"):
+            try:
+                os.remove(self._file(key, ext))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, max_bytes=None):
+        """Remove the least recently used tables over max_bytes.
+
+        Returns
+        -------
+        list of the removed keys
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = []
+        total = 0
+        for entry in self.entries():
+            total += entry["size"]
+            if total > max_bytes:
+                self.remove(entry["key"])
+                removed.append(entry["key"])
+        return removed
+
+    def clear(self):
+        """Remove every table, returns the number removed."""
+        return len(self.evict(0))
+
+
+def get_table_cache():
+    """The cache configured by the environment, None if it is disabled."""
+    cache = TableCache()
+    if cache.max_bytes <= 0:
+        return None
+    return cache
+
+
+def cached_table(ops_string, kind, params, build, **info):
+    """Load a table from the cache or build and store it.
+
+    build is called without arguments and returns the table, or None
+    if there is none, which is not cached. Without a cache, or if it
+    can't be written, the table is built every time.
+    """
+    cache = get_table_cache()
+    if cache is None:
+        return build()
+
+    key = cache.key(ops_string, kind, *params)
+    table = cache.get(key)
+    if table is not None:
+        return table
+
+    table = build()
+    if table is None:
+        return None
+    info.update(
+        ops_string=canonical_operations(ops_string),
+        kind=kind,
+        params=[str(p) for p in params],
+        shape=list(table.shape),
+        dtype=str(table.dtype),
+        created=time.time(),
+    )
+    try:
+        return cache.put(key, table, **info)
+    except OSError:
+        return table
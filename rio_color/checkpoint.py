@@ -0,0 +1,183 @@
+"""Checkpointing and resuming of long-running window jobs."""
+
+import json
+import os
+import time
+
+import rasterio
+
+from .pool import imap_windows, result_bytes
+
+
+def journal_path(dst_path):
+    """Path of the journal kept alongside an output."""
+    return dst_path + ".journal"
+
+
+class JournalMismatchError(ValueError):
+    """A journal was written by a different job than the one resumed."""
+
+
+class WindowJournal:
+    """Append-only record of the windows durably written to an output.
+
+    The first line is a JSON header describing the job, each further
+    line holds the ``row col`` block index of a finished window.
+    Windows are added as they are written but only committed to the
+    journal, and fsynced, after the output has been flushed, so a
+    journal never lists a window whose data could have been lost.
+    """
+
+    def __init__(self, path, header):
+        """Create a journal for a job described by header."""
+        self.path = path
+        self.header = header
+        self.done = set()
+        self._pending = []
+        self._file = None
+
+    def exists(self):
+        """Whether a journal was left by a previous run."""
+        return os.path.exists(self.path)
+
+    def load(self):
+        """Read the windows finished by a previous run of the same job.
+
+        Raises JournalMismatchError if the journal was written for
+        another job.
+        """
+        with open(self.path) as f:
+            header = json.loads(f.readline())
+            if header != self.header:
+                raise JournalMismatchError(
+                    "Journal {} was written by a different job, remove it to "
+                    "start over".format(self.path)
+                )
+            for line in f:
+                parts = line.split()
+                # A torn last line from a crash is ignored
+                if len(parts) == 2:
+                    self.done.add((int(parts[0]), int(parts[1])))
+        return self.done
+
+    def start(self):
+        """Open the journal for appending, writing the header if it is new."""
+        new = not self.exists()
+        self._file = open(self.path, "a")
+        if new:
+            self._file.write(json.dumps(self.header) + "\n")
+            self._sync()
+
+    def add(self, ij):
+        """Record a window written to the output but not yet flushed."""
+        self._pending.append(tuple(ij))
+
+    def commit(self):
+        """Record the pending windows, call after flushing the output."""
+        if self._pending:
+            self._file.write("".join("{} {}\n".format(*ij) for ij in self._pending))
+            self._sync()
+            self.done.update(self._pending)
+            self._pending = []
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """Close the journal file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Close and delete the journal once the job is complete."""
+        self.close()
+        os.remove(self.path)
+
+
+def job_header(src_path, windows, opts, args):
+    """A JSON-compatible description of a job, to match journals to jobs."""
+    return {
+        "src_path": os.path.abspath(src_path),
+        "args": args,
+        "width": opts["width"],
+        "height": opts["height"],
+        "count": opts["count"],
+        "dtype": opts["dtype"],
+        "windows": len(windows),
+        # Tells apart layouts with the same number of windows
+        "window_size": [int(windows[0][0].width), int(windows[0][0].height)],
+    }
+
+
+def process_windows_checkpointed(
+    worker,
+    src_path,
+    dst_path,
+    windows,
+    opts,
+    args,
+    jobs=1,
+    resume=False,
+    interval=30.0,
+    copy_colorinterp=False,
+):
+    """Run a window worker while keeping a journal of finished windows.
+
+    Every interval seconds, the output is closed to flush its data and
+    the windows written since the last checkpoint are committed to the
+    journal at ``journal_path(dst_path)``. With resume, an existing
+    output and journal of the same job are picked up and only the
+    windows missing from the journal are processed. The journal is
+    removed once every window has been written.
+
+    Returns
+    -------
+    int, the number of windows processed in this run
+    """
+    journal = WindowJournal(
+        journal_path(dst_path), job_header(src_path, windows, opts, args)
+    )
+    if resume and journal.exists() and os.path.exists(dst_path):
+        done = journal.load()
+        dest = rasterio.open(dst_path, "r+")
+    else:
+        if journal.exists():
+            os.remove(journal.path)
+        done = set()
+        dest = rasterio.open(dst_path, "w", **opts)
+
+    tasks = (
+        (ij, worker, src_path, window, ij, args)
+        for window, ij in windows
+        if tuple(ij) not in done
+    )
+
+    count = 0
+    journal.start()
+    size = result_bytes(windows, opts["count"], opts["dtype"])
+    results = imap_windows(tasks, jobs=jobs, result_size=size)
+    try:
+        last = time.monotonic()
+        for ij, window, arr, _ in results:
+            dest.write(arr, window=window)
+            journal.add(ij)
+            count += 1
+            if time.monotonic() - last >= interval:
+                dest.close()
+                journal.commit()
+                dest = rasterio.open(dst_path, "r+")
+                last = time.monotonic()
+
+        if copy_colorinterp:
+            with rasterio.open(src_path) as src:
+                dest.colorinterp = src.colorinterp
+    finally:
+        results.close()
+        dest.close()
+        journal.commit()
+        journal.close()
+
+    journal.remove()
+    return count
@@ -0,0 +1,74 @@
+"""Cloud-Optimized GeoTIFF output."""
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+import rasterio
+from rasterio.shutil import copy
+
+# GTiff creation options with a different name in, or no meaning
+# for, the COG driver.
+_gtiff_only = ("tiled", "blockxsize", "blockysize", "interleave", "photometric")
+
+
+def cog_options(profile, creation_options):
+    """COG driver creation options for an output.
+
+    Uses the compression of the output profile, which already
+    includes any user creation options, and translates GTiff block
+    size options to the COG driver's BLOCKSIZE.
+    """
+    options = {
+        k.lower(): v
+        for k, v in creation_options.items()
+        if k.lower() not in _gtiff_only
+    }
+    if "compress" not in options and profile.get("compress"):
+        options["compress"] = profile["compress"]
+    blocksize = {k.lower(): v for k, v in creation_options.items()}.get("blockxsize")
+    if blocksize and "blocksize" not in options:
+        options["blocksize"] = blocksize
+    return options
+
+
+@contextmanager
+def cog_output(dst_path, profile, creation_options, resampling="average"):
+    """Write to a temporary GeoTIFF and convert it to a COG at dst_path.
+
+    Yields a (path, profile) pair to write the full resolution data
+    to. The temporary file is tiled and uncompressed so that reading
+    it back is cheap. On exit, the COG driver builds the overviews
+    from it and writes the final, compressed COG in one pass. The
+    temporary file is always removed.
+
+    Parameters
+    ----------
+    dst_path: str, path of the COG to create
+    profile: dict, profile of the output, including creation options
+    creation_options: dict, user creation options for the COG
+    resampling: str, resampling method for overviews
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        suffix=".tif", prefix=".rio-color-", dir=os.path.dirname(dst_path) or "."
+    )
+    os.close(fd)
+
+    tmp_profile = profile.copy()
+    for key in ("compress", "predictor", "quality", "jpeg_quality"):
+        tmp_profile.pop(key, None)
+    tmp_profile.update(
+        driver="GTiff", tiled=True, blockxsize=512, blockysize=512, bigtiff="IF_SAFER"
+    )
+    if tmp_profile.get("photometric", "").lower() == "ycbcr":
+        del tmp_profile["photometric"]
+
+    try:
+        yield tmp_path, tmp_profile
+        options = cog_options(profile, creation_options)
+        options.setdefault("overview_resampling", resampling)
+        with rasterio.Env(GDAL_NUM_THREADS=options.pop("num_threads", "ALL_CPUS")):
+            copy(tmp_path, dst_path, driver="COG", **options)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -4,7 +4,7 @@ from enum import IntEnum
 import numpy as np
 
 cimport numpy as np
-from libc.math cimport cos, sin, atan2
+from libc.math cimport atan2, cos, exp, log, pow, sin
 cimport cython
 ctypedef np.float64_t FLOAT_t
 
@@ -134,7 +134,7 @@ cpdef np.ndarray[FLOAT_t, ndim=3] saturate_rgb(np.ndarray[FLOAT_t, ndim=3] arr,
     return out
 
 
-cdef inline color _convert(double one, double two, double three, int src, int dst):
+cdef inline color _convert(double one, double two, double three, int src, int dst) noexcept nogil:
     cdef color c
 
     if src == RGB:
@@ -257,7 +257,7 @@ DEF SRGB_COMPAND = True
 
 # Direct colorspace conversions
 
-cdef inline color _rgb_to_xyz(double r, double g, double b):
+cdef inline color _rgb_to_xyz(double r, double g, double b) noexcept nogil:
     cdef double rl, gl, bl
     cdef color color
 
@@ -293,7 +293,7 @@ cdef inline color _rgb_to_xyz(double r, double g, double b):
     return color
 
 
-cdef inline color _xyz_to_lab(double x, double y, double z):
+cdef inline color _xyz_to_lab(double x, double y, double z) noexcept nogil:
     cdef double fx, fy, fz
     cdef double L, a, b
     cdef color color
@@ -324,7 +324,7 @@ cdef inline color _xyz_to_lab(double x, double y, double z):
     return color
 
 
-cdef inline color _lab_to_lch(double L, double a, double b):
+cdef inline color _lab_to_lch(double L, double a, double b) noexcept nogil:
     cdef color color
 
     color.one = L
@@ -333,7 +333,7 @@ cdef inline color _lab_to_lch(double L, double a, double b):
     return color
 
 
-cdef inline color _lch_to_lab(double L, double C, double H):
+cdef inline color _lch_to_lab(double L, double C, double H) noexcept nogil:
     cdef double a, b
     cdef color color
 
@@ -346,7 +346,7 @@ cdef inline color _lch_to_lab(double L, double C, double H):
     return color
 
 
-cdef inline color _lab_to_xyz(double L, double a, double b):
+cdef inline color _lab_to_xyz(double L, double a, double b) noexcept nogil:
     cdef double x, y, z
     cdef color color
 
@@ -375,7 +375,7 @@ cdef inline color _lab_to_xyz(double L, double a, double b):
     return color
 
 
-cdef inline color _xyz_to_rgb(double x, double y, double z):
+cdef inline color _xyz_to_rgb(double x, double y, double z) noexcept nogil:
     cdef double rlin, glin, blin, r, g, b
     cdef color color
 
@@ -429,7 +429,7 @@ cdef inline color _xyz_to_rgb(double x, double y, double z):
     return color
 
 
-cdef inline color _xyz_to_luv(double x, double y, double z):
+cdef inline color _xyz_to_luv(double x, double y, double z) noexcept nogil:
     cdef color color
     cdef double L, u, v, uprime, vprime, denom
 
@@ -453,7 +453,7 @@ cdef inline color _xyz_to_luv(double x, double y, double z):
     return color
 
 
-cdef inline color _luv_to_xyz(double L, double u, double v):
+cdef inline color _luv_to_xyz(double L, double u, double v) noexcept nogil:
     cdef color color
     cdef double x, y, z, uprime, vprime
 
@@ -478,3 +478,204 @@ cdef inline color _luv_to_xyz(double L, double u, double v):
     color.two = y
     color.three = z
     return color
+
+
+# Op program interpreter
+# Opcodes of programs made by rio_color.operations.compile_program,
+# needs to stay in sync with the opcodes there
+cdef enum:
+    OP_GAMMA = 0
+    OP_SIGMOIDAL = 1
+    OP_INV_SIGMOIDAL = 2
+    OP_SATURATION = 3
+    OP_STRETCH = 4
+
+DEF MAX_BANDS = 64
+DEF EPSILON = 2.220446049250313e-16
+
+ctypedef fused in_t:
+    np.uint8_t
+    np.uint16_t
+    np.int16_t
+    np.uint32_t
+    np.int32_t
+
+ctypedef fused out_t:
+    np.uint8_t
+    np.uint16_t
+
+
+def run_program(const in_t[:, :, :] arr, out_t[:, :, :] out, double[:, ::1] program,
+                Py_ssize_t[::1] bands, double in_max, double out_max):
+    """Run an op program over every pixel of arr, writing to out.
+
+    Only the bands listed in bands are read and written, instruction
+    operands refer to positions in bands. Each pixel is loaded,
+    scaled to 0..1, run through every instruction and scaled to the
+    output range in a single pass, without holding the GIL.
+
+    Raises ValueError, after processing, if an operation received a
+    value outside of 0..1.
+    """
+    cdef Py_ssize_t i, j, k, p
+    cdef Py_ssize_t rows = arr.shape[1]
+    cdef Py_ssize_t cols = arr.shape[2]
+    cdef Py_ssize_t nbands = bands.shape[0]
+    cdef Py_ssize_t ninstr = program.shape[0]
+    cdef double v[MAX_BANDS]
+    cdef double x
+    cdef int op
+    cdef bint out_of_range = False
+    cdef color c
+
+    if nbands > MAX_BANDS:
+        raise ValueError("Programs can use at most {} bands".format(MAX_BANDS))
+    if program.shape[1] != 6:
+        raise ValueError("Program must have 6 columns")
+    for k in range(nbands):
+        if bands[k] < 0 or bands[k] >= arr.shape[0] or bands[k] >= out.shape[0]:
+            raise ValueError("Band index out of range")
+    for p in range(ninstr):
+        if program[p, 1] < 0 or program[p, 1] + (3 if program[p, 0] == OP_SATURATION else 1) > nbands:
+            raise ValueError("Instruction operand out of range")
+    if out.shape[1] != rows or out.shape[2] != cols:
+        raise ValueError("Output shape does not match the input")
+
+    with nogil:
+        for i in range(rows):
+            for j in range(cols):
+                for k in range(nbands):
+                    v[k] = arr[bands[k], i, j] / in_max
+
+                for p in range(ninstr):
+                    op = <int>program[p, 0]
+                    k = <Py_ssize_t>program[p, 1]
+                    x = v[k]
+
+                    if op == OP_GAMMA:
+                        # pow(x, 1 / gamma)
+                        if x > 1.0 + EPSILON or x < -EPSILON:
+                            out_of_range = True
+                        v[k] = pow(x, program[p, 2])
+
+                    elif op == OP_SIGMOIDAL:
+                        # operands: beta, alpha, offset, scale
+                        if x > 1.0 + EPSILON or x < -EPSILON:
+                            out_of_range = True
+                        v[k] = (
+                            1 / (1 + exp(program[p, 2] * (program[p, 3] - x)))
+                            - program[p, 4]
+                        ) / program[p, 5]
+
+                    elif op == OP_INV_SIGMOIDAL:
+                        # operands: beta, alpha, e1, e2
+                        if x > 1.0 + EPSILON or x < -EPSILON:
+                            out_of_range = True
+                        v[k] = (
+                            program[p, 2] * program[p, 3]
+                            - log(
+                                1 / (x / program[p, 4] - x / program[p, 5] + 1 / program[p, 5])
+                                - 1
+                            )
+                        ) / program[p, 2]
+
+                    elif op == OP_STRETCH:
+                        # operands: low, high - low
+                        x = (x - program[p, 2]) / program[p, 3]
+                        v[k] = 0 if x < 0 else (1 if x > 1 else x)
+
+                    elif op == OP_SATURATION:
+                        c = _convert(v[k], v[k + 1], v[k + 2], RGB, LCH)
+                        c.two *= program[p, 2]
+                        c = _convert(c.one, c.two, c.three, LCH, RGB)
+                        v[k] = c.one
+                        v[k + 1] = c.two
+                        v[k + 2] = c.three
+
+                for k in range(nbands):
+                    # Through a wide integer, like numpy's float casts
+                    out[bands[k], i, j] = <out_t><long long>(v[k] * out_max)
+
+    if out_of_range:
+        raise ValueError("Input array must have float values between 0 and 1")
+
+
+def apply_lut3d(const in_t[:, :, :] arr, out_t[:, :, :] out, const float[:, :, :, ::1] lut,
+                double in_max, double out_max):
+    """Map the first three bands of arr through a 3D lookup table.
+
+    lut has shape (n, n, n, 3) and holds, for the lattice point
+    (r, g, b) / (n - 1), the output red, green and blue between 0 and
+    1. Pixels are interpolated with the four corners of the
+    tetrahedron of the lattice cube containing them, without holding
+    the GIL. Bands past the third are left alone.
+    """
+    cdef Py_ssize_t i, j, c
+    cdef Py_ssize_t rows = arr.shape[1]
+    cdef Py_ssize_t cols = arr.shape[2]
+    cdef Py_ssize_t n = lut.shape[0]
+    cdef Py_ssize_t r0, g0, b0
+    cdef double scale, tolerance, x, fr, fg, fb, v
+    cdef double w0, w1, w2, w3
+    cdef const float *c0
+    cdef const float *c1
+    cdef const float *c2
+    cdef const float *c3
+    # Offsets of the lattice neighbors along r, g and b
+    cdef Py_ssize_t dr, dg, db
+
+    if lut.shape[1] != n or lut.shape[2] != n or lut.shape[3] != 3 or n < 2:
+        raise ValueError("Lookup table must have shape (n, n, n, 3) with n > 1")
+    if arr.shape[0] < 3 or out.shape[0] < 3:
+        raise ValueError("Arrays must have at least 3 bands")
+    if out.shape[1] != rows or out.shape[2] != cols:
+        raise ValueError("Output shape does not match the input")
+
+    scale = (n - 1) / in_max
+    # The table is single precision, values within two float ulps
+    # below a code value, such as 1.0, are taken as that value
+    tolerance = out_max * 2.0 ** -22
+    dr, dg, db = n * n * 3, n * 3, 3
+
+    with nogil:
+        for i in range(rows):
+            for j in range(cols):
+                x = min(max(arr[0, i, j] * scale, 0.0), n - 1.0)
+                r0 = min(<Py_ssize_t>x, n - 2)
+                fr = x - r0
+                x = min(max(arr[1, i, j] * scale, 0.0), n - 1.0)
+                g0 = min(<Py_ssize_t>x, n - 2)
+                fg = x - g0
+                x = min(max(arr[2, i, j] * scale, 0.0), n - 1.0)
+                b0 = min(<Py_ssize_t>x, n - 2)
+                fb = x - b0
+
+                # Corners from (r0, g0, b0) to (r0 + 1, g0 + 1, b0 + 1)
+                # along the edges of the tetrahedron holding the pixel
+                c0 = &lut[r0, g0, b0, 0]
+                c3 = c0 + dr + dg + db
+                if fr > fg:
+                    if fg > fb:
+                        c1, c2 = c0 + dr, c0 + dr + dg
+                        w0, w1, w2, w3 = 1 - fr, fr - fg, fg - fb, fb
+                    elif fr > fb:
+                        c1, c2 = c0 + dr, c0 + dr + db
+                        w0, w1, w2, w3 = 1 - fr, fr - fb, fb - fg, fg
+                    else:
+                        c1, c2 = c0 + db, c0 + dr + db
+                        w0, w1, w2, w3 = 1 - fb, fb - fr, fr - fg, fg
+                else:
+                    if fb > fg:
+                        c1, c2 = c0 + db, c0 + dg + db
+                        w0, w1, w2, w3 = 1 - fb, fb - fg, fg - fr, fr
+                    elif fb > fr:
+                        c1, c2 = c0 + dg, c0 + dg + db
+                        w0, w1, w2, w3 = 1 - fg, fg - fb, fb - fr, fr
+                    else:
+                        c1, c2 = c0 + dg, c0 + dr + dg
+                        w0, w1, w2, w3 = 1 - fg, fg - fr, fr - fb, fb
+
+                for c in range(3):
+                    v = w0 * c0[c] + w1 * c1[c] + w2 * c2[c] + w3 * c3[c]
+                    # Through a wide integer, like numpy's float casts
+                    out[c, i, j] = <out_t><long long>(v * out_max + tolerance)
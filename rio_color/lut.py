@@ -0,0 +1,368 @@
+"""3D lookup tables approximating RGB pipelines.
+
+Exact per-band tables can't represent operations that mix bands,
+such as ``saturation``, and a table of every uint16 RGB triplet would
+be far too large. A 3D lookup table instead samples the operations on
+a lattice of n x n x n RGB values, 33 or 65 points per axis being
+common, and interpolates between lattice points. Tetrahedral
+interpolation weights the four corners of the tetrahedron of the
+lattice cube a pixel falls in, which costs a dozen multiply-adds per
+pixel instead of the full chain of operations.
+
+Steep per-band curves, such as a strong ``sigmoidal``, are poorly
+approximated by a coarse lattice. The per-band operations before the
+first operation that mixes bands are therefore applied exactly with
+1D tables, the shaper, and only the remaining operations are sampled.
+
+Tables can be exported to, and read from, ``.cube`` files, the 1D and
+3D LUT format of Adobe and Resolve, which the ``lut`` operation
+applies.
+"""
+
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from .cache import cached_table
+from .operations import _parse_operations, format_operations
+from .pipeline import ColorPipeline, program_in_dtypes, program_out_dtypes
+
+default_size = 33
+
+
+def split_operations(ops_string):
+    """Split operations where they start mixing bands.
+
+    Returns
+    -------
+    tuple of (per-band, rest) normalized operations strings, either
+    may be empty
+    """
+    operations = _parse_operations(ops_string)
+    split = next((i for i, op in enumerate(operations) if op.rgb_op), len(operations))
+    return format_operations(operations[:split]), format_operations(operations[split:])
+
+
+def sample_pipeline(pipeline, size=default_size):
+    """Values of a pipeline on a size x size x size RGB lattice.
+
+    A pipeline of None is the identity.
+
+    Returns
+    -------
+    float32 ndarray of shape (size, size, size, 3), the output red,
+    green and blue between 0 and 1 for the input
+    ``(r, g, b) / (size - 1)``
+
+    Raises ValueError if the operations use bands past the third or
+    reject some lattice values.
+    """
+    if size < 2:
+        raise ValueError("Lookup tables need at least 2 points per axis")
+    if pipeline is not None and pipeline.bands and pipeline.bands[-1] > 3:
+        raise ValueError("3D lookup tables can only map the first 3 bands")
+
+    values = np.linspace(0, 1, size)
+    lattice = np.stack(np.meshgrid(values, values, values, indexing="ij"))
+    lattice = lattice.reshape(3, size * size, size)
+    if pipeline is not None and pipeline.bands:
+        buf = pipeline.evaluate(lattice[[b - 1 for b in pipeline.bands]])
+        for b, row in pipeline._rows.items():
+            lattice[b - 1] = buf[row]
+    table = np.moveaxis(lattice.reshape(3, size, size, size), 0, -1)
+    return np.ascontiguousarray(table, dtype="float32")
+
+
+def _parse_cube(text):
+    title = None
+    size = None
+    dims = None
+    domain = [[0.0] * 3, [1.0] * 3]
+    values = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        keyword, _, rest = line.partition(" ")
+        if keyword[0].isdigit() or keyword[0] in "-+.":
+            values.append(line)
+        elif keyword == "TITLE":
+            title = rest.strip().strip('"')
+        elif keyword in ("LUT_1D_SIZE", "LUT_3D_SIZE"):
+            if size is not None:
+                raise ValueError(
+                    "Files with both a 1D and a 3D table are not supported"
+                )
+            size, dims = int(rest), int(keyword[4])
+        elif keyword in ("DOMAIN_MIN", "DOMAIN_MAX"):
+            domain[keyword == "DOMAIN_MAX"] = [float(v) for v in rest.split()]
+        else:
+            raise ValueError("Unknown keyword {!r} on line {}".format(keyword, number))
+
+    if size is None:
+        raise ValueError("Missing LUT_1D_SIZE or LUT_3D_SIZE")
+    if domain != [[0.0] * 3, [1.0] * 3]:
+        raise ValueError("Only tables with a domain of 0 to 1 are supported")
+    try:
+        table = np.array(" ".join(values).split(), dtype="float32").reshape(-1, 3)
+    except ValueError:
+        raise ValueError("Table values must be rows of 3 numbers")
+    if len(table) != size**dims or size < 2:
+        raise ValueError(
+            "Expected {} rows of values, found {}".format(size**dims, len(table))
+        )
+    if dims == 3:
+        # Red changes fastest in the file
+        table = np.ascontiguousarray(
+            table.reshape(size, size, size, 3).transpose(2, 1, 0, 3)
+        )
+    return table, title
+
+
+@lru_cache(maxsize=16)
+def _load_cube(path, mtime, fsize):
+    with open(path) as f:
+        return _parse_cube(f.read())
+
+
+def read_cube(path):
+    """Read a .cube file.
+
+    Files are parsed once per process, until they are modified.
+
+    Returns
+    -------
+    tuple of (table, title). The table is a float32 array of shape
+    (n, 3) for a 1D table, the output of each channel for the input
+    ``i / (n - 1)``, or of shape (n, n, n, 3) for a 3D table, see
+    ``sample_pipeline``. The title is None if the file has none.
+
+    Raises ValueError if the file is not a valid .cube file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        raise ValueError("Can't read LUT file {}: {}".format(path, e.strerror))
+    try:
+        return _load_cube(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid LUT file {}: {}".format(path, e))
+
+
+def write_cube(path, table, title=None):
+    """Write a 1D table of shape (n, 3) or a 3D table of shape (n, n, n, 3)."""
+    table = np.asarray(table)
+    if table.ndim == 4:
+        header = "LUT_3D_SIZE {}".format(table.shape[0])
+        rows = table.transpose(2, 1, 0, 3).reshape(-1, 3)
+    elif table.ndim == 2 and table.shape[1] == 3:
+        header = "LUT_1D_SIZE {}".format(table.shape[0])
+        rows = table
+    else:
+        raise ValueError("Table must have shape (n, 3) or (n, n, n, 3)")
+
+    with open(path, "w") as f:
+        if title:
+            f.write('TITLE "{}"\n'.format(title.replace('"', "'")))
+        f.write(header + "\n")
+        f.write("DOMAIN_MIN 0.0 0.0 0.0\nDOMAIN_MAX 1.0 1.0 1.0\n")
+        np.savetxt(f, rows, fmt="%.6f")
+    return path
+
+
+def sample_curves(pipeline, size=1024):
+    """Values of a per-band pipeline for size inputs from 0 to 1.
+
+    Returns
+    -------
+    float32 ndarray of shape (size, 3), a 1D table of the first three
+    bands. Raises ValueError if the operations mix bands or use bands
+    past the third.
+    """
+    if not pipeline.per_band:
+        raise ValueError("Operations that mix bands need a 3D table")
+    if size < 2:
+        raise ValueError("Lookup tables need at least 2 points per axis")
+    if pipeline.bands and pipeline.bands[-1] > 3:
+        raise ValueError("Lookup tables can only map the first 3 bands")
+
+    curves = np.tile(np.linspace(0, 1, size), (3, 1))
+    if pipeline.bands:
+        buf = pipeline.evaluate(curves[[b - 1 for b in pipeline.bands]])
+        for b, row in pipeline._rows.items():
+            curves[b - 1] = buf[row]
+    return np.ascontiguousarray(curves.T, dtype="float32")
+
+
+def export_cube(ops_string, path, size=None, one_d=False, title=None):
+    """Write operations as a .cube file.
+
+    A 3D table, through the table cache, samples the whole chain of
+    operations on a lattice of size points per axis (default 33). A 1D
+    table (one_d) holds a curve per band with size points (default
+    1024) and only works for operations that don't mix bands.
+    """
+    if one_d:
+        table = sample_curves(ColorPipeline(ops_string), size or 1024)
+    else:
+        table = Lut3D.from_operations(ops_string, size or default_size, shaper=False)
+        table = table.table
+    return write_cube(path, table, title=title or ops_string)
+
+
+def interpolate(arr, table):
+    """Map a float RGB array of shape (3, ...) through a 3D table.
+
+    The numpy counterpart of the interpolation kernel, for values
+    between 0 and 1 (others are clipped). Returns a float64 array.
+    """
+    n = table.shape[0]
+    x = np.clip(arr, 0, 1) * (n - 1)
+    i0 = np.minimum(x.astype("intp"), n - 2)
+    f = x - i0
+    r, g, b = i0
+
+    # Corners along the path from (0, 0, 0) to (1, 1, 1) that goes
+    # through the largest fraction first, with the weights of the
+    # tetrahedron holding each pixel
+    order = np.argsort(-f, axis=0, kind="stable")
+    fs = np.take_along_axis(f, order, axis=0)
+    weights = [1 - fs[0], fs[0] - fs[1], fs[1] - fs[2], fs[2]]
+    corner = np.zeros_like(i0)
+    out = weights[0][..., None] * table[r, g, b]
+    for k in range(3):
+        np.put_along_axis(corner, order[k : k + 1], 1, axis=0)
+        out += (
+            weights[k + 1][..., None]
+            * table[r + corner[0], g + corner[1], b + corner[2]]
+        )
+    return np.moveaxis(out, -1, 0)
+
+
+class Lut3D:
+    """A 3D lookup table mapping RGB values to RGB values.
+
+    Applies to integer arrays of shape (bands, rows, cols) with at
+    least 3 bands. The first three bands are interpolated in the table
+    and further bands are copied, or rescaled if the output dtype
+    differs.
+
+    Parameters
+    ----------
+    table: ndarray of shape (n, n, n, 3), see ``sample_pipeline``
+    shaper: ColorPipeline of per-band operations applied to the first
+        three bands, as uint16, before the table. Default: None
+    """
+
+    def __init__(self, table, shaper=None):
+        """Wrap a table of output values between 0 and 1."""
+        table = np.asarray(table)
+        if table.ndim != 4 or table.shape[1:] != (table.shape[0],) * 2 + (3,):
+            raise ValueError("Lookup table must have shape (n, n, n, 3)")
+        if table.dtype != np.float32 or not table.flags.c_contiguous:
+            table = np.ascontiguousarray(table, dtype="float32")
+        self.table = table
+        if shaper is not None and shaper.bands and shaper.bands[-1] > 3:
+            raise ValueError("The shaper can only use the first 3 bands")
+        self.shaper = shaper
+
+    def __repr__(self):
+        return "Lut3D(size={}, shaper={!r})".format(self.size, self.shaper)
+
+    @property
+    def size(self):
+        """Number of lattice points per axis."""
+        return self.table.shape[0]
+
+    @classmethod
+    def from_operations(cls, ops_string, size=default_size, shaper=True):
+        """Sample an operations string, through the table cache.
+
+        With shaper, the leading per-band operations are applied
+        exactly and only the rest is sampled, see the module
+        documentation. If the rest is a single 3D ``lut`` operation,
+        the table of its file is used whatever the size.
+
+        Raises ValueError if the operations can't be sampled, see
+        ``sample_pipeline``.
+        """
+        if shaper:
+            shaper_ops, ops_string = split_operations(ops_string)
+        else:
+            shaper_ops, ops_string = "", format_operations(
+                _parse_operations(ops_string)
+            )
+
+        operations = _parse_operations(ops_string) if ops_string else []
+        if len(operations) == 1 and operations[0].name == "lut":
+            # A .cube file alone is used as is
+            table, _ = read_cube(operations[0].kwargs["path"])
+        elif ops_string:
+            table = cached_table(
+                ops_string,
+                "lut3d",
+                (size,),
+                lambda: sample_pipeline(ColorPipeline(ops_string), size),
+            )
+        else:
+            # Only the shaper, or nothing at all
+            table = sample_pipeline(None, size)
+        return cls(table, ColorPipeline(shaper_ops) if shaper_ops else None)
+
+    def apply(self, arr, out):
+        """Write the interpolated first three bands of arr to out."""
+        from .colorspace import apply_lut3d
+
+        if arr.dtype not in program_in_dtypes or out.dtype not in program_out_dtypes:
+            raise ValueError(
+                "Can't apply a 3D lookup table from {} to {}".format(
+                    arr.dtype, out.dtype
+                )
+            )
+        if self.shaper is not None:
+            arr = self.shaper(arr[:3], "uint16")
+        apply_lut3d(
+            arr,
+            out,
+            self.table,
+            np.iinfo(arr.dtype).max,
+            np.iinfo(out.dtype).max,
+        )
+        return out
+
+    def __call__(self, arr, out_dtype=None):
+        """Apply the table to an integer array.
+
+        Parameters
+        ----------
+        arr: ndarray, integer dtype, shape (bands, rows, cols)
+        out_dtype: uint8 or uint16, default: same as arr
+
+        Returns
+        -------
+        ndarray of out_dtype with the same shape as arr
+        """
+        out = np.empty(arr.shape, dtype=np.dtype(out_dtype or arr.dtype))
+        self.apply(arr, out)
+        in_max, out_max = np.iinfo(arr.dtype).max, np.iinfo(out.dtype).max
+        for b in range(3, arr.shape[0]):
+            if arr.dtype == out.dtype:
+                out[b] = arr[b]
+            else:
+                np.copyto(out[b], arr[b] / in_max * out_max, casting="unsafe")
+        return out
+
+    def error(self, ops_string, arr, out_dtype=None):
+        """Difference with the exact operations on an array.
+
+        Returns
+        -------
+        tuple of (max, mean) absolute difference, in output code values
+        """
+        out_dtype = np.dtype(out_dtype or arr.dtype)
+        diff = np.abs(
+            self(arr, out_dtype)[:3].astype("int64")
+            - ColorPipeline(ops_string)(arr, out_dtype)[:3]
+        )
+        return int(diff.max()), float(diff.mean())
@@ -0,0 +1,203 @@
+"""Incremental reprocessing of outputs from a manifest of window hashes.
+
+A manifest kept alongside an output records a hash of the input data
+of every window and of the formula it was computed with: the
+normalized operations and other worker arguments, the output profile
+and the versions of rio-color and numpy. When the same job is run
+again against the existing output, only the windows whose input data
+or formula changed are recomputed, the others are left untouched.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import rasterio
+
+import rio_color
+from .cache import _file_digests, canonical_operations
+from .pool import imap_windows
+
+
+def manifest_path(dst_path):
+    """Path of the manifest kept alongside an output."""
+    return dst_path + ".manifest"
+
+
+def window_key(window):
+    """Manifest key of a window, ``row_off col_off height width``."""
+    return "{} {} {} {}".format(
+        int(window.row_off), int(window.col_off), int(window.height), int(window.width)
+    )
+
+
+def formula_hash(opts, args):
+    """Hash of everything but the input data that an output depends on."""
+    args = dict(args)
+    if "ops_string" in args:
+        ops_string = args["ops_string"]
+        args["ops_string"] = canonical_operations(ops_string)
+        args["lut_files"] = _file_digests(ops_string)
+    description = json.dumps(
+        [
+            {k: str(v) for k, v in args.items()},
+            {k: str(v) for k, v in opts.items()},
+            rio_color.__version__,
+            np.__version__,
+        ],
+        sort_keys=True,
+    )
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def window_hash(arr):
+    """Hash of the data of a window."""
+    arr = np.ascontiguousarray(arr)
+    digest = hashlib.blake2b(arr.dtype.str.encode(), digest_size=16)
+    digest.update(arr)
+    return digest.hexdigest()
+
+
+class _ReadWindow:
+    """A dataset whose read of one window returns data already read."""
+
+    def __init__(self, src, window, arr):
+        self._src = src
+        self._window = window
+        self._arr = arr
+
+    def read(self, indexes=None, window=None, **kwargs):
+        if indexes is None and window == self._window and not kwargs:
+            return self._arr
+        return self._src.read(indexes, window=window, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._src, name)
+
+
+def incremental_worker(srcs, window, ij, args):
+    """Hash the data of a window, and run a worker if it changed.
+
+    args holds the ``worker`` to run, its ``args`` and the ``previous``
+    hash of the window, if any. The window is read once, for both the
+    hash and the worker.
+
+    Returns
+    -------
+    tuple of (hash, result of the worker or None if the hash is the
+    previous one)
+    """
+    src = srcs[0]
+    arr = src.read(window=window)
+    digest = window_hash(arr)
+    if digest == args["previous"]:
+        return digest, None
+    srcs = [_ReadWindow(src, window, arr)] + list(srcs[1:])
+    return digest, args["worker"](srcs, window, ij, args["args"])
+
+
+def load_manifest(path):
+    """Read a manifest, or None if it is missing or unreadable."""
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or "formula" not in manifest:
+        return None
+    return manifest
+
+
+def write_manifest(path, manifest):
+    """Write a manifest atomically."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def process_windows_incremental(
+    worker,
+    src_path,
+    dst_path,
+    windows,
+    opts,
+    args,
+    jobs=1,
+    copy_colorinterp=False,
+):
+    """Run a window worker, only for windows changed since the last run.
+
+    The data of every window of the source is hashed by the workers
+    and compared with the manifest at ``manifest_path(dst_path)``. If
+    the output and a manifest with the same formula exist, the windows
+    whose hashes differ, or that are new, are recomputed into the
+    output in place, from the data read for their hash. Otherwise the
+    whole output is written. The manifest is updated once every window
+    has been written, an interrupted run leaves the previous manifest,
+    or none, so its windows are computed again.
+
+    Returns
+    -------
+    (int, int), the number of windows processed in this run and the
+    total number of windows
+    """
+    path = manifest_path(dst_path)
+    formula = formula_hash(opts, args)
+
+    manifest = load_manifest(path)
+    if (
+        manifest is not None
+        and manifest["formula"] == formula
+        and os.path.exists(dst_path)
+    ):
+        previous = manifest["windows"]
+        dest = rasterio.open(dst_path, "r+")
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        previous = {}
+        dest = rasterio.open(dst_path, "w", **opts)
+
+    tasks = (
+        (
+            None,
+            incremental_worker,
+            src_path,
+            window,
+            ij,
+            {
+                "worker": worker,
+                "args": args,
+                "previous": previous.get(window_key(window)),
+            },
+        )
+        for window, ij in windows
+    )
+
+    hashes = {}
+    count = 0
+    try:
+        # Results hold a hash with the array, so they are pickled
+        # rather than returned through shared memory
+        results = imap_windows(tasks, jobs=jobs)
+        try:
+            for _, window, (digest, arr), _ in results:
+                hashes[window_key(window)] = digest
+                if arr is not None:
+                    dest.write(arr, window=window)
+                    count += 1
+        finally:
+            results.close()
+
+        if copy_colorinterp:
+            with rasterio.open(src_path) as src:
+                dest.colorinterp = src.colorinterp
+    finally:
+        dest.close()
+
+    write_manifest(path, {"formula": formula, "windows": hashes})
+    return count, len(windows)
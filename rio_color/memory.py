@@ -0,0 +1,165 @@
+"""Memory estimates and memory-bounded window layouts."""
+
+import re
+import sys
+
+import numpy as np
+
+from .operations import simple_atmo_opstring
+from .pipeline import get_pipeline
+from .pool import WindowGrid
+from .utils import math_type
+
+# Float temporaries, in bands, that an operation allocates on top of
+# the pipeline's scratch buffer while it runs. Measured with tracemalloc
+# on small windows, numpy reuses some temporaries of large arrays.
+op_temporaries = {"gamma": 1, "sigmoidal": 2, "saturation": 3, "stretch": 1}
+
+_units = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_size(value):
+    """Parse a size such as ``512M``, ``2G`` or ``1.5GB`` into bytes.
+
+    Units are binary (1K is 1024 bytes), a bare number is in bytes.
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d*)?)\s*([KMGT]?)(?:i?B)?\s*$", str(value), re.I)
+    if not match:
+        raise ValueError("Invalid size {!r}, expected e.g. 512M or 2G".format(value))
+    number, unit = match.groups()
+    return int(float(number) * _units[unit.upper()])
+
+
+def format_size(nbytes):
+    """Format a number of bytes with a binary unit."""
+    if nbytes < 1024:
+        return "{} B".format(int(nbytes))
+    for unit in ("KiB", "MiB", "GiB"):
+        nbytes /= 1024
+        if nbytes < 1024 or unit == "GiB":
+            break
+    return "{:.1f} {}".format(nbytes, unit)
+
+
+def op_floats(op, count):
+    """Float temporaries of an Operation, in bands.
+
+    Per-band operations run on all their bands at once, so their
+    temporaries are counted for each of their bands.
+    """
+    temporaries = op_temporaries.get(op.name, count)
+    return temporaries if op.rgb_op else temporaries * len(op.bands)
+
+
+def color_pixel_bytes(ops_string, count, in_dtype, out_dtype):
+    """Peak working memory of color_worker per pixel, in bytes.
+
+    Counts the window read from the source, the output and, unless the
+    pipeline uses lookup tables, its float scratch buffer for the bands
+    it computes and the temporaries of its most demanding operation.
+    """
+    pipeline = get_pipeline(ops_string)
+    nbytes = count * (np.dtype(in_dtype).itemsize + np.dtype(out_dtype).itemsize)
+    if pipeline.table(in_dtype, out_dtype, count) is None:
+        floats = len(pipeline.bands) + max(
+            [op_floats(op, count) for op in pipeline.operations] + [0]
+        )
+        if count > len(pipeline.bands) and np.dtype(in_dtype) != np.dtype(out_dtype):
+            # Scratch band to rescale the other bands
+            floats += 1
+        nbytes += floats * np.dtype(math_type).itemsize
+    return nbytes
+
+
+def atmos_pixel_bytes(count, in_dtype, out_dtype, atmo=0.03, contrast=10, bias=0.15):
+    """Peak working memory of atmos_worker per pixel, in bytes.
+
+    atmos_worker runs the operations of simple_atmo_opstring, see
+    color_pixel_bytes.
+    """
+    return color_pixel_bytes(
+        simple_atmo_opstring(atmo, contrast, bias), count, in_dtype, out_dtype
+    )
+
+
+def _spans(size, block, step):
+    """Offsets and lengths covering size, never crossing a block boundary
+    unless step spans whole blocks."""
+    if step >= size:
+        return [(0, size)]
+    if step >= block:
+        step -= step % block
+        return [(off, min(step, size - off)) for off in range(0, size, step)]
+
+    # Split each block evenly into as few pieces as possible
+    pieces = -(-block // step)
+    step = -(-block // pieces)
+    return [
+        (off, min(step, start + block - off, size - off))
+        for start in range(0, size, block)
+        for off in range(start, min(start + block, size), step)
+    ]
+
+
+def fit_windows(width, height, block_shape, pixel_bytes, budget, jobs=1):
+    """Windows covering a raster so that jobs windows fit in a budget.
+
+    Blocks are merged, whole block rows first, when the budget allows,
+    but never into fewer than about four windows per job so that all
+    workers stay busy. Blocks too large for the budget are split into
+    strips of rows.
+
+    Parameters
+    ----------
+    width, height: int, size of the raster
+    block_shape: tuple of (rows, cols), the raster's block shape
+    pixel_bytes: int, working memory per pixel, see color_pixel_bytes
+    budget: int, bytes available to all jobs together
+    jobs: int, number of windows processed at the same time
+
+    Returns
+    -------
+    WindowGrid of (Window, (row, col)) pairs like ``block_windows``
+    """
+    block_rows, block_cols = min(block_shape[0], height), min(block_shape[1], width)
+    max_pixels = budget // (jobs * pixel_bytes)
+    if max_pixels < block_cols:
+        raise ValueError(
+            "Memory limit of {} is too small for {} jobs, at least {} is "
+            "needed".format(
+                format_size(budget),
+                jobs,
+                format_size(jobs * pixel_bytes * block_cols),
+            )
+        )
+
+    target = min(max_pixels, max(block_rows * block_cols, width * height // (4 * jobs)))
+    if target >= block_rows * width:
+        rows, cols = target // width, width
+    elif target >= block_rows * block_cols:
+        rows, cols = block_rows, target // block_rows
+    else:
+        rows, cols = target // block_cols, block_cols
+
+    return WindowGrid(_spans(height, block_rows, rows), _spans(width, block_cols, cols))
+
+
+def peak_rss():
+    """Peak resident memory of this process and of its largest child.
+
+    Returns
+    -------
+    tuple of (self, children) in bytes, children only counts finished
+    child processes. (None, None) where the resource module is missing.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None, None
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == "darwin" else 1024
+    return tuple(
+        resource.getrusage(who).ru_maxrss * scale
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    )
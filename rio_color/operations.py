@@ -1,5 +1,7 @@
 """Color operations."""
 
+from collections import namedtuple
+
 import numpy as np
 from .utils import epsilon
 from .colorspace import saturate_rgb
@@ -27,6 +29,9 @@ def sigmoidal(arr, contrast, bias):
         Threshold level for the contrast function to center on
         (typically centered at 0.5)
 
+    contrast and bias may also be arrays of shape (bands, 1, ...) with
+    one value per band of arr.
+
     Notes
     ----------
 
@@ -52,6 +57,9 @@ def sigmoidal(arr, contrast, bias):
     if (arr.max() > 1.0 + epsilon) or (arr.min() < 0 - epsilon):
         raise ValueError("Input array must have float values between 0 and 1")
 
+    if np.ndim(bias) or np.ndim(contrast):
+        return _sigmoidal_bands(arr, contrast, bias)
+
     if (bias > 1.0 + epsilon) or (bias < 0 - epsilon):
         raise ValueError("bias must be a scalar float between 0 and 1")
 
@@ -66,7 +74,35 @@ def sigmoidal(arr, contrast, bias):
 
     np.seterr(divide="ignore", invalid="ignore")
 
-    if beta > 0:
+    return _sigmoidal(arr, alpha, beta, inverse=beta < 0)
+
+
+def _sigmoidal_bands(arr, contrast, bias):
+    # sigmoidal with per-band parameters broadcasting against arr, the
+    # bands with a positive and with a negative contrast are computed
+    # at once
+    if np.any(bias > 1.0 + epsilon) or np.any(bias < 0 - epsilon):
+        raise ValueError("bias must be a scalar float between 0 and 1")
+
+    alpha, beta = np.broadcast_arrays(np.where(bias == 0, epsilon, bias), contrast)
+    np.seterr(divide="ignore", invalid="ignore")
+
+    signs = np.sign(beta).reshape(len(beta), -1)[:, 0]
+    if signs[0] != 0 and (signs == signs[0]).all():
+        return _sigmoidal(arr, alpha, beta, inverse=signs[0] < 0)
+    output = np.array(arr, dtype="float64")
+    for sign in (1, -1):
+        bands = signs == sign
+        if bands.any():
+            output[bands] = _sigmoidal(
+                arr[bands], alpha[bands], beta[bands], inverse=sign < 0
+            )
+    return output
+
+
+def _sigmoidal(arr, alpha, beta, inverse):
+    # sigmoidal for non-zero contrasts, all negative if inverse
+    if not inverse:
         numerator = 1 / (1 + np.exp(beta * (alpha - arr))) - 1 / (
             1 + np.exp(beta * alpha)
         )
@@ -110,19 +146,43 @@ def gamma(arr, g):
 
     Parameters
     ----------
-    gamma (:math:`\gamma`): float
+    gamma (:math:`\gamma`): float, or array broadcasting against arr
         Reasonable values range from 0.8 to 2.4.
 
 
     """
     if (arr.max() > 1.0 + epsilon) or (arr.min() < 0 - epsilon):
         raise ValueError("Input array must have float values between 0 and 1")
-    if g <= 0 or np.isnan(g):
+    if np.ndim(g):
+        if np.any(g <= 0) or np.any(np.isnan(g)):
+            raise ValueError("gamma must be greater than 0")
+    elif g <= 0 or np.isnan(g):
         raise ValueError("gamma must be greater than 0")
 
     return arr ** (1.0 / g)
 
 
+def stretch(arr, low, high):
+    """Stretch values between low and high linearly to 0..1
+
+    Values below low become 0 and values above high become 1.
+
+    Parameters
+    ----------
+    arr: ndarray, values between 0 and 1
+    low, high: float, or array broadcasting against arr
+        Values between 0 and 1, high greater than low. See
+        ``rio_color.stats.resolve_percentiles`` to stretch between
+        percentiles of an image.
+    """
+    if np.any(np.asarray(high) <= low):
+        raise ValueError("stretch HIGH must be greater than LOW")
+
+    out = np.subtract(arr, low)
+    out /= np.subtract(high, low)
+    return np.clip(out, 0, 1, out=out)
+
+
 def saturation(arr, proportion):
     """Apply saturation to an RGB array (in LCH color space)
 
@@ -141,6 +201,37 @@ def saturation(arr, proportion):
     return saturate_rgb(arr, proportion)
 
 
+def lut(arr, path):
+    """Apply a 3D .cube lookup table to an RGB array
+
+    Each pixel is interpolated tetrahedrally in the table of the file.
+
+    Parameters
+    ----------
+    arr: ndarray with shape (3, ..., ...), values between 0 and 1
+    path: str, path of a .cube file with a 3D table
+    """
+    from .lut import interpolate, read_cube
+
+    table, _ = read_cube(path)
+    return interpolate(arr, table)
+
+
+def lut_curve(arr, path, channel):
+    """Apply one curve of a 1D .cube lookup table to a band
+
+    Parameters
+    ----------
+    arr: ndarray, values between 0 and 1
+    path: str, path of a .cube file with a 1D table
+    channel: int, 0, 1 or 2 for the red, green or blue curve
+    """
+    from .lut import read_cube
+
+    table, _ = read_cube(path)
+    return np.interp(arr, np.linspace(0, 1, len(table)), table[:, channel])
+
+
 def simple_atmo_opstring(haze, contrast, bias):
     """Make a simple atmospheric correction formula."""
     gamma_b = 1 - haze
@@ -169,14 +260,11 @@ def simple_atmo(rgb, haze, contrast, bias):
     """
     gamma_b = 1 - haze
     gamma_g = 1 - (haze / 3.0)
-    arr = np.empty(shape=(3, rgb.shape[1], rgb.shape[2]))
-
-    arr[0] = rgb[0]
-    arr[1] = gamma(rgb[1], gamma_g)
-    arr[2] = gamma(rgb[2], gamma_b)
 
     output = rgb.copy()
-    output[0:3] = sigmoidal(arr, contrast, bias)
+    output[1] = gamma(rgb[1], gamma_g)
+    output[2] = gamma(rgb[2], gamma_b)
+    output[0:3] = sigmoidal(output[0:3], contrast, bias)
 
     return output
 
@@ -186,6 +274,7 @@ def _op_factory(func, kwargs, opname, bands, rgb_op=False):
     don't call directly, use parse_operations
     returns a function which itself takes and returns ndarrays
     """
+    rows = [b - 1 for b in sorted(bands)]
 
     def f(arr):
         # Avoid mutation by copying
@@ -195,53 +284,154 @@ def _op_factory(func, kwargs, opname, bands, rgb_op=False):
             # additional band(s) are untouched
             newarr[0:3] = func(newarr[0:3], **kwargs)
         else:
-            # apply func to array band at a time
-            for b in bands:
-                newarr[b - 1] = func(arr[b - 1], **kwargs)
+            # apply func to all its bands at once, with per-band
+            # arguments broadcasting over the bands
+            if rows[-1] >= arr.shape[0]:
+                raise ValueError(
+                    "{} uses band {} but the array has {} bands".format(
+                        opname, rows[-1] + 1, arr.shape[0]
+                    )
+                )
+            newarr[rows] = func(arr[rows], **band_params(kwargs, arr.ndim))
         return newarr
 
     f.__name__ = str(opname)
     return f
 
 
-def parse_operations(ops_string):
-    """Takes a string of operations written with a handy DSL
+def band_params(kwargs, ndim):
+    """Arguments of a per-band operation for its bands of an array.
 
-    "OPERATION-NAME BANDS ARG1 ARG2 OPERATION-NAME BANDS ARG"
+    Per-band arguments, tuples with one value per band of the
+    operation, become arrays broadcasting against the stack of these
+    bands of an ndim array.
+    """
+    return {
+        k: np.reshape(v, (-1,) + (1,) * (ndim - 1)) if isinstance(v, tuple) else v
+        for k, v in kwargs.items()
+    }
 
-    And returns a list of functions, each of which take and return ndarrays
+
+def band_kwargs(op):
+    """(band, kwargs) pairs of a per-band Operation, in band order.
+
+    kwargs hold the scalar arguments of the operation for that band.
+    """
+    return [
+        (b, {k: v[i] if isinstance(v, tuple) else v for k, v in op.kwargs.items()})
+        for i, b in enumerate(sorted(op.bands))
+    ]
+
+
+# A parsed operation, see parse_operations
+Operation = namedtuple("Operation", ["name", "func", "kwargs", "bands", "rgb_op"])
+
+
+class Percentile(float):
+    """A percentile argument, such as ``2%``, that stands for a value of
+    an image, see ``rio_color.stats.resolve_percentiles``."""
+
+    def __repr__(self):
+        return "{!r}%".format(float(self))
+
+
+# Operations whose arguments can be percentiles
+percentile_ops = ("stretch",)
+
+
+def _parse_value(opname, value):
+    """Parse one value of an argument, a float or a Percentile."""
+    if not value.endswith("%"):
+        return float(value)
+    if opname not in percentile_ops:
+        raise ValueError("{} doesn't take percentiles".format(opname))
+    percentile = Percentile(value[:-1])
+    if not 0 <= percentile <= 100:
+        raise ValueError("Percentiles must be between 0% and 100%")
+    return percentile
+
+
+def has_percentiles(op):
+    """Whether an Operation has Percentile arguments."""
+    return any(
+        isinstance(x, Percentile)
+        for v in op.kwargs.values()
+        for x in (v if isinstance(v, tuple) else (v,))
+    )
+
+
+def check_resolved(operations):
+    """Raise ValueError if some Operation still has Percentile arguments."""
+    for op in operations:
+        if has_percentiles(op):
+            raise ValueError(
+                "{} percentiles need statistics of the image, see "
+                "rio_color.stats.resolve_percentiles".format(op.name)
+            )
+
+
+def _parse_operations(ops_string):
+    """Parse an operations string into a list of Operation tuples
+
+    Validates operation names, bands and arguments without creating
+    any functions. See parse_operations for the DSL.
     """
     band_lookup = {"r": 1, "g": 2, "b": 3}
-    count = len(band_lookup)
 
-    opfuncs = {"saturation": saturation, "sigmoidal": sigmoidal, "gamma": gamma}
+    opfuncs = {
+        "saturation": saturation,
+        "sigmoidal": sigmoidal,
+        "gamma": gamma,
+        "stretch": stretch,
+        "lut": lut,
+    }
 
     opkwargs = {
         "saturation": ("proportion",),
         "sigmoidal": ("contrast", "bias"),
         "gamma": ("g",),
+        "stretch": ("low", "high"),
     }
 
     # Operations that assume RGB colorspace
     rgb_ops = ("saturation",)
 
-    # split into tokens, commas are optional whitespace
-    tokens = [x.strip() for x in ops_string.replace(",", "").split(" ")]
+    # split into tokens, commas between operations are optional
+    # whitespace, commas within a token separate bands or values
     operations = []
     current = []
-    for token in tokens:
+    for raw in ops_string.split():
+        token = raw.strip(",")
+        if not token:
+            continue
         if token.lower() in opfuncs.keys():
             if len(current) > 0:
                 operations.append(current)
                 current = []
-        current.append(token.lower())
+        elif (
+            len(current) == 1
+            and current[0].lower() not in rgb_ops + ("lut",)
+            and raw.endswith(",")
+            and token.isdigit()
+        ):
+            # A single band past 9 keeps its trailing comma, as in 10,
+            token = raw
+        # Keep the case of lut file paths
+        current.append(token)
     if len(current) > 0:
         operations.append(current)
+    if not operations:
+        raise ValueError("No operations given")
 
     result = []
     for parts in operations:
-        opname = parts[0]
-        bandstr = parts[1]
+        opname = parts[0].lower()
+
+        if opname == "lut":
+            result.extend(_parse_lut(parts))
+            continue
+
+        bandstr = parts[1].lower()
         args = parts[2:]
 
         try:
@@ -256,31 +446,229 @@ def parse_operations(ops_string):
             bands = (1, 2, 3)
         else:
             # 2nd arg is bands
-            # parse r,g,b ~= 1,2,3
-            bands = set()
-            for bs in bandstr:
+            # parse r,g,b ~= 1,2,3, each character is a band unless
+            # bands are separated by commas, as in 9,10,11 or 10,
+            bands = []
+            for bs in bandstr.strip(",").split(",") if "," in bandstr else bandstr:
                 try:
                     band = int(bs)
                 except ValueError:
-                    band = band_lookup[bs.lower()]
-                if band < 1 or band > count:
+                    try:
+                        band = band_lookup[bs]
+                    except KeyError:
+                        raise ValueError("{} is not a valid band".format(bs))
+                if band < 1:
+                    raise ValueError("{} BAND must be 1 or more".format(opname))
+                bands.append(band)
+
+        # assume all args are float, or percentiles, values separated
+        # by commas are per band
+        args = [
+            (
+                tuple(_parse_value(opname, v) for v in arg.split(","))
+                if "," in arg
+                else _parse_value(opname, arg)
+            )
+            for arg in args
+        ]
+        for arg in args:
+            if isinstance(arg, tuple) and len({type(v) for v in arg}) > 1:
+                raise ValueError(
+                    "{} can't mix percentiles and values in an argument".format(opname)
+                )
+        if any(isinstance(arg, tuple) for arg in args):
+            if opname in rgb_ops:
+                raise ValueError("{} takes a single value per argument".format(opname))
+            if len(set(bands)) != len(bands):
+                raise ValueError(
+                    "{} bands can't repeat with per-band values".format(opname)
+                )
+            # Values in the order of the sorted bands
+            order = sorted(range(len(bands)), key=bands.__getitem__)
+            for i, arg in enumerate(args):
+                if not isinstance(arg, tuple):
+                    continue
+                if len(arg) != len(bands):
                     raise ValueError(
-                        "{} BAND must be between 1 and {}".format(opname, count)
+                        "{} has {} bands but {} values".format(
+                            opname, len(bands), len(arg)
+                        )
                     )
-                bands.add(band)
-
-        # assume all args are float
-        args = [float(arg) for arg in args]
+                arg = tuple(arg[j] for j in order)
+                args[i] = arg[0] if len(set(arg)) == 1 else arg
         kwargs = dict(zip(opkwargs[opname], args))
 
-        # Create opperation function
-        f = _op_factory(
-            func=func,
-            kwargs=kwargs,
-            opname=opname,
-            bands=bands,
-            rgb_op=(opname in rgb_ops),
+        result.append(
+            Operation(
+                name=opname,
+                func=func,
+                kwargs=kwargs,
+                bands=bands if opname in rgb_ops else set(bands),
+                rgb_op=(opname in rgb_ops),
+            )
         )
-        result.append(f)
 
     return result
+
+
+def format_operations(operations):
+    """Format a list of Operation tuples as a normalized operations string
+
+    Inverse of _parse_operations, bands are written as sorted digits,
+    separated by commas past band 9, with a trailing comma for a single
+    band past 9, and arguments as Python floats, separated by commas for
+    per-band values.
+    """
+    parts = []
+    for op in operations:
+        if op.name == "lut":
+            # Curves of a 1D table are written once
+            if op.kwargs.get("channel", 0) == 0:
+                parts.append("lut {}".format(op.kwargs["path"]))
+            continue
+        args = " ".join(
+            ",".join(repr(x) for x in v) if isinstance(v, tuple) else repr(v)
+            for v in op.kwargs.values()
+        )
+        if op.rgb_op:
+            parts.append("{} {}".format(op.name, args))
+        else:
+            sep = "," if max(op.bands) > 9 else ""
+            bands = sep.join(str(b) for b in sorted(op.bands))
+            if len(op.bands) == 1 and sep:
+                bands += ","
+            parts.append("{} {} {}".format(op.name, bands, args))
+    return ", ".join(parts)
+
+
+def _parse_lut(parts):
+    """Operations of "lut PATH", reading the .cube file at PATH
+
+    A 3D table mixes bands and becomes a single RGB operation, a 1D
+    table becomes one per-band operation per curve.
+    """
+    from .lut import read_cube
+
+    if len(parts) != 2:
+        raise ValueError("lut takes the path of a .cube file")
+    path = parts[1]
+    table, _ = read_cube(path)
+    if table.ndim == 4:
+        return [Operation("lut", lut, {"path": path}, (1, 2, 3), True)]
+    return [
+        Operation("lut", lut_curve, {"path": path, "channel": c}, {c + 1}, False)
+        for c in range(3)
+    ]
+
+
+def parse_operations(ops_string):
+    """Takes a string of operations written with a handy DSL
+
+    "OPERATION-NAME BANDS ARG1 ARG2 OPERATION-NAME BANDS ARG"
+
+    And returns a list of functions, each of which take and return ndarrays
+
+    BANDS are digits or r, g and b, or numbers separated by commas
+    such as 9,10,11, or a single number with a trailing comma such as
+    10,. ARGs of per-band operations may be values
+    separated by commas, one per band in the order of BANDS.
+    """
+    operations = _parse_operations(ops_string)
+    check_resolved(operations)
+    # Create opperation functions
+    return [
+        _op_factory(
+            func=op.func,
+            kwargs=op.kwargs,
+            opname=op.name,
+            bands=op.bands,
+            rgb_op=op.rgb_op,
+        )
+        for op in operations
+    ]
+
+
+# Opcodes of colorspace.run_program, need to stay in sync with the
+# enum in colorspace.pyx
+OP_GAMMA = 0
+OP_SIGMOIDAL = 1
+OP_INV_SIGMOIDAL = 2
+OP_SATURATION = 3
+OP_STRETCH = 4
+
+
+def compile_program(ops_string):
+    """Compile an operations string into a program for run_program
+
+    The program is a float array with one instruction per row:
+    opcode, position of the band in bands, then up to four operands.
+    Constants of each operation are computed here with the same
+    expressions as the operation functions use.
+
+    Returns
+    -------
+    tuple of (program, bands), bands being the sorted 1-based bands
+    used by the operations
+
+    Raises ValueError if an operation has invalid or missing arguments.
+    """
+    operations = _parse_operations(ops_string)
+    check_resolved(operations)
+    bands = tuple(sorted({b for op in operations for b in op.bands}))
+    position = {b: i for i, b in enumerate(bands)}
+
+    program = []
+    for op in operations:
+        if op.rgb_op:
+            program.append(_instruction(op, op.kwargs, position[1]))
+        else:
+            for b, kwargs in band_kwargs(op):
+                program.append(_instruction(op, kwargs, position[b]))
+
+    return np.array(program, dtype="float64").reshape(-1, 6), bands
+
+
+def _instruction(op, kwargs, position):
+    """Program row of an operation with scalar kwargs for a band position."""
+    try:
+        if op.name == "gamma":
+            g = kwargs["g"]
+            if g <= 0 or np.isnan(g):
+                raise ValueError("gamma must be greater than 0")
+            instr = [OP_GAMMA, 1.0 / g, 0, 0, 0]
+
+        elif op.name == "sigmoidal":
+            beta, alpha = kwargs["contrast"], kwargs["bias"]
+            if (alpha > 1.0 + epsilon) or (alpha < 0 - epsilon):
+                raise ValueError("bias must be a scalar float between 0 and 1")
+            if alpha == 0:
+                alpha = epsilon
+
+            if beta == 0:
+                # Only checks the range, like sigmoidal
+                instr = [OP_GAMMA, 1.0, 0, 0, 0]
+            elif beta > 0:
+                offset = 1 / (1 + np.exp(beta * alpha))
+                scale = 1 / (1 + np.exp(beta * (alpha - 1))) - offset
+                instr = [OP_SIGMOIDAL, beta, alpha, offset, scale]
+            else:
+                e1 = 1 + np.exp(beta * alpha - beta)
+                e2 = 1 + np.exp(beta * alpha)
+                instr = [OP_INV_SIGMOIDAL, beta, alpha, e1, e2]
+
+        elif op.name == "saturation":
+            instr = [OP_SATURATION, kwargs["proportion"], 0, 0, 0]
+
+        elif op.name == "stretch":
+            low, high = kwargs["low"], kwargs["high"]
+            if high <= low:
+                raise ValueError("stretch HIGH must be greater than LOW")
+            instr = [OP_STRETCH, low, high - low, 0, 0]
+
+        else:
+            raise ValueError("{} can't be compiled".format(op.name))
+
+    except KeyError:
+        raise ValueError("{} is missing arguments".format(op.name))
+
+    return [instr[0], position] + instr[1:]
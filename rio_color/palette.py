@@ -0,0 +1,133 @@
+"""Color correction of paletted rasters through their colormap.
+
+The pixels of a paletted raster are indices into a colormap of at
+most 256 (uint8) or 65536 (uint16) colors, so any operations can be
+applied to the colors of the colormap instead of to every pixel. The
+output is either a copy of the raster with the corrected colormap or,
+on request, the RGB(A) image the indices stand for.
+"""
+
+import shutil
+
+import numpy as np
+import rasterio
+from rasterio.enums import ColorInterp
+from rasterio.transform import guard_transform
+
+from .pipeline import get_pipeline
+
+
+def has_palette(src):
+    """Whether a dataset is a single band paletted raster."""
+    return src.count == 1 and src.colorinterp[0] == ColorInterp.palette
+
+
+def colormap_array(colormap):
+    """Colors of a colormap as a uint8 array of shape (4, 1, n).
+
+    n is one more than the largest index, missing entries are
+    transparent black.
+    """
+    arr = np.zeros((4, 1, max(colormap) + 1), dtype="uint8")
+    for index, color in colormap.items():
+        arr[: len(color), 0, index] = color
+        if len(color) == 3:
+            arr[3, 0, index] = 255
+    return arr
+
+
+def palette_colors(src, ops_string, out_dtype="uint8"):
+    """Corrected colors of the colormap of a paletted dataset.
+
+    Returns
+    -------
+    ndarray of out_dtype and shape (4, 1, n), corrected red, green and
+    blue and the alpha of the colormap, see ``colormap_array``. The
+    nodata index, if any, is transparent.
+    """
+    colors = get_pipeline(ops_string)(colormap_array(src.colormap(1)), out_dtype)
+    if src.nodata is not None and 0 <= src.nodata < colors.shape[2]:
+        colors[3, 0, int(src.nodata)] = 0
+    return colors
+
+
+def palette_profile(
+    src, ops_string, creation_options=None, expand=False, out_dtype=None
+):
+    """Output profile for color_palette.
+
+    Without expand, the profile of the source updated with
+    creation_options. With expand, an RGB profile of out_dtype
+    (default uint8), with an alpha band if some colors are transparent.
+    """
+    opts = src.profile.copy()
+    opts.update(**(creation_options or {}))
+    opts["transform"] = guard_transform(opts["transform"])
+    if expand:
+        out_dtype = out_dtype or "uint8"
+        alpha = palette_colors(src, ops_string, out_dtype)[3]
+        opts.update(
+            count=3 if (alpha == np.iinfo(out_dtype).max).all() else 4,
+            dtype=out_dtype,
+            nodata=None,
+        )
+        opts.pop("photometric", None)
+    return opts
+
+
+def color_palette(src_path, dst_path, ops_string, opts=None, expand=False):
+    """Color correct a paletted raster through its colormap.
+
+    Without expand, the output has the indices of the source and the
+    corrected colormap. Without opts, the source file is copied as is
+    and only its colormap is rewritten, so no block is decoded.
+    Otherwise the indices are copied window by window.
+
+    With expand, the output has the corrected colors of the pixels.
+
+    Parameters
+    ----------
+    src_path, dst_path: str
+    ops_string: str, operations, see ``parse_operations``
+    opts: dict, output profile, see ``palette_profile``
+    expand: bool, write the colors instead of indices
+
+    Returns
+    -------
+    str, dst_path
+    """
+    with rasterio.open(src_path) as src:
+        if not has_palette(src):
+            raise ValueError("{} is not a paletted raster".format(src_path))
+        if opts is None:
+            if expand or src.driver != "GTiff":
+                opts = palette_profile(src, ops_string, expand=expand)
+        colors = palette_colors(src, ops_string, opts["dtype"] if expand else "uint8")
+        values = np.iinfo(src.dtypes[0]).max + 1
+
+    if opts is None:
+        shutil.copyfile(src_path, dst_path)
+        with rasterio.open(dst_path, "r+") as dst:
+            dst.write_colormap(1, _colormap_dict(colors))
+        return dst_path
+
+    # Indices missing from the colormap are transparent black
+    lookup = np.zeros((opts["count"], values), dtype=colors.dtype)
+    lookup[:, : colors.shape[2]] = colors[: opts["count"], 0]
+    with rasterio.open(src_path) as src, rasterio.open(dst_path, "w", **opts) as dst:
+        for _, window in src.block_windows(1):
+            arr = src.read(window=window)
+            if expand:
+                arr = np.take(lookup, arr[0], axis=1)
+            dst.write(arr, window=window)
+
+        if expand:
+            interp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue]
+            dst.colorinterp = (interp + [ColorInterp.alpha])[: dst.count]
+        else:
+            dst.write_colormap(1, _colormap_dict(colors))
+    return dst_path
+
+
+def _colormap_dict(colors):
+    return {i: tuple(int(v) for v in colors[:, 0, i]) for i in range(colors.shape[2])}
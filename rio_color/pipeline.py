@@ -0,0 +1,597 @@
+"""Compiled, reusable color pipelines for integer arrays."""
+
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from .cache import cached_table
+from .operations import (
+    _parse_operations,
+    band_params,
+    check_resolved,
+    compile_program,
+)
+from .utils import math_type
+
+# Integer dtypes small enough to be processed through lookup tables
+table_dtypes = (np.dtype("uint8"), np.dtype("uint16"))
+
+# Dtypes supported by colorspace.run_program
+program_in_dtypes = tuple(
+    np.dtype(t) for t in ("uint8", "uint16", "int16", "uint32", "int32")
+)
+program_out_dtypes = table_dtypes
+
+engines = ("numpy", "native")
+
+
+class ColorPipeline:
+    """An operations string compiled once for repeated use.
+
+    Instances take integer arrays of shape (bands, rows, cols) in any
+    integer dtype and return integer arrays, producing the same result
+    as applying ``parse_operations`` functions between
+    ``to_math_type`` and ``scale_dtype``.
+
+    When every operation works on bands independently (no
+    ``saturation``) and the input is uint8 or uint16, the whole chain
+    is evaluated once per possible input value into per-band lookup
+    tables and applying the pipeline is a table lookup. Otherwise the
+    operations run in place on a float scratch buffer that is reused
+    between calls within each thread.
+
+    With the ``native`` engine, arrays that can't use tables are
+    processed by a compiled op program instead, see
+    ``operations.compile_program``. Every pixel is read, run through
+    the whole chain and written in a single pass without holding the
+    GIL. Its transcendental functions come from the C library rather
+    than numpy, so results may differ from the ``numpy`` engine by one
+    code value.
+
+    With a ``lut_size``, arrays with at least 3 bands that can't use
+    exact tables are approximated with a 3D lookup table of that many
+    points per axis instead, see ``rio_color.lut``. Results then differ
+    from the exact operations by a few code values. Operations ending
+    with a 3D ``lut`` use the table of its file this way without a
+    ``lut_size``.
+
+    Only the bands named by the operations, listed in ``bands``, are
+    computed. Other bands, such as alpha, are copied to the output, or
+    only rescaled if the output dtype differs.
+
+    Instances are safe to share between threads.
+
+    Parameters
+    ----------
+    ops_string: str, operations, see ``parse_operations``
+    engine: str, "numpy" (default) or "native"
+    lut_size: int, points per axis of a 3D lookup table, default: None
+
+    Example
+    -------
+    >>> pipeline = ColorPipeline("gamma rgb 1.2, sigmoidal rgb 10 0.3")
+    >>> out = pipeline(tile, out_dtype="uint8")
+    """
+
+    # Number of scratch buffer shapes kept per thread
+    max_buffers = 4
+
+    # Float values per chunk of evaluate, 1 MiB per temporary
+    chunk_values = 2**17
+
+    def __init__(self, ops_string, engine="numpy", lut_size=None):
+        """Parse and validate the operations string."""
+        if engine not in engines:
+            raise ValueError(
+                "Invalid engine {!r}, expected one of {}".format(
+                    engine, ", ".join(engines)
+                )
+            )
+        self.ops_string = ops_string
+        self.engine = engine
+        self.lut_size = lut_size
+        self.operations = _parse_operations(ops_string)
+        check_resolved(self.operations)
+        self._program = None
+        if engine == "native":
+            try:
+                self._program, _ = compile_program(ops_string)
+            except ValueError:
+                # Invalid arguments raise when applied, as with numpy
+                pass
+        self.per_band = not any(op.rgb_op for op in self.operations)
+        # Whether arrays that can't use exact tables go through a 3D
+        # table, always so for a 3D .cube file after per-band operations
+        mixing = [i for i, op in enumerate(self.operations) if op.rgb_op]
+        self._use_lut3d = bool(lut_size) or (
+            len(mixing) == 1
+            and mixing[0] == len(self.operations) - 1
+            and self.operations[-1].name == "lut"
+        )
+        self.bands = tuple(sorted({b for op in self.operations for b in op.bands}))
+        # Row of each band in the scratch buffer
+        self._rows = {b: row for row, b in enumerate(self.bands)}
+        # Rows of the bands of each operation, a slice when contiguous
+        self._op_rows = []
+        for op in self.operations:
+            rows = [self._rows[b] for b in sorted(op.bands)]
+            if rows == list(range(rows[0], rows[-1] + 1)):
+                rows = slice(rows[0], rows[-1] + 1)
+            self._op_rows.append(rows)
+        self._tables = {}
+        self._lut3d = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __repr__(self):
+        return "ColorPipeline({!r}, engine={!r}, lut_size={!r})".format(
+            self.ops_string, self.engine, self.lut_size
+        )
+
+    def __call__(self, arr, out_dtype=None):
+        """Apply the pipeline to an integer array.
+
+        Parameters
+        ----------
+        arr: ndarray, integer dtype, shape (bands, rows, cols)
+        out_dtype: integer dtype of the result, default: same as arr
+
+        Returns
+        -------
+        ndarray of out_dtype with the same shape as arr
+        """
+        out_dtype = np.dtype(out_dtype or arr.dtype)
+        return self._method(arr, out_dtype)(arr, out_dtype)
+
+    def _method(self, arr, out_dtype):
+        # The function applying the pipeline to arr
+        table = self.table(arr.dtype, out_dtype, arr.shape[0])
+        if table is not None:
+            return lambda arr, out_dtype: self._apply_table(arr, table, out_dtype)
+        if (
+            self._use_lut3d
+            and arr.shape[0] >= 3
+            and arr.dtype in program_in_dtypes
+            and out_dtype in program_out_dtypes
+            and self.lut3d() is not None
+        ):
+            return self._apply_lut3d
+        if (
+            self._program is not None
+            and arr.dtype in program_in_dtypes
+            and out_dtype in program_out_dtypes
+        ):
+            return self._apply_program
+        return self._apply_float
+
+    def table(self, in_dtype, out_dtype, count):
+        """Lookup table of shape (count, values of in_dtype) for a dtype pair.
+
+        Tables are built on first use and kept for the life of the
+        pipeline. uint16 tables are also kept in the on-disk table
+        cache, see ``rio_color.cache``. Returns None if the pipeline
+        can't be tabulated for these dtypes, either because it mixes
+        bands or because some input values are rejected by an
+        operation (the float path then only raises if such values
+        actually occur).
+        """
+        in_dtype, out_dtype = np.dtype(in_dtype), np.dtype(out_dtype)
+        if not self.per_band or in_dtype not in table_dtypes:
+            return None
+
+        key = (in_dtype, out_dtype, count)
+        try:
+            return self._tables[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self._tables:
+                self._tables[key] = self._build_table(*key)
+        return self._tables[key]
+
+    def _build_table(self, in_dtype, out_dtype, count):
+        if in_dtype.itemsize == 1:
+            # Faster to build than to load
+            return self._tabulate(in_dtype, out_dtype, count)
+        return cached_table(
+            self.ops_string,
+            "bands",
+            (in_dtype, out_dtype, count),
+            lambda: self._tabulate(in_dtype, out_dtype, count),
+        )
+
+    def _tabulate(self, in_dtype, out_dtype, count):
+        # Every possible input value, for every band, as a single row
+        values = np.arange(np.iinfo(in_dtype).max + 1, dtype=in_dtype)
+        arr = np.broadcast_to(values, (count, 1, values.size))
+        try:
+            return self._apply_float(arr, out_dtype)[:, 0, :]
+        except ValueError:
+            return None
+
+    def lut3d(self):
+        """The 3D lookup table of the pipeline.
+
+        Built on first use. Returns None without a lut_size, unless the
+        operations end with a 3D ``lut``, or if the operations can't be
+        sampled.
+        """
+        if not self._use_lut3d:
+            return None
+        if self._lut3d is None:
+            from .lut import Lut3D, default_size
+
+            with self._lock:
+                if self._lut3d is None:
+                    try:
+                        self._lut3d = Lut3D.from_operations(
+                            self.ops_string, self.lut_size or default_size
+                        )
+                    except ValueError:
+                        self._lut3d = False
+        return self._lut3d or None
+
+    def _apply_lut3d(self, arr, out_dtype):
+        out = np.empty(arr.shape, dtype=out_dtype)
+        self._lut3d.apply(arr, out)
+        self._copy_other_bands(arr, out)
+        return out
+
+    def _apply_table(self, arr, table, out_dtype):
+        out = np.empty(arr.shape, dtype=out_dtype)
+        for b in range(arr.shape[0]):
+            if b + 1 not in self._rows and arr.dtype == out_dtype:
+                out[b] = arr[b]
+            else:
+                np.take(table[b], arr[b], out=out[b])
+        return out
+
+    def _scratch(self, shape):
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        buf = buffers.get(shape)
+        if buf is None:
+            if len(buffers) >= self.max_buffers:
+                buffers.clear()
+            buf = buffers[shape] = np.empty(shape, dtype=math_type)
+        return buf
+
+    def _check_bands(self, count):
+        if self.bands and self.bands[-1] > count:
+            raise ValueError(
+                "Operations use band {} but the array has {} bands".format(
+                    self.bands[-1], count
+                )
+            )
+
+    def _apply_float(self, arr, out_dtype, values=None):
+        # Same arithmetic as to_math_type, op functions and scale_dtype,
+        # without the intermediate copies and only for the bands used.
+        # values, if given, holds every band of arr already divided.
+        self._check_bands(arr.shape[0])
+        in_max, out_max = np.iinfo(arr.dtype).max, np.iinfo(out_dtype).max
+
+        buf = self._scratch((len(self.bands),) + arr.shape[1:])
+        for b, row in self._rows.items():
+            if values is None:
+                np.divide(arr[b - 1], in_max, out=buf[row])
+            else:
+                buf[row] = values[b - 1]
+
+        self.evaluate(buf)
+
+        np.multiply(buf, out_max, out=buf)
+        out = np.empty(arr.shape, dtype=out_dtype)
+        for b, row in self._rows.items():
+            np.copyto(out[b - 1], buf[row], casting="unsafe")
+        self._copy_other_bands(arr, out)
+        return out
+
+    def evaluate(self, buf):
+        """Run the operations in place on float values between 0 and 1.
+
+        buf has one row per band in ``bands``, in that order. Per-band
+        operations run once over all their bands, with per-band
+        arguments broadcasting over them. Large buffers are processed
+        in chunks of rows so that the temporaries of the operations
+        stay in cache.
+        """
+        size = buf.shape[0] * int(np.prod(buf.shape[2:]))
+        step = max(1, self.chunk_values // max(size, 1))
+        for start in range(0, buf.shape[1], step):
+            chunk = buf[:, start : start + step]
+            for op, rows in zip(self.operations, self._op_rows):
+                if op.rgb_op:
+                    chunk[0:3] = op.func(chunk[0:3], **op.kwargs)
+                else:
+                    kwargs = band_params(op.kwargs, chunk.ndim)
+                    chunk[rows] = op.func(chunk[rows], **kwargs)
+        return buf
+
+    def _apply_program(self, arr, out_dtype):
+        from .colorspace import run_program
+
+        self._check_bands(arr.shape[0])
+        out = np.empty(arr.shape, dtype=out_dtype)
+        run_program(
+            arr,
+            out,
+            self._program,
+            np.array(self.bands, dtype=np.intp) - 1,
+            np.iinfo(arr.dtype).max,
+            np.iinfo(out_dtype).max,
+        )
+        self._copy_other_bands(arr, out)
+        return out
+
+    def _copy_other_bands(self, arr, out):
+        # (v / max) * max is exact, bands left alone are only copied
+        # or rescaled.
+        in_max, out_max = np.iinfo(arr.dtype).max, np.iinfo(out.dtype).max
+        for b in range(arr.shape[0]):
+            if b + 1 in self._rows:
+                continue
+            if arr.dtype == out.dtype:
+                out[b] = arr[b]
+            else:
+                tmp = self._scratch((1,) + arr.shape[1:])[0]
+                np.divide(arr[b], in_max, out=tmp)
+                np.multiply(tmp, out_max, out=tmp)
+                np.copyto(out[b], tmp, casting="unsafe")
+
+
+def _lut_files(ops_string):
+    """(path, mtime, size) of the files read by lut operations, in order."""
+    if "lut" not in ops_string.lower():
+        return ()
+    files = []
+    for op in _parse_operations(ops_string):
+        if op.name == "lut" and op.kwargs.get("channel", 0) == 0:
+            stat = os.stat(op.kwargs["path"])
+            files.append(
+                (os.path.abspath(op.kwargs["path"]), stat.st_mtime_ns, stat.st_size)
+            )
+    return tuple(files)
+
+
+@lru_cache(maxsize=32)
+def _cached_pipeline(ops_string, engine, lut_size, lut_files):
+    return ColorPipeline(ops_string, engine, lut_size)
+
+
+def get_pipeline(ops_string, engine="numpy", lut_size=None):
+    """Return a ColorPipeline for ops_string, compiled once per process.
+
+    Pipelines reading .cube files with lut operations are compiled
+    again when one of the files is modified.
+    """
+    return _cached_pipeline(ops_string, engine, lut_size, _lut_files(ops_string))
+
+
+get_pipeline.cache_clear = _cached_pipeline.cache_clear
+
+
+def apply_many(pipelines, arr, out_dtype=None):
+    """Apply several pipelines to the same array.
+
+    Gives the same results as calling each pipeline on arr, but the
+    array is converted to floats only once for all the pipelines that
+    need it.
+
+    Returns
+    -------
+    list of ndarrays of out_dtype, one per pipeline
+    """
+    out_dtype = np.dtype(out_dtype or arr.dtype)
+    methods = [pipeline._method(arr, out_dtype) for pipeline in pipelines]
+    floats = [
+        method == pipeline._apply_float for pipeline, method in zip(pipelines, methods)
+    ]
+    values = None
+    if sum(floats) > 1:
+        values = np.divide(arr, np.iinfo(arr.dtype).max, dtype=math_type)
+    return [
+        method(arr, out_dtype, values) if float_ else method(arr, out_dtype)
+        for method, float_ in zip(methods, floats)
+    ]
+
+
+def few_colors(arr, max_colors=8, samples=1024):
+    """Distinct pixel values of an array that has few of them.
+
+    A grid of about ``samples`` pixels spread over the rows and columns
+    is checked first, so
+    arrays with more than ``max_colors`` distinct values are usually
+    rejected after reading only the sample. Otherwise every pixel is
+    compared with the colors of the sample.
+
+    Parameters
+    ----------
+    arr: ndarray, shape (bands, rows, cols)
+    max_colors: int, largest number of distinct values to look for
+    samples: int, number of pixels sampled before the full check
+
+    Returns
+    -------
+    (colors, index) or None if arr has more than max_colors distinct
+    values. colors is an array of arr.dtype and shape (bands, 1, n),
+    index an array of shape (rows, cols) such that
+    ``colors[:, 0, index]`` equals arr.
+    """
+    _, rows, cols = arr.shape
+    count = rows * cols
+    if count == 0:
+        return None
+    flat = arr.reshape(arr.shape[0], count)
+    # Sampled rows and columns in proportion to the shape, a flat
+    # stride would fall on the same few columns of square blocks
+    sample_rows = max(1, min(rows, round(math.sqrt(samples * rows / cols))))
+    sample_cols = max(1, samples // sample_rows)
+    sample = arr[:, :: max(1, rows // sample_rows), :: max(1, cols // sample_cols)]
+    sample = sample.reshape(arr.shape[0], -1)
+    # Each band has at most as many values as the pixels
+    if any(np.unique(band).size > max_colors for band in sample):
+        return None
+    colors = np.unique(sample, axis=1)
+    if colors.shape[1] > max_colors:
+        return None
+
+    index = np.zeros(count, dtype=np.uint8)
+    if colors.shape[1] == 1:
+        if not (flat == colors).all():
+            return None
+        return colors[:, np.newaxis, :], index.reshape(arr.shape[1:])
+
+    matched = np.zeros(count, dtype=bool)
+    for i in range(colors.shape[1]):
+        match = flat[0] == colors[0, i]
+        for b in range(1, flat.shape[0]):
+            match &= flat[b] == colors[b, i]
+        index[match] = i
+        matched |= match
+    if not matched.all():
+        # Colors missed by the sample
+        return None
+    return colors[:, np.newaxis, :], index.reshape(arr.shape[1:])
+
+
+def apply_few_colors(pipeline, arr, out_dtype=None, max_colors=8):
+    """Apply a pipeline to the distinct pixel values of an array only.
+
+    Uniform arrays, or arrays made of up to ``max_colors`` distinct
+    values, are computed on these values and the results are spread
+    to the pixels, which gives the same output as ``pipeline(arr,
+    out_dtype)`` at a fraction of the cost. Returns None for other
+    arrays, and for arrays that have exact lookup tables since these
+    are already a single lookup per pixel. See ``few_colors``.
+    """
+    out_dtype = np.dtype(out_dtype or arr.dtype)
+    if pipeline.table(arr.dtype, out_dtype, arr.shape[0]) is not None:
+        return None
+    found = few_colors(arr, max_colors)
+    if found is None:
+        return None
+    colors, index = found
+    values = pipeline(colors, out_dtype)[:, 0]
+    if values.shape[1] == 1:
+        out = np.empty(arr.shape, dtype=out_dtype)
+        out[...] = values[:, :, np.newaxis]
+        return out
+    return np.take(values, index, axis=1)
+
+
+def _strips(rows, cols, workers, strip_rows=None):
+    """Row ranges splitting an array into strips for workers."""
+    if strip_rows is None:
+        # About a million pixels, and at least four strips per worker
+        strip_rows = min(max(1, 2**20 // max(cols, 1)), -(-rows // (4 * workers)))
+    strip_rows = max(1, strip_rows)
+    return [(r, min(r + strip_rows, rows)) for r in range(0, rows, strip_rows)]
+
+
+# Arrays and pipeline of a process pool worker, set by _init_shared
+_shared = {}
+
+
+def _init_shared(src_name, dst_name, shape, in_dtype, out_dtype, ops_string, engine):
+    from multiprocessing.shared_memory import SharedMemory
+
+    src, dst = SharedMemory(src_name), SharedMemory(dst_name)
+    _shared.update(
+        blocks=(src, dst),
+        src=np.ndarray(shape, in_dtype, buffer=src.buf),
+        dst=np.ndarray(shape, out_dtype, buffer=dst.buf),
+        pipeline=get_pipeline(ops_string, engine),
+    )
+
+
+def _apply_shared(strip):
+    start, stop = strip
+    dst = _shared["dst"]
+    dst[:, start:stop] = _shared["pipeline"](_shared["src"][:, start:stop], dst.dtype)
+
+
+def apply(
+    arr,
+    ops_string,
+    out_dtype=None,
+    workers=1,
+    processes=False,
+    strip_rows=None,
+    engine="numpy",
+):
+    """Apply an operations string to a large array on several cores.
+
+    The array is split into strips of rows that are processed in
+    parallel and written into a preallocated output. The result is the
+    same as ``get_pipeline(ops_string, engine)(arr, out_dtype)``.
+
+    Threads share the input and output arrays, and most of the work
+    happens in numpy with the GIL released. With the numpy engine,
+    ``saturation`` holds the GIL: use the native engine, or processes,
+    for chains with it. Processes work on a copy of the input in shared
+    memory and write to shared memory, so no strip is pickled.
+
+    Parameters
+    ----------
+    arr: ndarray, integer dtype, shape (bands, rows, cols)
+    ops_string: str, operations, see ``parse_operations``
+    out_dtype: integer dtype of the result, default: same as arr
+    workers: int, number of threads or processes
+    processes: bool, use processes instead of threads
+    strip_rows: int, rows per strip, default: about a million pixels
+    engine: str, see ``ColorPipeline``
+
+    Returns
+    -------
+    ndarray of out_dtype with the same shape as arr
+    """
+    pipeline = get_pipeline(ops_string, engine)
+    out_dtype = np.dtype(out_dtype or arr.dtype)
+    if arr.ndim != 3:
+        raise ValueError("Expected an array of shape (bands, rows, cols)")
+    strips = _strips(arr.shape[1], arr.shape[2], workers, strip_rows)
+
+    if workers <= 1 or len(strips) == 1:
+        return pipeline(arr, out_dtype)
+    if processes:
+        return _apply_processes(arr, ops_string, engine, out_dtype, workers, strips)
+
+    out = np.empty(arr.shape, dtype=out_dtype)
+
+    def run(strip):
+        start, stop = strip
+        out[:, start:stop] = pipeline(arr[:, start:stop], out_dtype)
+
+    with ThreadPoolExecutor(workers) as executor:
+        # Consume the results to raise the first error
+        for _ in executor.map(run, strips):
+            pass
+    return out
+
+
+def _apply_processes(arr, ops_string, engine, out_dtype, workers, strips):
+    from multiprocessing import Pool
+    from multiprocessing.shared_memory import SharedMemory
+
+    out_nbytes = arr.size * out_dtype.itemsize
+    # Created before the pool so that the workers share this process's
+    # resource tracker.
+    src = SharedMemory(create=True, size=max(arr.nbytes, 1))
+    dst = SharedMemory(create=True, size=max(out_nbytes, 1))
+    try:
+        np.ndarray(arr.shape, arr.dtype, buffer=src.buf)[...] = arr
+        initargs = (src.name, dst.name, arr.shape, arr.dtype.str, out_dtype.str)
+        with Pool(workers, _init_shared, initargs + (ops_string, engine)) as pool:
+            for _ in pool.imap_unordered(_apply_shared, strips):
+                pass
+        return np.ndarray(arr.shape, out_dtype, buffer=dst.buf).copy()
+    finally:
+        for block in (src, dst):
+            block.close()
+            block.unlink()
@@ -0,0 +1,333 @@
+"""Running window workers on a pool of processes."""
+
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Sequence
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+# Per-process cache of open source datasets, keyed by path and
+# modification time so that a long-lived pool never reads a stale file.
+_max_open = 8
+_datasets = OrderedDict()
+
+
+def open_cached(path):
+    """Return an open dataset for path, reusing handles within a process."""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    src = _datasets.pop(key, None)
+    if src is None:
+        src = rasterio.open(path)
+        while len(_datasets) >= _max_open:
+            _, oldest = _datasets.popitem(last=False)
+            oldest.close()
+    _datasets[key] = src
+    return src
+
+
+def run_window(task):
+    """Run a window worker for one task.
+
+    Parameters
+    ----------
+    task: tuple of (key, worker, src_path, window, ij, args), where
+        worker takes (datasets, window, ij, args) and key is passed
+        through to identify the result.
+
+    Returns
+    -------
+    tuple of (key, window, array, seconds spent in the worker)
+    """
+    key, worker, path, window, ij, args = task
+    start = time.perf_counter()
+    arr = worker([open_cached(path)], window, ij, args)
+    return key, window, arr, time.perf_counter() - start
+
+
+class WindowGrid(Sequence):
+    """Windows in rows and columns, generated as they are requested.
+
+    A sequence of (Window, (row, col)) pairs like ``block_windows``,
+    in the same row major order, that only stores the offsets and
+    lengths of its rows and columns. Rasters with millions of blocks
+    then cost no memory or time before their windows are processed.
+
+    Parameters
+    ----------
+    row_spans, col_spans: lists of (offset, length)
+    """
+
+    def __init__(self, row_spans, col_spans):
+        """Keep the spans."""
+        self.row_spans = list(row_spans)
+        self.col_spans = list(col_spans)
+
+    @classmethod
+    def from_blocks(cls, width, height, block_shape):
+        """The block windows of a raster, see ``block_grid``."""
+        rows, cols = block_shape
+        return cls(
+            [(off, min(rows, height - off)) for off in range(0, height, rows)],
+            [(off, min(cols, width - off)) for off in range(0, width, cols)],
+        )
+
+    def __len__(self):
+        return len(self.row_spans) * len(self.col_spans)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("window index out of range")
+        i, j = divmod(index, len(self.col_spans))
+        (row_off, height), (col_off, width) = self.row_spans[i], self.col_spans[j]
+        return Window(col_off, row_off, width, height), (i, j)
+
+    def __iter__(self):
+        for i, (row_off, height) in enumerate(self.row_spans):
+            for j, (col_off, width) in enumerate(self.col_spans):
+                yield Window(col_off, row_off, width, height), (i, j)
+
+    def max_pixels(self):
+        """Number of pixels of the largest window."""
+        return max(h for _, h in self.row_spans) * max(w for _, w in self.col_spans)
+
+
+def block_grid(src):
+    """The block windows of a dataset as a WindowGrid."""
+    return WindowGrid.from_blocks(src.width, src.height, src.block_shapes[0])
+
+
+def result_bytes(windows, count, dtype):
+    """Size of the largest result of a window worker, in bytes."""
+    if isinstance(windows, WindowGrid):
+        pixels = windows.max_pixels()
+    else:
+        pixels = max(int(window.width * window.height) for window, _ in windows)
+    return pixels * count * np.dtype(dtype).itemsize
+
+
+# Shared memory blocks attached in a worker process, by name
+_attached = {}
+
+
+def _attach(name):
+    from multiprocessing.shared_memory import SharedMemory
+
+    shm = _attached.get(name)
+    if shm is None:
+        shm = _attached[name] = SharedMemory(name)
+    return shm
+
+
+def run_window_shared(task):
+    """Run a window worker, returning the result in a shared memory slot.
+
+    Parameters
+    ----------
+    task: tuple of (slot, name, size, window task), where window task
+        is a run_window task and name and size describe the slot's
+        shared memory block.
+
+    Returns
+    -------
+    tuple of (slot, key, window, result, seconds), result is the
+    (shape, dtype) of the array written to the slot, or the array
+    itself if it doesn't fit.
+    """
+    slot, name, size, task = task
+    key, window, arr, seconds = run_window(task)
+    if arr.nbytes <= size:
+        buf = _attach(name).buf
+        np.ndarray(arr.shape, arr.dtype, buffer=buf)[...] = arr
+        arr = (arr.shape, arr.dtype.str)
+    return slot, key, window, arr, seconds
+
+
+def _shared_memory_fits(nbytes):
+    # Writing past the free space of a full /dev/shm kills the
+    # process with SIGBUS instead of raising, check beforehand.
+    try:
+        stat = os.statvfs("/dev/shm")
+    except (AttributeError, OSError):
+        return True
+    return nbytes <= stat.f_bavail * stat.f_frsize // 2
+
+
+class InFlight:
+    """Bound on the number of tasks handed to a pool at a time.
+
+    Pools take every task from their iterable as soon as they can, a
+    task only counts as done here once its result has been consumed.
+
+    Parameters
+    ----------
+    limit: int, number of tasks in flight
+    """
+
+    def __init__(self, limit):
+        """Create the semaphore."""
+        self._free = threading.Semaphore(limit)
+        self._stopped = threading.Event()
+
+    def tasks(self, tasks):
+        """Yield tasks, blocking while limit of them are in flight."""
+        for task in tasks:
+            while not self._free.acquire(timeout=0.1):
+                if self._stopped.is_set():
+                    return
+            yield task
+
+    def release(self):
+        """Count a task as done."""
+        self._free.release()
+
+    def stop(self):
+        """Stop handing out tasks, call before terminating the pool."""
+        self._stopped.set()
+
+
+class ResultSlots:
+    """Shared memory blocks that workers write their results to.
+
+    A slot is given to a task when the pool takes it and freed once
+    the result read from it has been consumed, so that at most count
+    results are in flight.
+
+    Parameters
+    ----------
+    count: int, number of slots
+    size: int, size of each slot in bytes
+    """
+
+    def __init__(self, count, size):
+        """Create the shared memory blocks."""
+        from multiprocessing.shared_memory import SharedMemory
+
+        self.size = size
+        self._blocks = [SharedMemory(create=True, size=size) for _ in range(count)]
+        self._free = queue.Queue()
+        for slot in range(count):
+            self._free.put(slot)
+        self._stopped = threading.Event()
+
+    def tasks(self, tasks):
+        """Wrap run_window tasks into run_window_shared tasks.
+
+        Blocks until a slot is free, this runs in the pool's task
+        handler thread.
+        """
+        for task in tasks:
+            while True:
+                try:
+                    slot = self._free.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if self._stopped.is_set():
+                        return
+            yield slot, self._blocks[slot].name, self.size, task
+
+    def result(self, slot, result):
+        """The array for a run_window_shared result."""
+        if isinstance(result, tuple):
+            shape, dtype = result
+            result = np.ndarray(shape, dtype, buffer=self._blocks[slot].buf)
+        return result
+
+    def release(self, slot):
+        """Make a slot available for another task."""
+        self._free.put(slot)
+
+    def stop(self):
+        """Stop handing out slots, call before terminating the pool."""
+        self._stopped.set()
+
+    def close(self):
+        """Free the shared memory blocks."""
+        self.stop()
+        for block in self._blocks:
+            try:
+                block.close()
+            except BufferError:
+                # The consumer still holds the last result, the
+                # mapping goes away with it.
+                pass
+            block.unlink()
+
+
+def imap_windows(tasks, jobs=1, pool=None, result_size=None, ordered=False):
+    """Run window tasks, yielding run_window results as they complete.
+
+    Uses pool if given, a new pool of jobs processes if jobs > 1, or
+    runs the tasks in this process. A given pool keeps all its
+    processes busy, jobs is then only a lower bound on its size.
+
+    Tasks are taken from their iterable as workers become free, one at
+    a time, so windows of uneven cost don't leave workers idle, and
+    at most two per job are in flight so that a lazy iterable such as
+    a ``WindowGrid`` is never held in memory.
+
+    With result_size, the size in bytes of the largest result (see
+    ``result_bytes``), a new pool returns results through shared memory
+    instead of pickling them through a pipe. Yielded arrays are then
+    only valid until the next result is requested.
+
+    With ordered, results are yielded in the order of the tasks. A
+    slow task then holds back the results after it, up to the number
+    in flight.
+    """
+    own_pool = None
+    slots = None
+    if pool is None and jobs > 1:
+        from multiprocessing import Pool
+
+        if result_size and _shared_memory_fits(2 * jobs * result_size):
+            # Two slots per job so workers don't wait on the writer.
+            # Created before the pool so that the workers share this
+            # process's resource tracker.
+            slots = ResultSlots(2 * jobs, result_size)
+        pool = own_pool = Pool(jobs)
+
+    gate = None
+    if pool is not None and slots is None:
+        # Sized from the pool a caller passes in, whatever jobs is
+        gate = InFlight(2 * max(getattr(pool, "_processes", jobs), jobs, 1))
+    try:
+        if pool is None:
+            yield from map(run_window, tasks)
+            return
+
+        imap = pool.imap if ordered else pool.imap_unordered
+        if slots is not None:
+            for slot, key, window, result, seconds in imap(
+                run_window_shared, slots.tasks(tasks)
+            ):
+                yield key, window, slots.result(slot, result), seconds
+                slots.release(slot)
+        else:
+            for result in imap(run_window, gate.tasks(tasks)):
+                yield result
+                gate.release()
+    except BaseException:
+        # Includes GeneratorExit when the consumer stops early,
+        # don't wait for the remaining tasks.
+        for bound in (slots, gate):
+            if bound is not None:
+                bound.stop()
+        if own_pool is not None:
+            own_pool.terminate()
+        raise
+    finally:
+        if own_pool is not None:
+            own_pool.close()
+            own_pool.join()
+        if slots is not None:
+            slots.close()
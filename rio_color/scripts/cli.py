@@ -1,13 +1,19 @@
-"""Main CLI."""
+"""Main CLI.
+
+rio loads every plugin's entry point for every invocation, including
+`rio --help` and unrelated subcommands. To keep that cheap, this module
+only imports click and rasterio's option helpers (rio has already
+imported rasterio at that point). The operations, workers, the Cython
+extension and the worker pool are imported by the commands that use
+them.
+"""
+
+import os
+from contextlib import nullcontext
 
 import click
 
-import rasterio
 from rasterio.rio.options import creation_options
-from rasterio.transform import guard_transform
-from rio_color.workers import atmos_worker, color_worker
-from rio_color.operations import parse_operations, simple_atmo_opstring
-import riomucho
 
 
 jobs_opt = click.option(
@@ -18,6 +24,68 @@ jobs_opt = click.option(
     help="Number of jobs to run simultaneously, Use -1 for all cores, default: 1",
 )
 
+cog_opt = click.option(
+    "--cog",
+    is_flag=True,
+    default=False,
+    help="Write a Cloud-Optimized GeoTIFF with overviews.",
+)
+
+overview_resampling_opt = click.option(
+    "--overview-resampling",
+    type=click.Choice(
+        ["nearest", "average", "bilinear", "cubic", "cubicspline", "lanczos", "mode"]
+    ),
+    default="average",
+    show_default=True,
+    help="Resampling method for COG overviews.",
+)
+
+checkpoint_opt = click.option(
+    "--checkpoint",
+    is_flag=True,
+    default=False,
+    help="Keep a journal of finished windows in DST_PATH.journal so that "
+    "an interrupted job can be resumed.",
+)
+
+resume_opt = click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Resume an interrupted --checkpoint job, only processing the "
+    "windows missing from its journal. Implies --checkpoint.",
+)
+
+checkpoint_interval_opt = click.option(
+    "--checkpoint-interval",
+    type=click.FLOAT,
+    default=30.0,
+    show_default=True,
+    help="Seconds between checkpoints.",
+)
+
+
+def _parse_mem_limit(ctx, param, value):
+    if value is None:
+        return None
+    from rio_color.memory import parse_size
+
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+mem_limit_opt = click.option(
+    "--mem-limit",
+    callback=_parse_mem_limit,
+    default=None,
+    help="Memory budget for the windows being processed by all jobs, e.g. "
+    "512M or 4G. Windows are split or merged to fit and the peak memory "
+    "reached is reported.",
+)
+
 
 def check_jobs(jobs):
     """Validate number of jobs."""
@@ -30,6 +98,188 @@ def check_jobs(jobs):
     return jobs
 
 
+def process_windows(
+    worker,
+    src_path,
+    dst_path,
+    windows,
+    opts,
+    args,
+    jobs,
+    copy_colorinterp=False,
+    checkpoint=False,
+    resume=False,
+    checkpoint_interval=30.0,
+    incremental=False,
+):
+    """Run a window worker over a source and write the results."""
+    import rasterio
+
+    if incremental:
+        from rio_color.manifest import process_windows_incremental
+
+        count, total = process_windows_incremental(
+            worker,
+            src_path,
+            dst_path,
+            windows,
+            opts,
+            args,
+            jobs=jobs,
+            copy_colorinterp=copy_colorinterp,
+        )
+        click.echo("Recomputed {} of {} windows".format(count, total), err=True)
+    elif checkpoint or resume:
+        from rio_color.checkpoint import (
+            JournalMismatchError,
+            process_windows_checkpointed,
+        )
+
+        try:
+            process_windows_checkpointed(
+                worker,
+                src_path,
+                dst_path,
+                windows,
+                opts,
+                args,
+                jobs=jobs,
+                resume=resume,
+                interval=checkpoint_interval,
+                copy_colorinterp=copy_colorinterp,
+            )
+        except JournalMismatchError as e:
+            raise click.UsageError(str(e))
+    elif jobs > 1:
+        from rio_color.pool import imap_windows, result_bytes
+
+        tasks = ((None, worker, src_path, window, ij, args) for window, ij in windows)
+        size = result_bytes(windows, opts["count"], opts["dtype"])
+        with rasterio.open(dst_path, "w", **opts) as dest:
+            # In order, so that blocks are laid out in the output as
+            # they would be by a single job
+            results = imap_windows(tasks, jobs=jobs, result_size=size, ordered=True)
+            try:
+                for _, window, arr, _ in results:
+                    dest.write(arr, window=window)
+            finally:
+                results.close()
+
+            if copy_colorinterp:
+                with rasterio.open(src_path) as src:
+                    dest.colorinterp = src.colorinterp
+    else:
+        with rasterio.open(dst_path, "w", **opts) as dest:
+            with rasterio.open(src_path) as src:
+                rasters = [src]
+                for window, ij in windows:
+                    arr = worker(rasters, window, ij, args)
+                    dest.write(arr, window=window)
+
+                if copy_colorinterp:
+                    dest.colorinterp = src.colorinterp
+
+
+def process_windows_multi(
+    worker, src_path, dst_paths, windows, opts, args, jobs, copy_colorinterp=False
+):
+    """Run a window worker returning the bands of several outputs stacked,
+    and write each output."""
+    from contextlib import ExitStack
+
+    import rasterio
+    from rio_color.pool import imap_windows, result_bytes
+
+    count = opts["count"]
+    tasks = ((None, worker, src_path, window, ij, args) for window, ij in windows)
+    size = result_bytes(windows, count * len(dst_paths), opts["dtype"])
+    with ExitStack() as stack:
+        dests = [
+            stack.enter_context(rasterio.open(path, "w", **opts)) for path in dst_paths
+        ]
+        results = imap_windows(tasks, jobs=jobs, result_size=size, ordered=True)
+        try:
+            for _, window, arr, _ in results:
+                for i, dest in enumerate(dests):
+                    dest.write(arr[i * count : (i + 1) * count], window=window)
+        finally:
+            results.close()
+
+        if copy_colorinterp:
+            with rasterio.open(src_path) as src:
+                for dest in dests:
+                    dest.colorinterp = src.colorinterp
+
+
+def fit_to_memory(mem_limit, jobs, opts, block_shape, pixel_bytes):
+    """Window layout keeping jobs windows within mem_limit bytes."""
+    from rio_color.memory import fit_windows, format_size
+
+    try:
+        windows = fit_windows(
+            opts["width"], opts["height"], block_shape, pixel_bytes, mem_limit, jobs
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    largest = windows.max_pixels()
+    click.echo(
+        "{} windows, estimated {} per window and {} for {} jobs, "
+        "memory limit {}".format(
+            len(windows),
+            format_size(largest * pixel_bytes),
+            format_size(jobs * largest * pixel_bytes),
+            jobs,
+            format_size(mem_limit),
+        ),
+        err=True,
+    )
+    return windows
+
+
+def resolve_stats(src_path, ops_strings, jobs):
+    """Operations strings with their percentiles replaced by values of
+    the source, see rio_color.stats.resolve_percentiles."""
+    from rio_color.stats import resolve_percentiles
+
+    resolved = []
+    try:
+        for ops_string in ops_strings:
+            resolved.append(resolve_percentiles(ops_string, src_path, jobs=jobs))
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    for ops_string, values in zip(ops_strings, resolved):
+        if values != ops_string:
+            click.echo("Operations: {}".format(values), err=True)
+    return resolved
+
+
+def echo_peak_memory(jobs):
+    """Report the peak resident memory of this process and its workers."""
+    from rio_color.memory import format_size, peak_rss
+
+    own, children = peak_rss()
+    if own is None:
+        return
+    message = "Peak memory: {} in this process".format(format_size(own))
+    if jobs > 1 and children:
+        message += ", {} in the largest worker".format(format_size(children))
+    click.echo(message, err=True)
+
+
+def cog_or_direct_output(cog, dst_path, opts, creation_options, resampling):
+    """Context manager yielding the path and profile to write to.
+
+    With cog, writes go to a temporary file that is converted to a
+    Cloud-Optimized GeoTIFF at dst_path on exit.
+    """
+    if cog:
+        from rio_color.cog import cog_output
+
+        return cog_output(dst_path, opts, creation_options, resampling)
+    return nullcontext((dst_path, opts))
+
+
 @click.command("color")
 @jobs_opt
 @click.option(
@@ -38,12 +288,75 @@ def check_jobs(jobs):
     type=click.Choice(["uint8", "uint16"]),
     help="Integer data type for output data, default: same as input",
 )
+@cog_opt
+@overview_resampling_opt
+@checkpoint_opt
+@resume_opt
+@checkpoint_interval_opt
+@mem_limit_opt
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Keep hashes of the input windows and of the operations in "
+    "DST_PATH.manifest. When run again against an existing output, only "
+    "recompute the windows whose input data or operations changed.",
+)
+@click.option(
+    "--also",
+    nargs=2,
+    multiple=True,
+    metavar="DST_PATH OPERATIONS",
+    help="Also write DST_PATH with OPERATIONS, a quoted operations string, "
+    "from the same read of the source. Can be repeated.",
+)
+@click.option(
+    "--expand-palette",
+    is_flag=True,
+    default=False,
+    help="Write the corrected colors of a paletted raster as RGB(A) instead "
+    "of its indices with a corrected colormap.",
+)
+@click.option(
+    "--lut-size",
+    type=click.IntRange(min=2),
+    default=None,
+    help="Approximate operations that mix bands, such as saturation, with a "
+    "3D lookup table of this many points per axis, e.g. 33 or 65. Faster, "
+    "but results differ by a few code values.",
+)
+@click.option(
+    "--server",
+    "server",
+    default=None,
+    help="Submit the job to a running `rio color-server` at this address "
+    "(host:port or unix:/path/to.sock) instead of processing it here",
+)
 @click.argument("src_path", type=click.Path(exists=True))
 @click.argument("dst_path", type=click.Path(exists=False))
 @click.argument("operations", nargs=-1, required=True)
 @click.pass_context
 @creation_options
-def color(ctx, jobs, out_dtype, src_path, dst_path, operations, creation_options):
+def color(
+    ctx,
+    jobs,
+    out_dtype,
+    cog,
+    overview_resampling,
+    checkpoint,
+    resume,
+    checkpoint_interval,
+    mem_limit,
+    incremental,
+    also,
+    expand_palette,
+    lut_size,
+    server,
+    src_path,
+    dst_path,
+    operations,
+    creation_options,
+):
     """Color correction
 
 Operations will be applied to the src image in the specified order.
@@ -60,6 +373,13 @@ Available OPERATIONS include:
         Adjusts the contrast and brightness of midtones.
         BIAS > 0.5 darkens the image.
 
+\b
+    "stretch BANDS LOW HIGH"
+        Stretches values between LOW and HIGH to the full range.
+        LOW and HIGH are between 0 and 1, or percentiles such as
+        2% and 98% of the bands after the operations before,
+        computed in a first pass.
+
 \b
     "saturation PROPORTION"
         Controls the saturation in LCH color space.
@@ -67,10 +387,20 @@ Available OPERATIONS include:
         PROPORTION = 1 results in an identical image
         PROPORTION = 2 is likely way too saturated
 
+\b
+    "lut PATH"
+        Applies a 1D or 3D lookup table from a .cube file,
+        see rio color-lut.
+
 BANDS are specified as a single arg, no delimiters
 
 \b
     `123` or `RGB` or `rgb` are all equivalent
+    `9,10,11` for bands past 9
+    `10,` for band 10 alone
+
+Arguments of gamma, sigmoidal and stretch can have one value per band,
+separated by commas, e.g. "gamma 1234 1.1,1.0,0.95,1.2".
 
 Example:
 
@@ -78,47 +408,556 @@ Example:
     rio color -d uint8 -j 4 input.tif output.tif \\
         gamma 3 0.95, sigmoidal rgb 35 0.13
     """
+    if cog and (checkpoint or resume):
+        raise click.UsageError("--cog can't be combined with --checkpoint or --resume")
+    if server and lut_size:
+        raise click.UsageError("--lut-size can't be combined with --server")
+    if server and cog:
+        raise click.UsageError("--cog can't be combined with --server")
+    if server and (checkpoint or resume):
+        raise click.UsageError(
+            "--checkpoint and --resume can't be combined with --server"
+        )
+    if server and mem_limit:
+        raise click.UsageError("--mem-limit can't be combined with --server")
+    if incremental and (cog or checkpoint or resume or server):
+        raise click.UsageError(
+            "--incremental can't be combined with --cog, --checkpoint, --resume "
+            "or --server"
+        )
+    if also and (checkpoint or resume or incremental or server):
+        raise click.UsageError(
+            "--also can't be combined with --checkpoint, --resume, --incremental "
+            "or --server"
+        )
+
+    ops_string = " ".join(operations)
+    if "%" in ops_string or any("%" in ops for _, ops in also):
+        ops_string, *others = resolve_stats(
+            src_path, [ops_string] + [ops for _, ops in also], check_jobs(jobs)
+        )
+        also = [(path, ops) for (path, _), ops in zip(also, others)]
+
+    if server:
+        from rio_color.server import ColorServerError, submit
+
+        try:
+            submit(
+                server,
+                src_path,
+                dst_path,
+                ops_string,
+                out_dtype=out_dtype,
+                creation_options=creation_options,
+            )
+        except (ColorServerError, ValueError) as e:
+            raise click.UsageError(str(e))
+        except OSError as e:
+            raise click.ClickException(
+                "Could not connect to server {}: {}".format(server, e)
+            )
+        return
+
+    import rasterio
+    from rasterio.transform import guard_transform
+    from rio_color.operations import _parse_operations, parse_operations
+    from rio_color.palette import has_palette
+    from rio_color.pool import block_grid
+    from rio_color.workers import color_worker, multi_color_worker
+
     with rasterio.open(src_path) as src:
+        if has_palette(src):
+            return color_paletted(ctx, src, dst_path, ops_string, creation_options)
         opts = src.profile.copy()
-        windows = [(window, ij) for ij, window in src.block_windows()]
+        windows = block_grid(src)
+        block_shape = src.block_shapes[0]
 
+    in_dtype = opts["dtype"]
     opts.update(**creation_options)
     opts["transform"] = guard_transform(opts["transform"])
 
     out_dtype = out_dtype if out_dtype else opts["dtype"]
     opts["dtype"] = out_dtype
 
-    args = {"ops_string": " ".join(operations), "out_dtype": out_dtype}
+    args = {"ops_string": ops_string, "out_dtype": out_dtype}
+    if lut_size:
+        args["lut_size"] = lut_size
     # Just run this for validation this time
     # parsing will be run again within the worker
     # where its returned value will be used
+    dst_paths = [dst_path] + [path for path, _ in also]
+    ops_strings = [args["ops_string"]] + [ops for _, ops in also]
     try:
-        parse_operations(args["ops_string"])
+        for ops_string in ops_strings:
+            parse_operations(ops_string)
+            for op in _parse_operations(ops_string):
+                if max(op.bands) > opts["count"]:
+                    raise ValueError(
+                        "{} uses band {} but the raster has {} bands".format(
+                            op.name, max(op.bands), opts["count"]
+                        )
+                    )
     except ValueError as e:
         raise click.UsageError(str(e))
+    if len(set(map(os.path.abspath, dst_paths))) < len(dst_paths):
+        raise click.UsageError("Each output must have its own path")
 
     jobs = check_jobs(jobs)
 
-    if jobs > 1:
-        with riomucho.RioMucho(
-            [src_path],
-            dst_path,
+    if mem_limit:
+        import numpy as np
+        from rio_color.memory import color_pixel_bytes
+
+        # The window is read once for all outputs
+        pixel_bytes = (
+            sum(
+                color_pixel_bytes(ops_string, opts["count"], in_dtype, out_dtype)
+                for ops_string in ops_strings
+            )
+            - len(also) * opts["count"] * np.dtype(in_dtype).itemsize
+        )
+        windows = fit_to_memory(mem_limit, jobs, opts, block_shape, pixel_bytes)
+
+    if also:
+        from contextlib import ExitStack
+
+        del args["ops_string"]
+        args["ops_strings"] = ops_strings
+        with ExitStack() as stack:
+            outputs = [
+                stack.enter_context(
+                    cog_or_direct_output(
+                        cog, path, opts, creation_options, overview_resampling
+                    )
+                )
+                for path in dst_paths
+            ]
+            process_windows_multi(
+                multi_color_worker,
+                src_path,
+                [out_path for out_path, _ in outputs],
+                windows,
+                outputs[0][1],
+                args,
+                jobs,
+                copy_colorinterp=True,
+            )
+        if mem_limit:
+            echo_peak_memory(jobs)
+        return
+
+    output = cog_or_direct_output(
+        cog, dst_path, opts, creation_options, overview_resampling
+    )
+    with output as (out_path, out_opts):
+        process_windows(
             color_worker,
-            windows=windows,
-            options=opts,
-            global_args=args,
-            mode="manual_read",
-        ) as mucho:
-            mucho.run(jobs)
-    else:
-        with rasterio.open(dst_path, "w", **opts) as dest:
-            with rasterio.open(src_path) as src:
-                rasters = [src]
-                for window, ij in windows:
-                    arr = color_worker(rasters, window, ij, args)
-                    dest.write(arr, window=window)
+            src_path,
+            out_path,
+            windows,
+            out_opts,
+            args,
+            jobs,
+            copy_colorinterp=True,
+            checkpoint=checkpoint,
+            resume=resume,
+            checkpoint_interval=checkpoint_interval,
+            incremental=incremental,
+        )
+
+    if mem_limit:
+        echo_peak_memory(jobs)
 
-                dest.colorinterp = src.colorinterp
+
+def color_paletted(ctx, src, dst_path, ops_string, creation_options):
+    """rio color for a paletted raster, through its colormap."""
+    from rio_color.operations import parse_operations
+    from rio_color.palette import color_palette, palette_colors, palette_profile
+
+    params = ctx.params
+    if params["checkpoint"] or params["resume"] or params["incremental"]:
+        raise click.UsageError(
+            "--checkpoint, --resume and --incremental don't apply to paletted "
+            "rasters"
+        )
+    if params["also"]:
+        raise click.UsageError("--also doesn't apply to paletted rasters")
+    expand = params["expand_palette"]
+    out_dtype = params["out_dtype"]
+    if not expand and out_dtype and out_dtype != src.dtypes[0]:
+        raise click.UsageError(
+            "The indices of a paletted raster can't be converted to {}, use "
+            "--expand-palette".format(out_dtype)
+        )
+    try:
+        parse_operations(ops_string)
+        opts = palette_profile(src, ops_string, creation_options, expand, out_dtype)
+        palette_colors(src, ops_string)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    if not (params["cog"] or creation_options or expand):
+        # Copy the file and only rewrite its colormap
+        color_palette(src.name, dst_path, ops_string)
+        return
+
+    # Averaging indices would make up colors
+    resampling = params["overview_resampling"] if expand else "nearest"
+    output = cog_or_direct_output(
+        params["cog"], dst_path, opts, creation_options, resampling
+    )
+    with output as (out_path, out_opts):
+        color_palette(src.name, out_path, ops_string, out_opts, expand)
+
+
+@click.command("color-batch")
+@jobs_opt
+@click.option(
+    "--out-dtype",
+    "-d",
+    type=click.Choice(["uint8", "uint16"]),
+    help="Integer data type for output data, default: same as input",
+)
+@click.option(
+    "--output",
+    "-o",
+    "dst_template",
+    required=True,
+    help="Output path template, e.g. 'out/{stem}_color.tif'. "
+    "Fields: {name}, {stem}, {ext}, {dir}",
+)
+@click.option(
+    "--ops",
+    "-p",
+    "operations",
+    required=True,
+    help="Operations string, see `rio color --help`",
+)
+@click.argument("inputs", nargs=-1, required=True)
+@click.pass_context
+@creation_options
+def color_batch(
+    ctx, jobs, out_dtype, dst_template, operations, inputs, creation_options
+):
+    """Color correct many rasters in one run
+
+INPUTS are paths or glob patterns. All files share one worker pool
+and one compiled set of operations, and windows from several files
+are processed at the same time.
+
+Example:
+
+\b
+    rio color-batch -j 8 -o 'out/{stem}_color.tif' \\
+        -p 'gamma 3 0.95, sigmoidal rgb 35 0.13' 'scenes/*.tif'
+    """
+    from rio_color.batch import expand_inputs, output_path, run_batch
+    from rio_color.operations import parse_operations
+
+    src_paths = expand_inputs(inputs)
+    if not src_paths:
+        raise click.UsageError("No input files match {}".format(" ".join(inputs)))
+    for path in src_paths:
+        if not os.path.exists(path):
+            raise click.UsageError("Input file {} does not exist".format(path))
+
+    try:
+        parse_operations(operations)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    try:
+        output_path(dst_template, src_paths[0])
+    except (KeyError, IndexError, ValueError) as e:
+        raise click.UsageError("Invalid output template: {}".format(e))
+
+    jobs = check_jobs(jobs)
+
+    try:
+        summary = run_batch(
+            src_paths,
+            dst_template,
+            operations,
+            out_dtype=out_dtype,
+            creation_options=creation_options,
+            jobs=jobs,
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    for item in summary:
+        click.echo(
+            "{src_path} -> {dst_path}: {windows} windows, "
+            "{elapsed:.3f}s elapsed, {compute:.3f}s compute".format(**item)
+        )
+    click.echo("{} files processed".format(len(summary)))
+
+
+@click.command("color-server")
+@jobs_opt
+@click.option(
+    "--listen",
+    "-l",
+    "address",
+    default="127.0.0.1:8765",
+    show_default=True,
+    help="Address to listen on, host:port or unix:/path/to.sock",
+)
+@click.option("--verbose", "-v", is_flag=True, help="Log every request.")
+@click.pass_context
+def color_server(ctx, jobs, address, verbose):
+    """Run a local color correction server
+
+    The server keeps a warm worker pool between jobs. Submit jobs to it
+    with `rio color --server ADDRESS ...`. Stop it with Ctrl-C.
+    """
+    from rio_color.server import make_server
+
+    jobs = check_jobs(jobs)
+    try:
+        server = make_server(address, jobs=jobs, verbose=verbose)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    click.echo("Listening on {} with {} jobs".format(address, jobs), err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@click.group("color-shard")
+def color_shard():
+    """Split one color job across machines
+
+    \b
+        rio color-shard plan -n 3 -d uint8 src.tif work/job "gamma rgb 1.5"
+        rio color-shard run work/job-0.json   # on each machine, k = 0..2
+        rio color-shard merge work/job-*.json out.vrt
+
+    The plan step writes a JSON manifest per shard listing its windows.
+    Each run step processes one manifest into a part GeoTIFF. The merge
+    step stitches the parts into a VRT (for a .vrt output) or copies them
+    into a single output.
+    """
+
+
+@color_shard.command("plan")
+@click.option("--shards", "-n", type=int, required=True, help="Number of shards.")
+@click.option(
+    "--out-dtype",
+    "-d",
+    type=click.Choice(["uint8", "uint16"]),
+    help="Integer data type for output data, default: same as input",
+)
+@click.argument("src_path", type=click.Path(exists=True))
+@click.argument("prefix")
+@click.argument("operations", nargs=-1, required=True)
+@creation_options
+def shard_plan(shards, out_dtype, src_path, prefix, operations, creation_options):
+    """Write PREFIX-K.json shard manifests for a job."""
+    from rio_color.operations import parse_operations
+    from rio_color.shard import plan_shards
+
+    ops_string = " ".join(operations)
+    try:
+        parse_operations(ops_string)
+        paths = plan_shards(
+            src_path,
+            prefix,
+            ops_string,
+            shards,
+            out_dtype=out_dtype,
+            creation_options=creation_options,
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    for path in paths:
+        click.echo(path)
+
+
+@color_shard.command("run")
+@jobs_opt
+@click.argument("manifest", type=click.Path(exists=True))
+def shard_run(jobs, manifest):
+    """Process one shard manifest into its part."""
+    from rio_color.shard import run_shard
+
+    click.echo(run_shard(manifest, jobs=check_jobs(jobs)))
+
+
+@color_shard.command("merge")
+@click.option(
+    "--vrt/--no-vrt",
+    default=None,
+    help="Write a VRT referencing the parts, default: if DST_PATH ends in .vrt",
+)
+@click.argument("manifests", nargs=-1, required=True, type=click.Path(exists=True))
+@click.argument("dst_path", type=click.Path(exists=False))
+@creation_options
+def shard_merge(vrt, manifests, dst_path, creation_options):
+    """Merge the parts of all shards into DST_PATH."""
+    from rio_color.shard import load_manifest, merge_shards, write_vrt
+
+    if vrt is None:
+        vrt = dst_path.lower().endswith(".vrt")
+
+    try:
+        loaded = [load_manifest(path) for path in manifests]
+        if vrt:
+            write_vrt(loaded, dst_path)
+        else:
+            merge_shards(loaded, dst_path, creation_options=creation_options)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+@click.group("color-lut")
+def color_lut():
+    """Export operations as .cube lookup tables
+
+    \b
+        rio color-lut export look.cube "saturation 1.2 sigmoidal rgb 10 0.15"
+        rio color -d uint8 src.tif dst.tif lut look.cube
+
+    .cube files, written here or by other software, are applied with
+    the lut operation of rio color.
+    """
+
+
+@color_lut.command("export")
+@click.option(
+    "--size",
+    "-s",
+    type=click.IntRange(min=2),
+    default=None,
+    help="Points per axis of a 3D table, default: 33, or of the curves of a "
+    "1D table, default: 1024.",
+)
+@click.option(
+    "--1d",
+    "one_d",
+    is_flag=True,
+    default=False,
+    help="Write a 1D table with a curve per band, for operations that don't "
+    "mix bands.",
+)
+@click.option("--title", default=None, help="Title, default: the operations.")
+@click.argument("dst_path", type=click.Path(exists=False))
+@click.argument("operations", nargs=-1, required=True)
+def lut_export(size, one_d, title, dst_path, operations):
+    """Write OPERATIONS as a .cube file."""
+    from rio_color.lut import export_cube
+
+    try:
+        export_cube(" ".join(operations), dst_path, size, one_d=one_d, title=title)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+@color_lut.command("info")
+@click.argument("path", type=click.Path(exists=True))
+def lut_info(path):
+    """Describe a .cube file."""
+    from rio_color.lut import read_cube
+
+    try:
+        table, title = read_cube(path)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    click.echo("Title: {}".format(title or ""))
+    click.echo("Type: {}D".format(table.ndim - 1))
+    click.echo("Size: {}".format(table.shape[0]))
+    click.echo("Range: {:.6f} to {:.6f}".format(table.min(), table.max()))
+
+
+@click.group("color-cache")
+def color_cache():
+    """Inspect and clear the lookup table cache
+
+    Lookup tables compiled for uint16 data are stored in
+    $RIO_COLOR_CACHE_DIR, by default rio-color in the user cache
+    directory, and reused by later jobs. The least recently used tables
+    are removed when the cache grows over $RIO_COLOR_CACHE_SIZE, 256M by
+    default. Set RIO_COLOR_CACHE_SIZE=0 to disable the cache.
+    """
+
+
+@color_cache.command("list")
+def cache_list():
+    """List the cached tables, most recently used first."""
+    from rio_color.cache import TableCache
+    from rio_color.memory import format_size
+
+    cache = TableCache()
+    entries = cache.entries()
+    for entry in entries:
+        click.echo(
+            "{}  {:>10}  {}  {}".format(
+                entry["key"],
+                format_size(entry["size"]),
+                " ".join(entry.get("params", [])),
+                entry.get("ops_string", ""),
+            )
+        )
+    click.echo(
+        "{} tables, {} of {} in {}".format(
+            len(entries),
+            format_size(sum(e["size"] for e in entries)),
+            format_size(cache.max_bytes),
+            cache.path,
+        ),
+        err=True,
+    )
+
+
+@color_cache.command("clear")
+@click.option(
+    "--max-size",
+    help="Only remove the least recently used tables over this size, e.g. 64M.",
+)
+def cache_clear(max_size):
+    """Remove cached tables."""
+    from rio_color.cache import TableCache
+    from rio_color.memory import parse_size
+
+    try:
+        max_bytes = parse_size(max_size) if max_size else 0
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--max-size")
+    removed = TableCache().evict(max_bytes)
+    click.echo("Removed {} tables".format(len(removed)), err=True)
+
+
+def estimate_atmos(ctx, src_path, jobs, atmo, contrast, bias):
+    """rio atmos parameters estimated from the source, except those
+    given on the command line."""
+    from click.core import ParameterSource
+    from rio_color.stats import atmos_parameters, collect_stats
+
+    try:
+        params = atmos_parameters(collect_stats(src_path, jobs=jobs))
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    given = {"atmo": atmo, "contrast": contrast, "bias": bias}
+    for name, value in given.items():
+        if ctx.get_parameter_source(name) == ParameterSource.COMMANDLINE:
+            params[name] = value
+    click.echo(
+        "Estimated --atmo {atmo} --contrast {contrast} --bias {bias}, dark "
+        "values {dark}".format(
+            atmo=params["atmo"],
+            contrast=params["contrast"],
+            bias=params["bias"],
+            dark=" ".join("{:.4f}".format(v) for v in params["dark"]),
+        ),
+        err=True,
+    )
+    return params["atmo"], params["contrast"], params["bias"]
 
 
 @click.command("atmos")
@@ -159,9 +998,22 @@ Example:
     help="Prints the equivalent rio color command to stdout."
     "Does NOT run either command, SRC_PATH will not be created",
 )
+@click.option(
+    "--auto",
+    is_flag=True,
+    default=False,
+    help="Estimate --atmo, --contrast and --bias from a sampled statistics "
+    "pass over the source and print them. Values given explicitly are kept.",
+)
 @click.argument("src_path", required=True)
 @click.argument("dst_path", type=click.Path(exists=False))
 @jobs_opt
+@cog_opt
+@overview_resampling_opt
+@checkpoint_opt
+@resume_opt
+@checkpoint_interval_opt
+@mem_limit_opt
 @creation_options
 @click.pass_context
 def atmos(
@@ -170,13 +1022,27 @@ def atmos(
     contrast,
     bias,
     jobs,
+    cog,
+    overview_resampling,
+    checkpoint,
+    resume,
+    checkpoint_interval,
+    mem_limit,
     out_dtype,
     src_path,
     dst_path,
     creation_options,
     as_color,
+    auto,
 ):
     """Atmospheric correction"""
+    from rio_color.operations import simple_atmo_opstring
+
+    if auto:
+        atmo, contrast, bias = estimate_atmos(
+            ctx, src_path, check_jobs(jobs), atmo, contrast, bias
+        )
+
     if as_color:
         click.echo(
             "rio color {} {} {}".format(
@@ -185,10 +1051,20 @@ def atmos(
         )
         exit(0)
 
+    if cog and (checkpoint or resume):
+        raise click.UsageError("--cog can't be combined with --checkpoint or --resume")
+
+    import rasterio
+    from rasterio.transform import guard_transform
+    from rio_color.pool import block_grid
+    from rio_color.workers import atmos_worker
+
     with rasterio.open(src_path) as src:
         opts = src.profile.copy()
-        windows = [(window, ij) for ij, window in src.block_windows()]
+        windows = block_grid(src)
+        block_shape = src.block_shapes[0]
 
+    in_dtype = opts["dtype"]
     opts.update(**creation_options)
     opts["transform"] = guard_transform(opts["transform"])
 
@@ -199,21 +1075,30 @@ def atmos(
 
     jobs = check_jobs(jobs)
 
-    if jobs > 1:
-        with riomucho.RioMucho(
-            [src_path],
-            dst_path,
+    if mem_limit:
+        from rio_color.memory import atmos_pixel_bytes
+
+        pixel_bytes = atmos_pixel_bytes(
+            opts["count"], in_dtype, out_dtype, atmo, contrast, bias
+        )
+        windows = fit_to_memory(mem_limit, jobs, opts, block_shape, pixel_bytes)
+
+    output = cog_or_direct_output(
+        cog, dst_path, opts, creation_options, overview_resampling
+    )
+    with output as (out_path, out_opts):
+        process_windows(
             atmos_worker,
-            windows=windows,
-            options=opts,
-            global_args=args,
-            mode="manual_read",
-        ) as mucho:
-            mucho.run(jobs)
-    else:
-        with rasterio.open(dst_path, "w", **opts) as dest:
-            with rasterio.open(src_path) as src:
-                rasters = [src]
-                for window, ij in windows:
-                    arr = atmos_worker(rasters, window, ij, args)
-                    dest.write(arr, window=window)
+            src_path,
+            out_path,
+            windows,
+            out_opts,
+            args,
+            jobs,
+            checkpoint=checkpoint,
+            resume=resume,
+            checkpoint_interval=checkpoint_interval,
+        )
+
+    if mem_limit:
+        echo_peak_memory(jobs)
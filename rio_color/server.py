@@ -0,0 +1,323 @@
+"""A long-running local color correction server and its client.
+
+The server keeps a warm worker pool and the per-process caches of
+parsed operations and open datasets alive between jobs, so that many
+small jobs don't each pay for interpreter startup, imports and pool
+creation. It speaks plain HTTP over a local TCP port or a Unix socket.
+
+Endpoints:
+
+``POST /color``
+    JSON body with ``src_path``, ``dst_path``, ``operations`` and the
+    optional ``out_dtype`` and ``creation_options``. Paths are read and
+    written by the server process. Responds with a JSON summary.
+
+``POST /array?operations=...&out_dtype=...``
+    Body is an integer array in ``.npy`` format, the response is the
+    corrected array in ``.npy`` format.
+
+``GET /status``
+    Server version and pool size.
+"""
+
+import http.client
+import io
+import json
+import os
+import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlsplit, urlencode
+
+import numpy as np
+
+from rio_color import __version__
+
+default_address = "127.0.0.1:8765"
+
+
+class ColorServerError(Exception):
+    """An error reported by the color server."""
+
+
+def parse_address(address):
+    """Parse a server address.
+
+    ``unix:/path/to.sock`` addresses a Unix socket, ``host:port`` or
+    ``http://host:port`` a TCP socket.
+
+    Returns
+    -------
+    tuple, ("unix", path) or ("tcp", (host, port))
+    """
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:") :]
+    if "://" in address:
+        address = urlsplit(address).netloc
+    host, sep, port = address.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError("Invalid server address: {}".format(address))
+    return "tcp", (host or "127.0.0.1", int(port))
+
+
+def _warm_worker():
+    """Pool initializer, imports the worker modules ahead of the first job."""
+    import rio_color.batch  # noqa: F401
+    import rio_color.pool  # noqa: F401
+
+
+def color_array(arr, operations, out_dtype=None):
+    """Apply an operations string to an integer array in memory."""
+    from rio_color.pipeline import get_pipeline
+
+    return get_pipeline(operations)(arr, out_dtype)
+
+
+class ColorRequestHandler(BaseHTTPRequestHandler):
+    """Handles requests to the color server."""
+
+    server_version = "rio-color/" + __version__
+
+    def log_message(self, format, *args):
+        """Only log when the server is verbose."""
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data).encode("utf-8"), "application/json")
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        """Report the server status."""
+        if urlsplit(self.path).path != "/status":
+            return self._send_json(404, {"error": "Not found"})
+        self._send_json(200, {"version": __version__, "jobs": self.server.jobs})
+
+    def do_POST(self):
+        """Run a file or array job."""
+        url = urlsplit(self.path)
+        try:
+            if url.path == "/color":
+                self._send_json(200, self._color_file(json.loads(self._read_body())))
+            elif url.path == "/array":
+                self._color_array(parse_qs(url.query))
+            else:
+                self._send_json(404, {"error": "Not found"})
+        except (ValueError, KeyError, OSError) as e:
+            self._send_json(400, {"error": "{}: {}".format(type(e).__name__, e)})
+        except Exception as e:
+            self._send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+
+    def _color_file(self, job):
+        from rio_color.batch import run_batch
+
+        # A single output path, braces escaped so it isn't a template
+        dst_path = job["dst_path"].replace("{", "{{").replace("}", "}}")
+        summary = run_batch(
+            [job["src_path"]],
+            dst_path,
+            job["operations"],
+            out_dtype=job.get("out_dtype"),
+            creation_options=job.get("creation_options"),
+            jobs=self.server.jobs,
+            pool=self.server.pool,
+        )
+        return summary[0]
+
+    def _color_array(self, query):
+        operations = query["operations"][0]
+        out_dtype = query.get("out_dtype", [None])[0]
+        arr = np.load(io.BytesIO(self._read_body()), allow_pickle=False)
+        out = io.BytesIO()
+        np.save(out, color_array(arr, operations, out_dtype), allow_pickle=False)
+        self._send(200, out.getvalue(), "application/octet-stream")
+
+
+class _PoolMixin:
+    """Owns the warm worker pool shared by all requests."""
+
+    verbose = False
+
+    def start_pool(self, jobs):
+        # File jobs always go through the pool, even with a single
+        # job, since dataset handles must not be shared between the
+        # server's request threads.
+        from multiprocessing import Pool
+
+        self.jobs = jobs
+        self.pool = Pool(jobs, _warm_worker)
+
+    def server_close(self):
+        super().server_close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class ColorHTTPServer(_PoolMixin, ThreadingHTTPServer):
+    """Color server on a local TCP port."""
+
+    daemon_threads = True
+
+
+class ColorUnixServer(_PoolMixin, ThreadingMixIn, UnixStreamServer):
+    """Color server on a Unix socket."""
+
+    daemon_threads = True
+
+    def get_request(self):
+        """Give unix clients an address the request handler can log."""
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+    def server_close(self):
+        """Close the server and remove its socket file."""
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def make_server(address=default_address, jobs=1, verbose=False):
+    """Create a color server with a warm pool of jobs processes.
+
+    Call ``serve_forever()`` on the result to handle requests and
+    ``server_close()`` to release the socket and the pool.
+    """
+    kind, addr = parse_address(address)
+    if kind == "unix":
+        if os.path.exists(addr):
+            os.unlink(addr)
+        server = ColorUnixServer(addr, ColorRequestHandler)
+    else:
+        server = ColorHTTPServer(addr, ColorRequestHandler)
+    server.verbose = verbose
+    server.start_pool(jobs)
+    return server
+
+
+# Client
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection over a Unix socket."""
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        """Connect to the Unix socket."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _request(address, method, path, body=None, content_type=None, timeout=None):
+    kind, addr = parse_address(address)
+    if kind == "unix":
+        conn = _UnixHTTPConnection(addr, timeout=timeout)
+    else:
+        conn = http.client.HTTPConnection(*addr, timeout=timeout)
+    try:
+        headers = {"Content-Type": content_type} if content_type else {}
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+    finally:
+        conn.close()
+
+    if response.status != 200:
+        try:
+            message = json.loads(data)["error"]
+        except (ValueError, KeyError):
+            message = data.decode("utf-8", "replace")
+        raise ColorServerError(message)
+    return data
+
+
+def status(address=default_address, timeout=None):
+    """Return the status of a running color server."""
+    return json.loads(_request(address, "GET", "/status", timeout=timeout))
+
+
+def _absolute_luts(operations):
+    """An operations string with the paths of its lut files made absolute.
+
+    Strings without lut operations are returned as they are.
+    """
+    if "lut" not in operations.lower():
+        return operations
+    from rio_color.operations import _parse_operations, format_operations
+
+    parsed = _parse_operations(operations)
+    if not any(op.name == "lut" for op in parsed):
+        return operations
+    return format_operations(
+        [
+            (
+                op._replace(
+                    kwargs=dict(op.kwargs, path=os.path.abspath(op.kwargs["path"]))
+                )
+                if op.name == "lut"
+                else op
+            )
+            for op in parsed
+        ]
+    )
+
+
+def submit(
+    address,
+    src_path,
+    dst_path,
+    operations,
+    out_dtype=None,
+    creation_options=None,
+    timeout=None,
+):
+    """Submit a file job to a color server and wait for it to finish.
+
+    Paths, with those of lut files, are made absolute since the server
+    may run in another working directory. Returns the server's summary
+    of the job.
+    """
+    job = {
+        "src_path": os.path.abspath(src_path),
+        "dst_path": os.path.abspath(dst_path),
+        "operations": _absolute_luts(operations),
+        "out_dtype": out_dtype,
+        "creation_options": creation_options or {},
+    }
+    body = json.dumps(job).encode("utf-8")
+    data = _request(address, "POST", "/color", body, "application/json", timeout)
+    return json.loads(data)
+
+
+def submit_array(address, arr, operations, out_dtype=None, timeout=None):
+    """Color correct an in-memory integer array on a color server."""
+    query = {"operations": _absolute_luts(operations)}
+    if out_dtype:
+        query["out_dtype"] = out_dtype
+    body = io.BytesIO()
+    np.save(body, arr, allow_pickle=False)
+    data = _request(
+        address,
+        "POST",
+        "/array?" + urlencode(query),
+        body.getvalue(),
+        "application/octet-stream",
+        timeout,
+    )
+    return np.load(io.BytesIO(data), allow_pickle=False)
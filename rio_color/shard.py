@@ -0,0 +1,255 @@
+"""Sharded processing of one raster across several machines.
+
+A job is split in three steps:
+
+1. ``plan_shards`` splits the block windows of the source into
+   contiguous strips of block rows and writes a JSON manifest per shard.
+2. ``run_shard`` processes the windows of one manifest into a part
+   GeoTIFF covering the shard's strip. Shards are independent and can
+   run on different machines that share the source and manifest paths.
+3. ``merge_shards`` stitches the parts into a VRT, or copies them into
+   a single output, without recomputing anything.
+"""
+
+import json
+import os
+from xml.sax.saxutils import escape
+
+from affine import Affine
+import rasterio
+from rasterio.dtypes import dtype_rev, typename_fwd
+from rasterio.transform import guard_transform
+from rasterio.windows import Window
+
+from .pool import imap_windows, result_bytes
+from .workers import color_worker
+
+
+def _block_rows(windows):
+    """Group (window, ij) pairs by block row, in order."""
+    rows = {}
+    for window, ij in windows:
+        rows.setdefault(ij[0], []).append((window, ij))
+    return [rows[i] for i in sorted(rows)]
+
+
+def plan_shards(
+    src_path, prefix, ops_string, shards, out_dtype=None, creation_options=None
+):
+    """Split a job into shards and write one manifest per shard.
+
+    Block rows are divided into ``shards`` contiguous strips with as
+    equal a number of windows as possible. Manifests are written to
+    ``{prefix}-{k}.json`` and name ``{prefix}-{k}.tif`` as their part.
+
+    Returns
+    -------
+    list of str, the manifest paths
+    """
+    with rasterio.open(src_path) as src:
+        windows = [(window, ij) for ij, window in src.block_windows()]
+        height = src.height
+
+    rows = _block_rows(windows)
+    if shards < 1 or shards > len(rows):
+        raise ValueError(
+            "Number of shards must be between 1 and {}, the number of "
+            "block rows".format(len(rows))
+        )
+
+    paths = []
+    start = 0
+    for k in range(shards):
+        # Spread the remaining rows evenly over the remaining shards
+        stop = start + (len(rows) - start) // (shards - k)
+        strip = [pair for row in rows[start:stop] for pair in row]
+        row_off = min(int(w.row_off) for w, _ in strip)
+        row_end = max(int(w.row_off + w.height) for w, _ in strip)
+        if stop == len(rows):
+            row_end = height
+
+        manifest = {
+            "src_path": os.path.abspath(src_path),
+            "ops_string": ops_string,
+            "out_dtype": out_dtype,
+            "creation_options": creation_options or {},
+            "shard": k,
+            "shards": shards,
+            "part_path": os.path.abspath("{}-{}.tif".format(prefix, k)),
+            "row_off": row_off,
+            "height": row_end - row_off,
+            "windows": [
+                [int(w.col_off), int(w.row_off), int(w.width), int(w.height), i, j]
+                for w, (i, j) in strip
+            ],
+        }
+        path = "{}-{}.json".format(prefix, k)
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+        paths.append(path)
+        start = stop
+
+    return paths
+
+
+def load_manifest(path):
+    """Read a shard manifest."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def _part_profile(src, manifest):
+    # The transform of the strip, shifted down by row_off rows
+    t = src.transform
+    row_off = manifest["row_off"]
+    opts = src.profile.copy()
+    opts.update(**manifest["creation_options"])
+    opts.update(
+        height=manifest["height"],
+        transform=Affine(t.a, t.b, t.c + t.b * row_off, t.d, t.e, t.f + t.e * row_off),
+        dtype=manifest["out_dtype"] or opts["dtype"],
+    )
+    return opts
+
+
+def run_shard(manifest_path, jobs=1):
+    """Process the windows of one shard into its part GeoTIFF.
+
+    Returns
+    -------
+    str, the path of the part
+    """
+    manifest = load_manifest(manifest_path)
+    with rasterio.open(manifest["src_path"]) as src:
+        opts = _part_profile(src, manifest)
+        colorinterp = src.colorinterp
+
+    args = {"ops_string": manifest["ops_string"], "out_dtype": opts["dtype"]}
+    windows = [(Window(*w[:4]), tuple(w[4:])) for w in manifest["windows"]]
+    tasks = (
+        (None, color_worker, manifest["src_path"], window, ij, args)
+        for window, ij in windows
+    )
+    size = result_bytes(windows, opts["count"], opts["dtype"])
+
+    row_off = manifest["row_off"]
+    with rasterio.open(manifest["part_path"], "w", **opts) as dest:
+        for _, window, arr, _ in imap_windows(tasks, jobs=jobs, result_size=size):
+            dest.write(
+                arr,
+                window=Window(
+                    window.col_off,
+                    window.row_off - row_off,
+                    window.width,
+                    window.height,
+                ),
+            )
+        dest.colorinterp = colorinterp
+
+    return manifest["part_path"]
+
+
+def _check_shards(manifests):
+    """Check that manifests are the complete set of one plan, return them sorted."""
+    manifests = sorted(manifests, key=lambda m: m["shard"])
+    first = manifests[0]
+    for m in manifests:
+        for key in ("src_path", "ops_string", "out_dtype", "shards"):
+            if m[key] != first[key]:
+                raise ValueError("Manifests belong to different plans")
+    if [m["shard"] for m in manifests] != list(range(first["shards"])):
+        raise ValueError(
+            "Expected manifests for shards 0 to {}".format(first["shards"] - 1)
+        )
+    for m in manifests:
+        if not os.path.exists(m["part_path"]):
+            raise ValueError("Part {} has not been processed".format(m["part_path"]))
+    return manifests
+
+
+def write_vrt(manifests, dst_path):
+    """Write a VRT stitching the parts of a complete set of shards."""
+    manifests = _check_shards(manifests)
+    with rasterio.open(manifests[0]["part_path"]) as part:
+        profile = part.profile
+        colorinterp = part.colorinterp
+        nodata = part.nodata
+    with rasterio.open(manifests[0]["src_path"]) as src:
+        width, height = src.width, src.height
+        transform = src.transform
+        crs = src.crs
+
+    vrt_dir = os.path.dirname(os.path.abspath(dst_path))
+    datatype = typename_fwd[dtype_rev[profile["dtype"]]]
+
+    lines = ['<VRTDataset rasterXSize="{}" rasterYSize="{}">'.format(width, height)]
+    if crs:
+        lines.append("  <SRS>{}</SRS>".format(escape(crs.to_wkt())))
+    lines.append(
+        "  <GeoTransform>{}</GeoTransform>".format(
+            ", ".join(repr(v) for v in transform.to_gdal())
+        )
+    )
+    for bidx in range(1, profile["count"] + 1):
+        lines.append('  <VRTRasterBand dataType="{}" band="{}">'.format(datatype, bidx))
+        lines.append(
+            "    <ColorInterp>{}</ColorInterp>".format(
+                colorinterp[bidx - 1].name.capitalize()
+            )
+        )
+        if nodata is not None:
+            lines.append("    <NoDataValue>{!r}</NoDataValue>".format(nodata))
+        for m in manifests:
+            rect = 'xOff="0" yOff="{}" xSize="{}" ySize="{}"'
+            lines.extend(
+                [
+                    "    <SimpleSource>",
+                    '      <SourceFilename relativeToVRT="1">{}</SourceFilename>'.format(
+                        escape(os.path.relpath(m["part_path"], vrt_dir))
+                    ),
+                    "      <SourceBand>{}</SourceBand>".format(bidx),
+                    "      <SrcRect {}/>".format(rect.format(0, width, m["height"])),
+                    "      <DstRect {}/>".format(
+                        rect.format(m["row_off"], width, m["height"])
+                    ),
+                    "    </SimpleSource>",
+                ]
+            )
+        lines.append("  </VRTRasterBand>")
+    lines.append("</VRTDataset>")
+
+    with open(dst_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return dst_path
+
+
+def merge_shards(manifests, dst_path, creation_options=None):
+    """Copy the parts of a complete set of shards into a single output.
+
+    The output has the profile of the source with the output dtype and
+    creation options of the plan, updated with creation_options.
+    """
+    manifests = _check_shards(manifests)
+    with rasterio.open(manifests[0]["src_path"]) as src:
+        opts = src.profile.copy()
+        colorinterp = src.colorinterp
+    opts.update(**manifests[0]["creation_options"])
+    opts.update(**(creation_options or {}))
+    opts["transform"] = guard_transform(opts["transform"])
+    opts["dtype"] = manifests[0]["out_dtype"] or opts["dtype"]
+
+    with rasterio.open(dst_path, "w", **opts) as dest:
+        for m in manifests:
+            with rasterio.open(m["part_path"]) as part:
+                for _, window in part.block_windows():
+                    dest.write(
+                        part.read(window=window),
+                        window=Window(
+                            window.col_off,
+                            window.row_off + m["row_off"],
+                            window.width,
+                            window.height,
+                        ),
+                    )
+        dest.colorinterp = colorinterp
+    return dst_path
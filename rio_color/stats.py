@@ -0,0 +1,400 @@
+"""Streaming per-band histograms and percentiles of images.
+
+Histograms of integer bands have one bin per code value up to
+``max_bins`` bins, uint8 and uint16 percentiles are then exact, and
+are updated window by window, so statistics of a raster of any size
+take the memory of its histograms. ``collect_stats`` computes them in
+one pass over a raster, possibly in parallel, from its overviews or a
+sample of its blocks when it is large, and keeps them in the table
+cache (see ``rio_color.cache``) so that the same raster isn't read
+again.
+
+Percentile arguments of operations, such as ``stretch rgb 2% 98%``,
+are replaced by the values of the image at these percentiles, after
+the operations before them, with ``resolve_percentiles`` before the
+operations are applied, and
+``atmos_parameters`` estimates the parameters of ``simple_atmo`` for
+an image.
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags
+
+import rio_color
+from .cache import get_table_cache
+from .operations import (
+    Percentile,
+    _op_factory,
+    _parse_operations,
+    band_kwargs,
+    format_operations,
+    has_percentiles,
+    sigmoidal,
+)
+from .palette import has_palette
+from .pool import WindowGrid, block_grid, imap_windows
+
+# Bins of the histogram of a band, one per value of 16-bit bands
+max_bins = 2**16
+
+# Pixels read by collect_stats, about 4 million by default
+default_max_pixels = 2**22
+
+
+class Histograms:
+    """Histograms of the bands of integer images, updated as they are read.
+
+    Parameters
+    ----------
+    count: int, number of bands
+    dtype: integer dtype of the images
+    """
+
+    def __init__(self, count, dtype):
+        """Start with empty histograms."""
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind not in "ui":
+            raise ValueError("Histograms need integer data, not {}".format(dtype))
+        self.max = int(np.iinfo(self.dtype).max)
+        self.bins = min(self.max + 1, max_bins)
+        self.counts = np.zeros((count, self.bins), dtype="int64")
+
+    def update(self, arr, mask=None):
+        """Add the pixels of an array to the histograms.
+
+        Parameters
+        ----------
+        arr: ndarray of shape (bands, rows, cols)
+        mask: boolean ndarray broadcasting against arr, True for pixels
+            to leave out, default: none. Masked arrays use their mask.
+
+        Returns
+        -------
+        self
+        """
+        if np.ma.isMaskedArray(arr):
+            arr, mask = arr.data, np.ma.getmask(arr)
+        if mask is not None and not np.any(mask):
+            mask = None
+        if mask is not None:
+            mask = np.broadcast_to(mask, arr.shape)
+        for b in range(self.counts.shape[0]):
+            values = arr[b] if mask is None else arr[b][~mask[b]]
+            self.counts[b] += np.bincount(
+                self._bin(values).ravel(), minlength=self.bins
+            )
+        return self
+
+    def _bin(self, values):
+        if self.bins == self.max + 1 and self.dtype.kind == "u":
+            return values
+        # Negative values fall in the first bin, the others evenly
+        # over the bins
+        values = np.clip(values, 0, None).astype("float64")
+        return np.minimum(values * (self.bins / (self.max + 1)), self.bins - 1).astype(
+            "intp"
+        )
+
+    def merge(self, other):
+        """Add the counts of other histograms of the same layout."""
+        self.counts += other.counts
+        return self
+
+    def bin_values(self):
+        """Value of the lower edge of every bin, between 0 and 1."""
+        return np.arange(self.bins) * ((self.max + 1) / self.bins) / self.max
+
+    def percentiles(self, q, values=None):
+        """Values of every band at percentiles q.
+
+        The value at percentile q is the smallest value that at least
+        q% of the pixels are less than or equal to, as with
+        ``numpy.percentile(..., method="inverted_cdf")``. It is exact
+        with one bin per value and the lower edge of its bin otherwise.
+
+        Parameters
+        ----------
+        q: float or sequence of floats between 0 and 100
+        values: ndarray of shape (bands, bins), the values the bins of
+            each band stand for, such as ``bin_values()`` after some
+            operations, default: ``bin_values()``
+
+        Returns
+        -------
+        float64 ndarray of shape (bands,) + shape of q, between 0 and 1,
+        values divided by the maximum of the dtype. NaN for bands with
+        no pixels.
+        """
+        q = np.asarray(q, dtype="float64")
+        result = np.full((len(self.counts),) + q.shape, np.nan)
+        for b, counts in enumerate(self.counts):
+            band_values = self.bin_values() if values is None else values[b]
+            order = np.argsort(band_values, kind="stable")
+            cumulative = np.cumsum(counts[order])
+            if cumulative[-1] == 0:
+                continue
+            # At least one pixel, so that 0% is the minimum
+            ranks = np.maximum(q / 100 * cumulative[-1], 1)
+            index = np.searchsorted(cumulative, ranks, side="left")
+            result[b] = band_values[order][index]
+        return result
+
+
+def window_histograms(src, window, decimation=1):
+    """Histograms of the valid pixels of a window of a dataset.
+
+    With a decimation, the window is read at that fraction of its
+    size, from overviews if the dataset has them.
+    """
+    shape = None
+    if decimation > 1:
+        shape = (
+            src.count,
+            max(1, math.ceil(window.height / decimation)),
+            max(1, math.ceil(window.width / decimation)),
+        )
+    masked = any(MaskFlags.all_valid not in flags for flags in src.mask_flag_enums)
+    arr = src.read(window=window, out_shape=shape, masked=masked)
+    return Histograms(src.count, src.dtypes[0]).update(arr)
+
+
+def _sample_windows(src, max_pixels):
+    """The windows read by collect_stats and their decimation."""
+    pixels = src.width * src.height
+    if pixels <= max_pixels:
+        return block_grid(src), 1
+
+    decimation = math.ceil(math.sqrt(pixels / max_pixels))
+    if src.overviews(1):
+        # Windows of decimation blocks a side read as about one block
+        rows, cols = src.block_shapes[0]
+        grid = WindowGrid.from_blocks(
+            src.width, src.height, (rows * decimation, cols * decimation)
+        )
+        return grid, decimation
+
+    # A random but reproducible sample of the blocks, spread over the
+    # whole raster
+    grid = block_grid(src)
+    size = max(1, min(len(grid), max_pixels // grid.max_pixels()))
+    picked = np.random.default_rng(0).choice(len(grid), size, replace=False)
+    return [grid[int(i)] for i in np.sort(picked)], 1
+
+
+def _stats_key(src_path, max_pixels):
+    stat = os.stat(src_path)
+    description = json.dumps(
+        [
+            "stats",
+            os.path.abspath(src_path),
+            stat.st_mtime_ns,
+            stat.st_size,
+            max_pixels,
+            max_bins,
+            rio_color.__version__,
+            np.__version__,
+        ]
+    )
+    return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+
+def collect_stats(src_path, jobs=1, max_pixels=default_max_pixels, cache=True):
+    """Histograms of the bands of a raster, in one pass.
+
+    Rasters of up to max_pixels pixels are read whole. Larger ones are
+    read from their overviews, at a decimation that reads about
+    max_pixels pixels, or without overviews from a sample of their
+    blocks of about max_pixels pixels. Masked and nodata pixels are
+    left out. Windows are read by jobs processes.
+
+    With cache, histograms are kept in the table cache, keyed by the
+    path, size and modification time of the raster.
+
+    Returns
+    -------
+    Histograms
+    """
+    from .workers import stats_worker
+
+    with rasterio.open(src_path) as src:
+        hist = Histograms(src.count, src.dtypes[0])
+        windows, decimation = _sample_windows(src, max_pixels)
+
+    table_cache = get_table_cache() if cache else None
+    if table_cache is not None:
+        key = _stats_key(src_path, max_pixels)
+        counts = table_cache.get(key)
+        if counts is not None and counts.shape == hist.counts.shape:
+            hist.counts[:] = counts
+            return hist
+
+    args = {"decimation": decimation}
+    tasks = ((None, stats_worker, src_path, window, ij, args) for window, ij in windows)
+    results = imap_windows(tasks, jobs=jobs, result_size=hist.counts.nbytes)
+    try:
+        for _, _, counts, _ in results:
+            hist.counts += counts
+    finally:
+        results.close()
+
+    if table_cache is not None:
+        try:
+            table_cache.put(
+                key,
+                hist.counts,
+                kind="stats",
+                params=[os.path.abspath(src_path), str(max_pixels)],
+                shape=list(hist.counts.shape),
+                dtype=str(hist.counts.dtype),
+                created=time.time(),
+            )
+        except OSError:
+            pass
+    return hist
+
+
+def resolve_percentiles(ops_string, src_path, jobs=1, max_pixels=default_max_pixels):
+    """Replace the percentile arguments of operations with image values.
+
+    ``stretch rgb 2% 98%`` becomes a stretch of each band between its
+    own 2nd and 98th percentiles in the raster at src_path, see
+    ``collect_stats``. Percentiles are those of the bands as they reach
+    the operation, so in ``gamma rgb 2, stretch rgb 2% 98%`` they are
+    percentiles of the gamma output, found by passing the histogram
+    bins through the operations before. Operations mixing bands, such
+    as ``saturation``, can't be passed through, percentiles of their
+    bands after them raise ValueError. Operations strings without
+    percentiles are returned as they are, without reading the raster.
+
+    Returns
+    -------
+    str, normalized operations string without percentiles
+    """
+    operations = _parse_operations(ops_string)
+    if not any(has_percentiles(op) for op in operations):
+        return ops_string
+
+    with rasterio.open(src_path) as src:
+        count = src.count
+        if has_palette(src):
+            raise ValueError("Percentiles of paletted rasters aren't supported")
+    mixing = []
+    for op in operations:
+        if has_percentiles(op):
+            if max(op.bands) > count:
+                raise ValueError(
+                    "{} uses band {} but the raster has {} bands".format(
+                        op.name, max(op.bands), count
+                    )
+                )
+            for other in mixing:
+                if set(op.bands) & set(other.bands):
+                    raise ValueError(
+                        "{} percentiles can't follow {}, which mixes bands".format(
+                            op.name, other.name
+                        )
+                    )
+        if op.rgb_op:
+            mixing.append(op)
+
+    hist = collect_stats(src_path, jobs=jobs, max_pixels=max_pixels)
+    # The value of every bin of every band as it reaches each operation
+    values = np.tile(hist.bin_values(), (count, 1))
+    resolved = []
+    for op in operations:
+        if has_percentiles(op):
+            op = _resolve(op, hist, values)
+        resolved.append(op)
+        if not op.rgb_op:
+            values = _op_factory(op.func, op.kwargs, op.name, op.bands)(values)
+    return format_operations(resolved)
+
+
+def _resolve(op, hist, values):
+    """op with the values of its Percentile arguments in histograms."""
+    resolved = [
+        {
+            k: (hist.percentiles(v, values)[b - 1] if isinstance(v, Percentile) else v)
+            for k, v in kwargs.items()
+        }
+        for b, kwargs in band_kwargs(op)
+    ]
+    for (b, _), v in zip(band_kwargs(op), resolved):
+        if np.isnan(list(v.values())).any():
+            raise ValueError("Band {} has no valid pixels".format(b))
+        if op.name == "stretch" and v["high"] <= v["low"]:
+            raise ValueError(
+                "stretch HIGH must be greater than LOW, band {} has the "
+                "same value at both percentiles".format(b)
+            )
+    kwargs = {}
+    for k in op.kwargs:
+        column = tuple(float(v[k]) for v in resolved)
+        kwargs[k] = column[0] if len(set(column)) == 1 else column
+    return op._replace(kwargs=kwargs)
+
+
+def atmos_parameters(hist, dark=0.5, low=2, high=98, spread=0.8):
+    """Estimate the haze, contrast and bias of simple_atmo for an image.
+
+    The haze is found by dark object subtraction. The darkest values of
+    the red, green and blue bands, at the dark percentile, would be
+    equal without haze. The haze is the one whose blue gamma brings the
+    dark value of blue down to that of red. Dark values are at least
+    1/256 so that a black red band doesn't ask for an infinite gamma.
+
+    The low and high percentiles of the bands after the gammas are
+    averaged over the bands. The bias is halfway between them and the
+    contrast is the lowest, in steps of 0.5 up to 50, for which
+    sigmoidal moves them spread apart, or 50.
+
+    Parameters
+    ----------
+    hist: Histograms of an image with red, green and blue first
+    dark: float, percentile of the dark objects
+    low, high: float, percentiles of the range to stretch
+    spread: float, distance between low and high after the sigmoidal
+
+    Returns
+    -------
+    dict of ``atmo``, ``contrast`` and ``bias``, rounded, and ``dark``,
+    the dark values of the red, green and blue bands between 0 and 1
+    """
+    if hist.counts.shape[0] < 3:
+        raise ValueError("Atmospheric correction needs red, green and blue bands")
+    values = hist.percentiles([dark, low, high])[:3]
+    if np.isnan(values).any():
+        raise ValueError("Bands have no valid pixels")
+
+    red, _, blue = np.clip(values[:, 0], 1 / 256, 1 - 1 / 256)
+    atmo = 0.0
+    if blue > red:
+        atmo = round(min(1 - np.log(blue) / np.log(red), 0.9), 3)
+
+    # Percentiles are unchanged by gammas, which keep the order
+    corrected = values[:, 1:] ** (1 / np.array([[1], [1 - atmo / 3], [1 - atmo]]))
+    lo, hi = corrected.mean(axis=0)
+    bias = round(float(np.clip((lo + hi) / 2, 0.01, 0.99)), 3)
+
+    contrast = 0.0
+    if hi - lo < spread:
+        contrasts = np.arange(1, 101) / 2
+        spreads = np.array(
+            [np.diff(sigmoidal(np.array([lo, hi]), c, bias))[0] for c in contrasts]
+        )
+        reached = np.flatnonzero(spreads >= spread)
+        contrast = float(contrasts[reached[0] if len(reached) else -1])
+
+    return {
+        "atmo": float(atmo),
+        "contrast": contrast,
+        "bias": bias,
+        "dark": [float(v) for v in values[:, 0]],
+    }
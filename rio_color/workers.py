@@ -1,31 +1,75 @@
-"""Color functions for use with rio-mucho."""
+"""Window workers run by rio_color.pool."""
 
-from .operations import parse_operations, simple_atmo
-from .utils import to_math_type, scale_dtype
+import numpy as np
+
+from .operations import simple_atmo_opstring
+from .pipeline import apply_few_colors, apply_many, get_pipeline
+from .stats import window_histograms
 
 # Rio workers
 
 
 def atmos_worker(srcs, window, ij, args):
-    """A simple atmospheric correction user function."""
-    src = srcs[0]
-    rgb = src.read(window=window)
-    rgb = to_math_type(rgb)
+    """A simple atmospheric correction user function.
 
-    atmos = simple_atmo(rgb, args["atmo"], args["contrast"], args["bias"])
+    simple_atmo is a chain of per-band operations, see
+    simple_atmo_opstring, run through a compiled pipeline: a table
+    lookup from the source dtype to out_dtype for uint8 and uint16
+    sources.
+    """
+    src = srcs[0]
+    arr = src.read(window=window)
 
-    # should be scaled 0 to 1, scale to outtype
-    return scale_dtype(atmos, args["out_dtype"])
+    pipeline = get_pipeline(
+        simple_atmo_opstring(args["atmo"], args["contrast"], args["bias"])
+    )
+    return pipeline(arr, args["out_dtype"])
 
 
 def color_worker(srcs, window, ij, args):
     """A user function."""
     src = srcs[0]
     arr = src.read(window=window)
-    arr = to_math_type(arr)
 
-    for func in parse_operations(args["ops_string"]):
-        arr = func(arr)
+    # The pipeline is compiled once per process and scales
+    # the result to outtype
+    pipeline = get_pipeline(args["ops_string"], lut_size=args.get("lut_size"))
+    # Uniform windows, like water or fill, are computed once per color
+    out = apply_few_colors(pipeline, arr, args["out_dtype"])
+    if out is None:
+        out = pipeline(arr, args["out_dtype"])
+    return out
+
+
+def multi_color_worker(srcs, window, ij, args):
+    """color_worker for several operations strings at once.
+
+    The window is read once and args["ops_strings"] are applied to it.
+    The results are stacked along the band axis, in order.
+    """
+    src = srcs[0]
+    arr = src.read(window=window)
+
+    out_dtype = args["out_dtype"]
+    pipelines = [
+        get_pipeline(ops_string, lut_size=args.get("lut_size"))
+        for ops_string in args["ops_strings"]
+    ]
+    outs = [apply_few_colors(pipeline, arr, out_dtype) for pipeline in pipelines]
+    rest = iter(
+        apply_many(
+            [pipeline for pipeline, out in zip(pipelines, outs) if out is None],
+            arr,
+            out_dtype,
+        )
+    )
+    return np.concatenate([next(rest) if out is None else out for out in outs])
+
+
+def stats_worker(srcs, window, ij, args):
+    """Histogram counts of the valid pixels of a window.
 
-    # scaled 0 to 1, now scale to outtype
-    return scale_dtype(arr, args["out_dtype"])
+    args["decimation"] reads the window at a fraction of its size, see
+    ``rio_color.stats.collect_stats``.
+    """
+    return window_histograms(srcs[0], window, args.get("decimation", 1)).counts
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""Accuracy and speed of 3D lookup tables against the exact operations.
+
+For each operations string and lattice size, reports the time to
+sample the table, the time to apply it and the exact pipeline to the
+image, and the max and mean error of the table in output code values.
+The table cache is bypassed so that sampling is timed.
+"""
+
+import os
+import time
+
+import click
+import numpy as np
+import rasterio
+
+from rio_color.lut import Lut3D
+from rio_color.pipeline import ColorPipeline
+
+
+def timed(func, *args):
+    """Return the result of func and its duration in ms."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+@click.command()
+@click.option("--sizes", default="17,33,65", help="Lattice sizes to test")
+@click.option(
+    "--ops",
+    "-p",
+    "ops_list",
+    multiple=True,
+    default=[
+        "gamma g 1.85, gamma b 1.95, sigmoidal rgb 35 0.13, saturation 1.15",
+        "saturation 1.2, sigmoidal rgb 10 0.15",
+    ],
+    help="Operations strings to test",
+)
+@click.option(
+    "--out-dtype", "-d", default="uint8", type=click.Choice(["uint8", "uint16"])
+)
+@click.argument("path", default="tests/rgb16.tif", type=click.Path(exists=True))
+def main(sizes, ops_list, out_dtype, path):
+    """Compare 3D lookup tables with the exact operations on an image."""
+    os.environ["RIO_COLOR_CACHE_SIZE"] = "0"
+    with rasterio.open(path) as src:
+        arr = src.read()
+
+    click.echo(
+        "{:>5} {:>10} {:>10} {:>10} {:>8} {:>10}".format(
+            "size", "build ms", "lut ms", "exact ms", "max err", "mean err"
+        )
+    )
+    for i, ops in enumerate(ops_list):
+        click.echo("ops {}: {}".format(i, ops))
+        _, exact_ms = timed(ColorPipeline(ops), arr, out_dtype)
+        for size in (int(s) for s in sizes.split(",")):
+            lut, build_ms = timed(Lut3D.from_operations, ops, size)
+            lut(arr, out_dtype)
+            _, lut_ms = timed(lut, arr, out_dtype)
+            max_err, mean_err = lut.error(ops, arr, out_dtype)
+            click.echo(
+                "{:>5} {:>10.1f} {:>10.1f} {:>10.1f} {:>8} {:>10.3f}".format(
+                    size, build_ms, lut_ms, exact_ms, max_err, mean_err
+                )
+            )
+
+
+if __name__ == "__main__":
+    np.seterr(all="ignore")
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Benchmark per-tile latency of ColorPipeline against parse_operations.
+
+The baseline is what a tile server had to do before ColorPipeline:
+parse the operations string, scale to float, run each operation
+function (each of which copies the array) and scale back.
+"""
+
+import time
+
+import click
+import numpy as np
+
+from rio_color.operations import parse_operations
+from rio_color.pipeline import ColorPipeline
+from rio_color.utils import to_math_type, scale_dtype
+
+
+def baseline(ops):
+    """Per-request parsing and operation functions."""
+
+    def run(arr, out_dtype):
+        arr = to_math_type(arr)
+        for func in parse_operations(ops):
+            arr = func(arr)
+        return scale_dtype(arr, out_dtype)
+
+    return run
+
+
+def latencies(func, tiles, out_dtype, runs):
+    """Call func on tiles round robin, return latencies in ms."""
+    times = []
+    for i in range(runs):
+        arr = tiles[i % len(tiles)]
+        start = time.perf_counter()
+        func(arr, out_dtype)
+        times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+
+@click.command()
+@click.option("--runs", "-n", default=200, help="Calls per case")
+@click.option(
+    "--ops",
+    "-p",
+    "ops_list",
+    multiple=True,
+    default=[
+        "gamma g 1.85, gamma b 1.95, sigmoidal rgb 35 0.13",
+        "gamma g 1.85, gamma b 1.95, sigmoidal rgb 35 0.13, saturation 1.15",
+    ],
+    help="Operations strings to benchmark",
+)
+def main(runs, ops_list):
+    """Print p50 and p99 latencies for 256 and 512 pixel tiles."""
+    rng = np.random.default_rng(0)
+    click.echo(
+        "{:<10} {:>5} {:<6} {:>10} {:>10} {:>10} {:>10}".format(
+            "", "size", "dtype", "old p50", "old p99", "new p50", "new p99"
+        )
+    )
+    for i, ops in enumerate(ops_list):
+        click.echo("ops {}: {}".format(i, ops))
+        for size in (256, 512):
+            for dtype in ("uint8", "uint16"):
+                tiles = [
+                    rng.integers(0, np.iinfo(dtype).max, (3, size, size)).astype(dtype)
+                    for _ in range(8)
+                ]
+                old = latencies(baseline(ops), tiles, "uint8", runs)
+                pipeline = ColorPipeline(ops)
+                pipeline(tiles[0], "uint8")  # compile outside of the timing
+                new = latencies(pipeline, tiles, "uint8", runs)
+                click.echo(
+                    "{:<10} {:>5} {:<6} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                        "ops {}".format(i),
+                        size,
+                        dtype,
+                        np.percentile(old, 50),
+                        np.percentile(old, 99),
+                        np.percentile(new, 50),
+                        np.percentile(new, 99),
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
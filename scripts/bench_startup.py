@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""Benchmark the import cost of the rio color plugin entry points.
+
+rio imports every plugin's entry point on every invocation, so the time
+spent importing rio_color.scripts.cli is paid by `rio --help` and every
+other rio subcommand. This compares a bare `rasterio.rio.main` import
+against one that also imports the plugin, each in a fresh interpreter.
+"""
+
+import statistics
+import subprocess
+import sys
+
+import click
+
+baseline = "import rasterio.rio.main"
+plugin = "import rasterio.rio.main; import rio_color.scripts.cli"
+timed = """
+import time
+t = time.perf_counter()
+{}
+print(time.perf_counter() - t)
+"""
+
+
+def measure(code, runs):
+    """Run code in fresh interpreters, return the import times in seconds."""
+    times = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, "-c", timed.format(code)])
+        times.append(float(out))
+    return times
+
+
+@click.command()
+@click.option("--runs", "-n", default=20, help="Number of interpreters to start")
+def main(runs):
+    """Print median import times and the plugin's share of them."""
+    base = statistics.median(measure(baseline, runs))
+    with_plugin = statistics.median(measure(plugin, runs))
+    click.echo("rasterio.rio.main:          {:8.1f} ms".format(base * 1000))
+    click.echo("+ rio_color.scripts.cli:    {:8.1f} ms".format(with_plugin * 1000))
+    click.echo(
+        "plugin overhead:            {:8.1f} ms".format((with_plugin - base) * 1000)
+    )
+
+
+if __name__ == "__main__":
+    main()
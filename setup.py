@@ -42,7 +42,7 @@ extensions = [
     )
 ]
 
-inst_reqs = ["click>=8.0", "rasterio~=1.4", "rio-mucho"]
+inst_reqs = ["click>=8.0", "rasterio~=1.4"]
 
 setup(
     name="rio-color",
@@ -78,6 +78,11 @@ setup(
     entry_points="""
     [rasterio.rio_plugins]
     color=rio_color.scripts.cli:color
+    color-batch=rio_color.scripts.cli:color_batch
+    color-cache=rio_color.scripts.cli:color_cache
+    color-lut=rio_color.scripts.cli:color_lut
+    color-server=rio_color.scripts.cli:color_server
+    color-shard=rio_color.scripts.cli:color_shard
     atmos=rio_color.scripts.cli:atmos
     """,
 )
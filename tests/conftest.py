@@ -0,0 +1,45 @@
+"""Fixtures shared by the tests."""
+
+from click.testing import CliRunner
+import pytest
+import rasterio
+
+from rio_color.scripts.cli import color
+
+
+@pytest.fixture(autouse=True)
+def table_cache_dir(tmp_path_factory, monkeypatch):
+    """Keep the table cache of every test out of the user's cache."""
+    path = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("RIO_COLOR_CACHE_DIR", str(path))
+    return path
+
+
+@pytest.fixture
+def job():
+    """Block windows and uint8 output profile of a source."""
+
+    def job(src_path="tests/rgb8.tif"):
+        with rasterio.open(src_path) as src:
+            opts = src.profile.copy()
+            windows = [(window, ij) for ij, window in src.block_windows()]
+        opts["dtype"] = "uint8"
+        return windows, opts
+
+    return job
+
+
+@pytest.fixture
+def reference(tmpdir):
+    """Data of the uint8 output of rio color for a source."""
+
+    def reference(ops_string, src_path="tests/rgb8.tif"):
+        output = str(tmpdir.join("reference.tif"))
+        result = CliRunner().invoke(
+            color, ["-d", "uint8", src_path, output, ops_string]
+        )
+        assert result.exit_code == 0
+        with rasterio.open(output) as src:
+            return src.read()
+
+    return reference
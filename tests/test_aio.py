@@ -0,0 +1,115 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from rio_color import aio
+from rio_color.aio import TileBatcher, apply_async
+from rio_color.pipeline import ColorPipeline
+
+
+ops = "gamma 3 1.85, sigmoidal rgb 20 0.2, saturation 1.15"
+
+
+def tiles(n, dtype="uint16", size=32):
+    rng = np.random.default_rng(0)
+    return [
+        rng.integers(0, np.iinfo(dtype).max, (3, size, size + i)).astype(dtype)
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def batch_calls(monkeypatch):
+    calls = []
+    apply_batch = aio._apply_batch
+
+    def counting(pipeline, arrs, out_dtype):
+        calls.append(len(arrs))
+        return apply_batch(pipeline, arrs, out_dtype)
+
+    monkeypatch.setattr(aio, "_apply_batch", counting)
+    return calls
+
+
+def test_batcher(batch_calls):
+    arrs = tiles(10)
+    expected = [ColorPipeline(ops)(arr, "uint8") for arr in arrs]
+
+    async def main():
+        batcher = TileBatcher(delay=0.05)
+        return await asyncio.gather(*[batcher.apply(a, ops, "uint8") for a in arrs])
+
+    results = asyncio.run(main())
+    assert batch_calls == [10]
+    for out, exp in zip(results, expected):
+        assert out.dtype == np.uint8
+        assert np.array_equal(out, exp)
+
+
+def test_batcher_max_batch(batch_calls):
+    arrs = tiles(10)
+
+    async def main():
+        with ThreadPoolExecutor(2) as executor:
+            batcher = TileBatcher(delay=10, max_batch=4, executor=executor)
+            tasks = [batcher.apply(a, ops) for a in arrs[:8]]
+            return await asyncio.gather(*tasks)
+
+    results = asyncio.run(main())
+    assert batch_calls == [4, 4]
+    assert all(r.dtype == np.uint16 for r in results)
+
+
+def test_batcher_groups(batch_calls):
+    arrs = tiles(4)
+
+    async def main():
+        batcher = TileBatcher(delay=0.05)
+        return await asyncio.gather(
+            batcher.apply(arrs[0], ops, "uint8"),
+            batcher.apply(arrs[1], "gamma rgb 1.1", "uint8"),
+            batcher.apply(arrs[2], ops, "uint16"),
+            batcher.apply(arrs[3], ops, "uint8"),
+        )
+
+    results = asyncio.run(main())
+    assert sorted(batch_calls) == [1, 1, 2]
+    assert np.array_equal(results[1], ColorPipeline("gamma rgb 1.1")(arrs[1], "uint8"))
+
+
+def test_batcher_errors(batch_calls):
+    # some uint8 values are out of range for this pipeline, the error
+    # must only reach the request whose tile contains them
+    ops = "sigmoidal rgb -10 0.3 gamma r 0.7"
+    good = [np.full((3, 8, 8), v, dtype="uint8") for v in (90, 100)]
+    bad = np.broadcast_to(np.arange(256, dtype="uint8"), (3, 256)).reshape(3, 16, 16)
+
+    async def main():
+        batcher = TileBatcher(delay=0.05)
+        return await asyncio.gather(
+            batcher.apply(good[0], ops),
+            batcher.apply(bad, ops),
+            batcher.apply(good[1], ops),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+    assert batch_calls == [3]
+    assert isinstance(results[1], ValueError)
+    assert np.array_equal(results[0], ColorPipeline(ops)(good[0]))
+    assert np.array_equal(results[2], ColorPipeline(ops)(good[1]))
+
+    with pytest.raises(ValueError):
+        asyncio.run(TileBatcher().apply(good[0], "foob 1"))
+
+
+def test_apply_async():
+    arrs = tiles(3, "uint8")
+
+    async def main():
+        return await asyncio.gather(*[apply_async(a, "gamma rgb 1.2") for a in arrs])
+
+    for out, arr in zip(asyncio.run(main()), arrs):
+        assert np.array_equal(out, ColorPipeline("gamma rgb 1.2")(arr))
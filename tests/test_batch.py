@@ -0,0 +1,72 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import rasterio
+
+from rio_color.batch import expand_inputs, output_path, run_batch
+from rio_color.workers import color_worker
+
+
+ops = "gamma 3 1.85, gamma 1,2 1.95, sigmoidal 1,2,3 35 0.13, saturation 1.15"
+
+
+def expected(path, out_dtype):
+    args = {"ops_string": ops, "out_dtype": out_dtype}
+    with rasterio.open(path) as src:
+        out = np.empty((src.count, src.height, src.width), dtype=out_dtype)
+        for _, window in src.block_windows():
+            arr = color_worker([src], window, None, args)
+            out[
+                :,
+                window.row_off : window.row_off + window.height,
+                window.col_off : window.col_off + window.width,
+            ] = arr
+    return out
+
+
+def test_expand_inputs():
+    paths = expand_inputs(["tests/rgb8.tif", "tests/rgb[0-9]*.tif"])
+    assert paths == ["tests/rgb8.tif", "tests/rgb16.tif"]
+    assert expand_inputs(["tests/nothing*.tif"]) == []
+
+
+def test_output_path():
+    assert output_path("out/{stem}_color{ext}", "in/a.tif") == "out/a_color.tif"
+    assert output_path("{dir}/c_{name}", "in/a.tif") == "in/c_a.tif"
+    assert output_path("{dir}/c_{name}", "a.tif") == "./c_a.tif"
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_run_batch(tmpdir, jobs):
+    srcs = []
+    for name in ("rgb8.tif", "rgba8.tif", "rgb16.tif"):
+        path = str(tmpdir.join(name))
+        shutil.copy(os.path.join("tests", name), path)
+        srcs.append(path)
+
+    template = str(tmpdir.join("{stem}_out.tif"))
+    summary = run_batch(srcs, template, ops, out_dtype="uint8", jobs=jobs)
+
+    assert [s["src_path"] for s in summary] == srcs
+    for src_path, item in zip(srcs, summary):
+        assert item["windows"] == 224
+        assert item["elapsed"] >= 0
+        assert item["compute"] > 0
+        with rasterio.open(item["dst_path"]) as dst:
+            assert dst.dtypes[0] == "uint8"
+            assert np.array_equal(dst.read(), expected(src_path, "uint8"))
+
+
+def test_run_batch_native_dtype(tmpdir):
+    template = str(tmpdir.join("{stem}_out.tif"))
+    summary = run_batch(["tests/rgb16.tif"], template, "gamma rgb 1.5")
+    with rasterio.open(summary[0]["dst_path"]) as dst:
+        assert dst.dtypes[0] == "uint16"
+
+
+def test_run_batch_template_collision(tmpdir):
+    template = str(tmpdir.join("out.tif"))
+    with pytest.raises(ValueError):
+        run_batch(["tests/rgb8.tif", "tests/rgb16.tif"], template, ops)
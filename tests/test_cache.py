@@ -0,0 +1,161 @@
+import os
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+
+from rio_color.cache import (
+    TableCache,
+    cached_table,
+    canonical_operations,
+    get_table_cache,
+)
+from rio_color.pipeline import ColorPipeline
+from rio_color.scripts.cli import color_cache
+
+
+def test_canonical_operations():
+    expected = "gamma 12 1.5, sigmoidal 123 10.0 0.2, saturation 1.1"
+    assert (
+        canonical_operations("Gamma RG 1.5 sigmoidal rgb 10 0.2 saturation 1.1")
+        == expected
+    )
+    for ops in (
+        "gamma 2,1 1.50, sigmoidal bgr 1e1 .2, saturation 1.10",
+        "GAMMA gr 1.5 SIGMOIDAL 321 10 0.20 Saturation 1.1",
+    ):
+        assert canonical_operations(ops) == expected
+    assert canonical_operations("gamma 1 1.5") != canonical_operations("gamma 2 1.5")
+
+
+def test_key():
+    key = TableCache.key("gamma rg 1.5", "bands", "uint16", "uint8", 3)
+    assert key == TableCache.key("gamma 2,1 1.50", "bands", "uint16", "uint8", 3)
+    assert key != TableCache.key("gamma rg 1.5", "bands", "uint16", "uint16", 3)
+    assert key != TableCache.key("gamma rg 1.5", "cube", "uint16", "uint8", 3)
+
+
+def test_put_get(tmpdir):
+    cache = TableCache(str(tmpdir.join("cache")), max_bytes=2**20)
+    assert cache.get("missing") is None
+    assert cache.entries() == []
+
+    table = np.arange(12, dtype="uint16").reshape(3, 4)
+    stored = cache.put("a", table, ops_string="gamma 1 1.0")
+    assert isinstance(stored, np.memmap)
+    assert not stored.flags.writeable
+    assert np.array_equal(cache.get("a"), table)
+    [entry] = cache.entries()
+    assert entry["key"] == "a"
+    assert entry["ops_string"] == "gamma 1 1.0"
+    assert entry["size"] > table.nbytes
+    assert not [f for f in os.listdir(cache.path) if f.endswith(".tmp")]
+
+    # A truncated table is rebuilt
+    with open(os.path.join(cache.path, "a.npy"), "r+b") as f:
+        f.truncate(10)
+    assert cache.get("a") is None
+    cache.remove("a")
+    cache.remove("a")
+    assert cache.entries() == []
+
+
+def test_evict(tmpdir):
+    table = np.zeros(1000, dtype="uint8")
+    cache = TableCache(str(tmpdir), max_bytes=3500)
+    for i, key in enumerate("abc"):
+        cache.put(key, table)
+        os.utime(os.path.join(cache.path, key + ".npy"), (i, i))
+    # Using a table makes it the most recently used
+    cache.get("a")
+
+    cache.put("d", table)
+    assert sorted(e["key"] for e in cache.entries()) == ["a", "c", "d"]
+    assert len(cache.evict(1500)) == 2
+    assert cache.clear() == 1
+    assert cache.entries() == []
+
+    # Too large for the cache, returned but not kept
+    stored = TableCache(str(tmpdir), max_bytes=100).put("e", table)
+    assert np.array_equal(stored, table)
+    assert cache.entries() == []
+
+
+def test_get_table_cache(monkeypatch, table_cache_dir):
+    assert get_table_cache().path == str(table_cache_dir)
+    assert get_table_cache().max_bytes == 256 * 2**20
+    monkeypatch.setenv("RIO_COLOR_CACHE_SIZE", "1G")
+    assert get_table_cache().max_bytes == 2**30
+    monkeypatch.setenv("RIO_COLOR_CACHE_SIZE", "0")
+    assert get_table_cache() is None
+
+    monkeypatch.delenv("RIO_COLOR_CACHE_DIR")
+    monkeypatch.setenv("XDG_CACHE_HOME", "/tmp/xdg")
+    assert TableCache().path == "/tmp/xdg/rio-color"
+
+
+def test_cached_table(monkeypatch):
+    calls = []
+
+    def build():
+        calls.append(1)
+        return np.arange(5, dtype="uint8")
+
+    for _ in range(2):
+        table = cached_table("gamma 1 1.5", "test", ("uint8",), build, note="x")
+        assert np.array_equal(table, np.arange(5))
+    assert len(calls) == 1
+    [entry] = get_table_cache().entries()
+    assert entry["ops_string"] == "gamma 1 1.5"
+    assert entry["params"] == ["uint8"]
+    assert entry["note"] == "x"
+
+    # Missing tables are not cached
+    assert cached_table("gamma 1 1.5", "none", (), lambda: None) is None
+    assert len(get_table_cache().entries()) == 1
+
+    monkeypatch.setenv("RIO_COLOR_CACHE_SIZE", "0")
+    cached_table("gamma 1 1.5", "test", ("uint8",), build)
+    assert len(calls) == 2
+
+
+def test_pipeline_uses_cache(table_cache_dir):
+    ops = "gamma 3 1.85, sigmoidal rgb 20 0.2"
+    arr = np.random.default_rng(0).integers(0, 65535, (4, 16, 16), dtype="uint16")
+    expected = ColorPipeline(ops)(arr, "uint8")
+    [entry] = get_table_cache().entries()
+    assert entry["params"] == ["uint16", "uint8", "4"]
+    assert entry["shape"] == [4, 65536]
+
+    # A new pipeline with an equivalent string loads the table
+    pipeline = ColorPipeline("gamma b 1.85 sigmoidal 321 20 0.2")
+    assert isinstance(pipeline.table("uint16", "uint8", 4), np.memmap)
+    assert np.array_equal(pipeline(arr, "uint8"), expected)
+    assert len(get_table_cache().entries()) == 1
+
+    # uint8 tables are not cached
+    ColorPipeline(ops)(arr.astype("uint8"))
+    assert len(get_table_cache().entries()) == 1
+
+
+@pytest.mark.parametrize("max_size, remaining", [(None, 0), ("1M", 2)])
+def test_cli(max_size, remaining):
+    for ops in ("gamma 1 1.5", "gamma 2 1.5"):
+        ColorPipeline(ops).table("uint16", "uint8", 3)
+
+    runner = CliRunner()
+    result = runner.invoke(color_cache, ["list"])
+    assert result.exit_code == 0
+    assert "gamma 1 1.5" in result.output
+    assert "gamma 2 1.5" in result.output
+    assert "uint16 uint8 3" in result.output
+    assert "2 tables" in result.output
+
+    args = ["clear"] + (["--max-size", max_size] if max_size else [])
+    result = runner.invoke(color_cache, args)
+    assert result.exit_code == 0
+    assert "Removed {} tables".format(2 - remaining) in result.output
+    assert len(get_table_cache().entries()) == remaining
+
+    result = runner.invoke(color_cache, ["clear", "--max-size", "lots"])
+    assert result.exit_code == 2
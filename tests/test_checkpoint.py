@@ -0,0 +1,129 @@
+import os
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from rio_color.checkpoint import (
+    WindowJournal,
+    journal_path,
+    process_windows_checkpointed,
+)
+from rio_color.scripts.cli import color
+from rio_color.workers import color_worker
+
+
+args = {"ops_string": "gamma 3 1.85 sigmoidal rgb 35 0.13", "out_dtype": "uint8"}
+
+
+def failing_worker(srcs, window, ij, args):
+    if ij[0] >= 5:
+        raise RuntimeError("killed")
+    return color_worker(srcs, window, ij, args)
+
+
+def test_journal(tmpdir):
+    path = str(tmpdir.join("out.tif.journal"))
+    journal = WindowJournal(path, {"a": 1})
+    assert not journal.exists()
+    journal.start()
+    journal.add((0, 1))
+    journal.add((2, 3))
+    assert journal.done == set()
+    journal.commit()
+    journal.close()
+    with open(path, "a") as f:
+        f.write("4 ")  # torn write
+
+    assert WindowJournal(path, {"a": 1}).load() == {(0, 1), (2, 3)}
+    with pytest.raises(ValueError):
+        WindowJournal(path, {"a": 2}).load()
+
+    journal.remove()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_resume(tmpdir, jobs, job, reference):
+    output = str(tmpdir.join("out.tif"))
+    windows, opts = job()
+
+    with pytest.raises(RuntimeError):
+        process_windows_checkpointed(
+            failing_worker, "tests/rgb8.tif", output, windows, opts, args, interval=0
+        )
+    assert os.path.exists(journal_path(output))
+    with open(journal_path(output)) as f:
+        finished = len(f.readlines()) - 1
+    assert 0 < finished < len(windows)
+
+    count = process_windows_checkpointed(
+        color_worker, "tests/rgb8.tif", output, windows, opts, args, jobs, resume=True
+    )
+    assert count == len(windows) - finished
+    assert not os.path.exists(journal_path(output))
+    with rasterio.open(output) as src:
+        assert np.array_equal(src.read(), reference(args["ops_string"]))
+
+
+def test_resume_without_journal(tmpdir, job):
+    output = str(tmpdir.join("out.tif"))
+    windows, opts = job()
+    count = process_windows_checkpointed(
+        color_worker, "tests/rgb8.tif", output, windows, opts, args, resume=True
+    )
+    assert count == len(windows)
+
+
+def test_resume_other_job(tmpdir, job):
+    output = str(tmpdir.join("out.tif"))
+    windows, opts = job()
+    with pytest.raises(RuntimeError):
+        process_windows_checkpointed(
+            failing_worker, "tests/rgb8.tif", output, windows, opts, args, interval=0
+        )
+    other = dict(args, ops_string="gamma 3 1.5")
+    with pytest.raises(ValueError):
+        process_windows_checkpointed(
+            color_worker, "tests/rgb8.tif", output, windows, opts, other, resume=True
+        )
+
+    # Same number of windows in another layout, as with another --mem-limit
+    strips = [(Window(0, i * 2, 438, 2), (i, 0)) for i in range(len(windows))]
+    with pytest.raises(ValueError):
+        process_windows_checkpointed(
+            color_worker, "tests/rgb8.tif", output, strips, opts, args, resume=True
+        )
+
+
+def test_checkpoint_cli(tmpdir, reference):
+    output = str(tmpdir.join("out.tif"))
+    runner = CliRunner()
+    result = runner.invoke(
+        color,
+        ["--checkpoint", "-j", "2", "-d", "uint8", "tests/rgb8.tif", output]
+        + [args["ops_string"]],
+    )
+    assert result.exit_code == 0
+    assert not os.path.exists(journal_path(output))
+    with rasterio.open(output) as src:
+        assert np.array_equal(src.read(), reference(args["ops_string"]))
+        assert src.colorinterp[0] == rasterio.enums.ColorInterp.red
+
+    result = runner.invoke(
+        color,
+        ["--resume", "--cog", "tests/rgb8.tif", output, args["ops_string"]],
+    )
+    assert result.exit_code == 2
+
+    # A journal left by another job
+    with open(journal_path(output), "w") as f:
+        f.write('{"other": "job"}\n0 0\n')
+    result = runner.invoke(
+        color, ["--resume", "tests/rgb8.tif", output, args["ops_string"]]
+    )
+    assert result.exit_code == 2
+    assert journal_path(output) in result.output
+    assert "different job" in result.output
@@ -1,4 +1,6 @@
 import os
+import subprocess
+import sys
 
 from click import UsageError
 from click.testing import CliRunner
@@ -7,7 +9,7 @@ import pytest
 import rasterio
 from rasterio.enums import Compression
 
-from rio_color.scripts.cli import color, atmos, check_jobs
+from rio_color.scripts.cli import color, color_batch, atmos, check_jobs
 
 
 def equal(r1, r2):
@@ -111,6 +113,29 @@ def test_color_jobsn1(tmpdir):
     assert os.path.exists(output)
 
 
+def test_color_jobs_same_output(tmpdir):
+    # Windows are written in order with any number of jobs
+    outputs = []
+    for jobs in ["1", "3"]:
+        output = str(tmpdir.join("out{}.tif".format(jobs)))
+        result = CliRunner().invoke(
+            color,
+            [
+                "-j",
+                jobs,
+                "--co",
+                "compress=deflate",
+                "tests/rgb8.tif",
+                output,
+                "gamma 3 1.85 sigmoidal rgb 35 0.13",
+            ],
+        )
+        assert result.exit_code == 0
+        with open(output, "rb") as f:
+            outputs.append(f.read())
+    assert outputs[0] == outputs[1]
+
+
 def test_check_jobs():
     assert 1 == check_jobs(1)
     assert check_jobs(-1) > 0
@@ -239,3 +264,331 @@ def test_as_color(tmpdir):
         result.output.strip()
         == "rio color foo.tif bar.tif gamma g 0.99, gamma b 0.97, sigmoidal rgb 10.0 0.15"
     )
+
+
+def test_color_batch_cli(tmpdir):
+    template = str(tmpdir.join("{stem}_color.tif"))
+    runner = CliRunner()
+    result = runner.invoke(
+        color_batch,
+        [
+            "-d",
+            "uint8",
+            "-j",
+            "2",
+            "-o",
+            template,
+            "-p",
+            "gamma 1,2,3 1.85 sigmoidal rgb 35 0.13",
+            "tests/rgb8.tif",
+            "tests/rgb1*.tif",
+        ],
+    )
+    assert result.exit_code == 0
+    assert "2 files processed" in result.output
+    assert "rgb16.tif" in result.output
+
+    output = str(tmpdir.join("colorj1.tif"))
+    result = runner.invoke(
+        color,
+        [
+            "-d",
+            "uint8",
+            "tests/rgb8.tif",
+            output,
+            "gamma 1,2,3 1.85 sigmoidal rgb 35 0.13",
+        ],
+    )
+    assert result.exit_code == 0
+    assert equal(output, str(tmpdir.join("rgb8_color.tif")))
+
+
+def test_color_batch_cli_errors(tmpdir):
+    runner = CliRunner()
+    template = str(tmpdir.join("{stem}.tif"))
+    result = runner.invoke(
+        color_batch, ["-o", template, "-p", "gamma 1 1.5", "tests/nothing*.tif"]
+    )
+    assert result.exit_code == 2
+    assert "No input files" in result.output
+
+    result = runner.invoke(
+        color_batch, ["-o", template, "-p", "foob 115", "tests/rgb8.tif"]
+    )
+    assert result.exit_code == 2
+    assert "foob is not a valid operation" in result.output
+
+    result = runner.invoke(
+        color_batch, ["-o", "{bad}.tif", "-p", "gamma 1 1.5", "tests/rgb8.tif"]
+    )
+    assert result.exit_code == 2
+    assert "Invalid output template" in result.output
+
+
+def test_lazy_imports():
+    # rio imports every plugin for every invocation, heavy modules must
+    # only be imported once a command runs.
+    code = (
+        "import sys\n"
+        "from click.testing import CliRunner\n"
+        "from rio_color.scripts.cli import color, atmos\n"
+        "CliRunner().invoke(color, ['--help'])\n"
+        "CliRunner().invoke(atmos, ['--help'])\n"
+        "heavy = ['rio_color.colorspace', 'rio_color.operations',\n"
+        "         'rio_color.workers', 'rio_color.batch', 'rio_color.server']\n"
+        "print(','.join(m for m in heavy if m in sys.modules))\n"
+    )
+    out = subprocess.check_output([sys.executable, "-c", code])
+    assert out.decode().strip() == ""
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_color_cog(tmpdir, jobs):
+    output = str(tmpdir.join("cog.tif"))
+    reference = str(tmpdir.join("reference.tif"))
+    ops = "gamma 3 1.85 sigmoidal rgb 35 0.13"
+    runner = CliRunner()
+    result = runner.invoke(
+        color,
+        [
+            "--cog",
+            "-j",
+            jobs,
+            "--co",
+            "blockxsize=128",
+            "--co",
+            "blockysize=128",
+            "--co",
+            "compress=deflate",
+            "tests/rgb8.tif",
+            output,
+            ops,
+        ],
+    )
+    assert result.exit_code == 0
+    assert os.listdir(str(tmpdir)) == ["cog.tif"]
+
+    result = runner.invoke(color, ["tests/rgb8.tif", reference, ops])
+    assert result.exit_code == 0
+    assert equal(output, reference)
+
+    with rasterio.open(output) as src:
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert src.compression == Compression.deflate
+        assert src.block_shapes[0] == (128, 128)
+        assert src.overviews(1) == [2, 4]
+
+
+def test_atmos_auto(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(
+        atmos, ["--auto", "-b", "0.2", "--as-color", "tests/rgb8.tif", "out.tif"]
+    )
+    assert result.exit_code == 0
+    assert "Estimated --atmo 0.122 --contrast 41.5 --bias 0.2," in result.output
+    assert "sigmoidal rgb 41.5 0.2" in result.output
+
+    output = str(tmpdir.join("auto.tif"))
+    reference = str(tmpdir.join("reference.tif"))
+    result = runner.invoke(atmos, ["--auto", "-j", "2", "tests/rgb8.tif", output])
+    assert result.exit_code == 0
+    result = runner.invoke(
+        atmos,
+        ["-a", "0.122", "-c", "41.5", "-b", "0.152", "tests/rgb8.tif", reference],
+    )
+    assert result.exit_code == 0
+    assert equal(output, reference)
+
+
+def test_atmos_cog(tmpdir):
+    output = str(tmpdir.join("cog.tif"))
+    result = CliRunner().invoke(
+        atmos,
+        ["--cog", "--overview-resampling", "nearest"]
+        + ["--co", "blockxsize=256", "--co", "blockysize=256"]
+        + ["tests/rgb16.tif", output],
+    )
+    assert result.exit_code == 0
+    with rasterio.open(output) as src:
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert src.compression == Compression.lzw
+        assert src.overviews(1) == [2]
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+@pytest.mark.parametrize("mem_limit", ["64K", "64M"])
+def test_color_mem_limit(tmpdir, jobs, mem_limit):
+    output = str(tmpdir.join("limited.tif"))
+    reference = str(tmpdir.join("reference.tif"))
+    ops = "gamma 3 1.85 sigmoidal rgb 35 0.13 saturation 1.2"
+    runner = CliRunner()
+    result = runner.invoke(
+        color, ["--mem-limit", mem_limit, "-j", jobs, "tests/rgb8.tif", output, ops]
+    )
+    assert result.exit_code == 0
+    assert "memory limit {}.0 {}iB".format(mem_limit[:-1], mem_limit[-1]) in (
+        result.output
+    )
+    assert "Peak memory:" in result.output
+    assert ("largest worker" in result.output) == (jobs == "2")
+
+    result = runner.invoke(color, ["tests/rgb8.tif", reference, ops])
+    assert result.exit_code == 0
+    assert "Peak memory" not in result.output
+    assert equal(output, reference)
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_color_lut_size(tmpdir, jobs):
+    output = str(tmpdir.join("lut.tif"))
+    reference = str(tmpdir.join("reference.tif"))
+    ops = "saturation 1.2 sigmoidal rgb 10 0.15"
+    runner = CliRunner()
+    result = runner.invoke(
+        color,
+        ["--lut-size", "33", "-j", jobs, "-d", "uint8", "tests/rgb16.tif", output, ops],
+    )
+    assert result.exit_code == 0
+    result = runner.invoke(color, ["-d", "uint8", "tests/rgb16.tif", reference, ops])
+    assert result.exit_code == 0
+
+    with rasterio.open(output) as out, rasterio.open(reference) as ref:
+        assert np.abs(out.read().astype(int) - ref.read()).max() <= 1
+
+    result = runner.invoke(color, ["--lut-size", "1", "tests/rgb16.tif", output, ops])
+    assert result.exit_code == 2
+    result = runner.invoke(
+        color,
+        [
+            "--lut-size",
+            "33",
+            "--server",
+            "unix:/nowhere",
+            "tests/rgb16.tif",
+            output,
+            ops,
+        ],
+    )
+    assert result.exit_code == 2
+    assert "--lut-size can't be combined with --server" in result.output
+
+
+@pytest.mark.parametrize(
+    "option,message",
+    [
+        ("--cog", "--cog can't"),
+        ("--checkpoint", "--checkpoint and --resume can't"),
+        ("--resume", "--checkpoint and --resume can't"),
+        ("--mem-limit=1G", "--mem-limit can't"),
+    ],
+)
+def test_color_server_unsupported(tmpdir, option, message):
+    output = str(tmpdir.join("out.tif"))
+    result = CliRunner().invoke(
+        color,
+        [option, "--server", "unix:/nowhere", "tests/rgb8.tif", output, "gamma 1 1.1"],
+    )
+    assert result.exit_code == 2
+    assert message + " be combined with --server" in result.output
+    assert not os.path.exists(output)
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["gamma 5 1.1"],
+        ["--also", "other.tif", "gamma 5 1.1", "gamma 1 1.1"],
+    ],
+)
+def test_color_band_out_of_range(tmpdir, jobs, args):
+    output = str(tmpdir.join("out.tif"))
+    args = [str(tmpdir.join(a)) if a == "other.tif" else a for a in args]
+    result = CliRunner().invoke(
+        color, ["-j", jobs] + args[:-1] + ["tests/rgb8.tif", output, args[-1]]
+    )
+    assert result.exit_code == 2
+    assert "gamma uses band 5 but the raster has 3 bands" in result.output
+    assert not os.path.exists(output)
+
+
+def test_color_mem_limit_errors(tmpdir):
+    output = str(tmpdir.join("out.tif"))
+    runner = CliRunner()
+    result = runner.invoke(
+        color, ["--mem-limit", "lots", "tests/rgb8.tif", output, "gamma 1 1.1"]
+    )
+    assert result.exit_code == 2
+    assert "Invalid size" in result.output
+
+    result = runner.invoke(
+        color, ["--mem-limit", "1K", "tests/rgb8.tif", output, "saturation 1.1"]
+    )
+    assert result.exit_code == 2
+    assert "too small" in result.output
+
+
+def test_atmos_mem_limit(tmpdir):
+    output = str(tmpdir.join("limited.tif"))
+    reference = str(tmpdir.join("reference.tif"))
+    runner = CliRunner()
+    result = runner.invoke(atmos, ["--mem-limit", "100K", "tests/rgb16.tif", output])
+    assert result.exit_code == 0
+    assert "Peak memory:" in result.output
+
+    result = runner.invoke(atmos, ["tests/rgb16.tif", reference])
+    assert result.exit_code == 0
+    assert equal(output, reference)
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+@pytest.mark.parametrize("cog", [[], ["--cog"]])
+def test_color_also(tmpdir, jobs, cog):
+    runner = CliRunner()
+    products = {
+        str(tmpdir.join("natural.tif")): "gamma g 1.1",
+        str(tmpdir.join("contrast.tif")): "sigmoidal rgb 20 0.2 saturation 1.2",
+        str(tmpdir.join("gray.tif")): "saturation 0",
+    }
+    (first, first_ops), *others = products.items()
+    also = [arg for path, ops in others for arg in ("--also", path, ops)]
+    result = runner.invoke(
+        color,
+        ["-j", jobs, "-d", "uint8"]
+        + cog
+        + also
+        + ["tests/rgba8.tif", first, first_ops],
+    )
+    assert result.exit_code == 0
+
+    for path, ops in products.items():
+        reference = str(tmpdir.join("reference.tif"))
+        result = runner.invoke(
+            color, ["-d", "uint8", "tests/rgba8.tif", reference, ops]
+        )
+        assert result.exit_code == 0
+        with rasterio.open(path) as out, rasterio.open(reference) as ref:
+            assert np.array_equal(out.read(), ref.read())
+            assert out.colorinterp == ref.colorinterp
+            layout = out.tags(ns="IMAGE_STRUCTURE").get("LAYOUT")
+            assert (layout == "COG") == bool(cog)
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--also", "out2.tif", "blur rgb 3"],
+        ["--also", "out2.tif", "gamma rgb 1.5", "--incremental"],
+        ["--also", "out2.tif", "gamma rgb 1.5", "--checkpoint"],
+        ["--also", "out.tif", "gamma rgb 1.5"],
+    ],
+)
+def test_color_also_errors(tmpdir, args):
+    src_path = os.path.abspath("tests/rgb8.tif")
+    with tmpdir.as_cwd():
+        result = CliRunner().invoke(
+            color, args + [src_path, "out.tif", "gamma rgb 1.5"]
+        )
+    assert result.exit_code == 2
+    assert "Error" in result.output
+    assert not os.path.exists(str(tmpdir.join("out.tif")))
@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+from rio_color.cog import cog_options, cog_output
+
+
+def test_cog_options():
+    profile = {"compress": "lzw", "tiled": True}
+    assert cog_options(profile, {}) == {"compress": "lzw"}
+    assert cog_options(
+        profile, {"compress": "jpeg", "blockxsize": 256, "blockysize": 256}
+    ) == {"compress": "jpeg", "blocksize": 256}
+    assert cog_options({}, {"TILED": "YES", "QUALITY": 90}) == {"quality": 90}
+
+
+def test_cog_output_cleanup(tmpdir):
+    dst = str(tmpdir.join("out.tif"))
+    with pytest.raises(RuntimeError):
+        with cog_output(dst, {"compress": "jpeg"}, {}) as (path, profile):
+            assert os.path.dirname(path) == str(tmpdir)
+            assert "compress" not in profile
+            assert profile["tiled"]
+            raise RuntimeError("failed")
+    assert os.listdir(str(tmpdir)) == []
@@ -0,0 +1,394 @@
+import os
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import rasterio
+
+from rio_color.cache import TableCache
+from rio_color.colorspace import apply_lut3d
+from rio_color.lut import (
+    Lut3D,
+    export_cube,
+    interpolate,
+    read_cube,
+    sample_pipeline,
+    split_operations,
+    write_cube,
+)
+from rio_color.operations import (
+    _parse_operations,
+    compile_program,
+    format_operations,
+    parse_operations,
+)
+from rio_color.pipeline import ColorPipeline, get_pipeline
+from rio_color.scripts.cli import color, color_lut
+from rio_color.utils import scale_dtype, to_math_type
+from rio_color.workers import color_worker
+
+
+@pytest.fixture
+def rgb16():
+    with rasterio.open("tests/rgb16.tif") as src:
+        return src.read(window=((100, 228), (100, 228)))
+
+
+def test_split_operations():
+    assert split_operations("gamma g 1.5 sigmoidal rgb 10 0.2 saturation 1.1") == (
+        "gamma 2 1.5, sigmoidal 123 10.0 0.2",
+        "saturation 1.1",
+    )
+    assert split_operations("saturation 1.1 gamma 1 1.5") == (
+        "",
+        "saturation 1.1, gamma 1 1.5",
+    )
+    assert split_operations("gamma 1 1.5") == ("gamma 1 1.5", "")
+
+
+def test_sample_pipeline():
+    identity = sample_pipeline(None, 3)
+    assert identity.shape == (3, 3, 3, 3)
+    assert identity.dtype == np.float32
+    assert identity[2, 1, 0].tolist() == [1.0, 0.5, 0.0]
+
+    table = sample_pipeline(ColorPipeline("gamma b 2.0"), 5)
+    assert np.array_equal(table[..., :2], sample_pipeline(None, 5)[..., :2])
+    assert np.allclose(table[1, 2, 3, 2], 0.75**0.5)
+
+    table = sample_pipeline(ColorPipeline("saturation 0"), 5)
+    # Gray, whatever the input
+    assert np.allclose(table[..., 0], table[..., 1], atol=1e-6)
+    assert np.allclose(table[..., 1], table[..., 2], atol=1e-6)
+
+    with pytest.raises(ValueError):
+        sample_pipeline(None, 1)
+    with pytest.raises(ValueError, match="between 0 and 1"):
+        sample_pipeline(ColorPipeline("sigmoidal rgb -10 0.3 gamma r 0.7"), 9)
+
+
+@pytest.mark.parametrize("in_dtype", ["uint8", "uint16", "int16"])
+@pytest.mark.parametrize("out_dtype", ["uint8", "uint16"])
+def test_lut3d_linear(in_dtype, out_dtype):
+    # Interpolating a linear table is exact
+    lut = Lut3D(sample_pipeline(None, 5))
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, np.iinfo(in_dtype).max, (4, 9, 11), endpoint=True)
+    arr = arr.astype(in_dtype)
+    out = lut(arr, out_dtype)
+    assert out.dtype == out_dtype
+    expected = ColorPipeline("gamma 1 1.0")(arr, out_dtype)
+    assert np.abs(out.astype(int) - expected).max() <= 1
+    assert np.array_equal(out[3], expected[3])
+
+
+def test_lut3d_lattice_points():
+    # Pixels on lattice points get the table value
+    table = np.random.default_rng(0).random((6, 6, 6, 3), dtype="float32")
+    index = np.array([[[0, 1, 2, 5]], [[5, 0, 3, 4]], [[2, 5, 0, 1]]])
+    out = Lut3D(table)((index * 13107).astype("uint16"), "uint16")
+    for j, (r, g, b) in enumerate(zip(*index[:, 0])):
+        expected = (table[r, g, b] * 65535).astype(int)
+        assert np.abs(out[:, 0, j].astype(int) - expected).max() <= 1
+
+
+@pytest.mark.parametrize(
+    "ops, size, max_err",
+    [
+        ("saturation 1.2, sigmoidal rgb 10 0.15", 33, 1),
+        ("gamma g 1.85, gamma b 1.95, sigmoidal rgb 35 0.13, saturation 1.15", 33, 5),
+        ("gamma g 1.85, gamma b 1.95, sigmoidal rgb 35 0.13, saturation 1.15", 65, 3),
+        ("gamma rgb 1.5", 9, 0),
+    ],
+)
+def test_lut3d_error(rgb16, ops, size, max_err):
+    lut = Lut3D.from_operations(ops, size)
+    assert lut.size == size
+    err_max, err_mean = lut.error(ops, rgb16, "uint8")
+    assert err_max <= max_err
+    assert err_mean <= 1
+
+
+def test_lut3d_shaper(rgb16):
+    ops = "gamma g 1.85, gamma b 1.95, sigmoidal rgb 35 0.13, saturation 1.15"
+    shaped = Lut3D.from_operations(ops, 33)
+    assert (
+        shaped.shaper.ops_string
+        == "gamma 2 1.85, gamma 3 1.95, sigmoidal 123 35.0 0.13"
+    )
+    plain = Lut3D.from_operations(ops, 33, shaper=False)
+    assert plain.shaper is None
+    assert shaped.error(ops, rgb16, "uint8")[0] < plain.error(ops, rgb16, "uint8")[0]
+
+
+def test_lut3d_errors():
+    with pytest.raises(ValueError, match="shape"):
+        Lut3D(np.zeros((3, 3, 4, 3)))
+    with pytest.raises(ValueError, match="can't apply|Can't apply"):
+        Lut3D(sample_pipeline(None, 3))(np.zeros((3, 2, 2), "int64"))
+    with pytest.raises(ValueError, match="3 bands"):
+        Lut3D(sample_pipeline(None, 3))(np.zeros((2, 2, 2), "uint8"))
+
+    table = sample_pipeline(None, 3)
+    arr = np.zeros((3, 2, 2), "uint8")
+    with pytest.raises(ValueError, match="shape"):
+        apply_lut3d(arr, np.zeros((3, 2, 3), "uint8"), table, 255, 255)
+    with pytest.raises(ValueError, match="n > 1"):
+        apply_lut3d(arr, arr.copy(), table[:1, :1, :1].copy(), 255, 255)
+
+
+def test_pipeline_lut_size(rgb16):
+    ops = "saturation 1.2, sigmoidal rgb 10 0.15"
+    exact = ColorPipeline(ops)
+    pipeline = ColorPipeline(ops, lut_size=33)
+    assert pipeline.lut3d().size == 33
+    assert ColorPipeline(ops).lut3d() is None
+
+    arr = np.concatenate([rgb16, rgb16[:1]])
+    out = pipeline(arr, "uint8")
+    expected = exact(arr, "uint8")
+    assert np.abs(out.astype(int) - expected).max() <= 1
+    # The extra band is only rescaled
+    assert np.array_equal(out[3], expected[3])
+
+    # Unused bands are copied exactly
+    pipeline = ColorPipeline("gamma r 1.5", lut_size=9)
+    arr = rgb16.astype("int16") // 2
+    out = pipeline(arr, "uint16")
+    assert np.array_equal(out[1:], ColorPipeline("gamma r 1.5")(arr, "uint16")[1:])
+
+    # Exact tables are used when possible
+    assert np.array_equal(pipeline(rgb16), ColorPipeline("gamma r 1.5")(rgb16))
+
+    # Operations that can't be sampled fall back to the exact path
+    pipeline = ColorPipeline(
+        "saturation 1.0 sigmoidal rgb -10 0.3 gamma rgb 0.7", lut_size=9
+    )
+    assert pipeline.lut3d() is None
+    with pytest.raises(ValueError):
+        pipeline(np.linspace(0, 32767, 256).astype("int16").reshape(1, 1, 256)[[0] * 3])
+
+
+def test_color_worker_lut_size():
+    window = ((0, 64), (0, 64))
+    args = {
+        "ops_string": "saturation 1.2, sigmoidal rgb 10 0.15",
+        "out_dtype": "uint8",
+        "lut_size": 33,
+    }
+    with rasterio.open("tests/rgb16.tif") as src:
+        out = color_worker([src], window, None, args)
+        expected = get_pipeline(args["ops_string"])(src.read(window=window), "uint8")
+    assert np.abs(out.astype(int) - expected).max() <= 1
+
+
+identity_cube = """# An identity table
+TITLE "identity"
+LUT_3D_SIZE 2
+DOMAIN_MIN 0 0 0
+DOMAIN_MAX 1 1 1
+0 0 0
+1 0 0
+0 1 0
+1 1 0
+0 0 1
+1 0 1
+0 1 1
+1 1 1
+"""
+
+
+def test_read_cube(tmpdir):
+    path = str(tmpdir.join("identity.cube"))
+    with open(path, "w") as f:
+        f.write(identity_cube)
+    table, title = read_cube(path)
+    assert title == "identity"
+    assert table.dtype == np.float32
+    # Red changes fastest in the file
+    assert np.array_equal(table, sample_pipeline(None, 2))
+
+    with open(path, "w") as f:
+        f.write("LUT_1D_SIZE 3\n0 0 0\n0.25 0.5 1\n1 1 1\n")
+    table, title = read_cube(path)
+    assert title is None
+    assert table.shape == (3, 3)
+    assert table[1].tolist() == [0.25, 0.5, 1]
+
+
+@pytest.mark.parametrize(
+    "text, match",
+    [
+        ("LUT_3D_SIZE 2\n0 0 0\n", "Expected 8 rows"),
+        ("LUT_1D_SIZE 2\n0 0\n1 1\n", "rows of 3 numbers"),
+        ("0 0 0\n1 1 1\n", "Missing LUT_1D_SIZE"),
+        ("LUT_1D_SIZE 2\nDOMAIN_MAX 2 2 2\n0 0 0\n1 1 1\n", "domain"),
+        ("LUT_1D_SIZE 2\nLUT_3D_SIZE 2\n", "both"),
+        ("LUT_1D_SIZE 2\nLUT_3D_INPUT_RANGE 0 1\n0 0 0\n1 1 1\n", "Unknown keyword"),
+    ],
+)
+def test_read_cube_errors(tmpdir, text, match):
+    path = str(tmpdir.join("bad.cube"))
+    with open(path, "w") as f:
+        f.write(text)
+    with pytest.raises(ValueError, match=match):
+        read_cube(path)
+
+
+def test_read_cube_missing(tmpdir):
+    with pytest.raises(ValueError, match="Can't read LUT file"):
+        read_cube(str(tmpdir.join("missing.cube")))
+
+
+def test_write_cube(tmpdir):
+    path = str(tmpdir.join("out.cube"))
+    table = np.random.default_rng(0).random((4, 4, 4, 3), dtype="float32")
+    write_cube(path, table, title="random")
+    read, title = read_cube(path)
+    assert title == "random"
+    assert np.allclose(read, table, atol=1e-6)
+
+    write_cube(path, table[0, 0])
+    assert np.allclose(read_cube(path)[0], table[0, 0], atol=1e-6)
+
+    with pytest.raises(ValueError):
+        write_cube(path, table[0])
+
+
+def test_interpolate():
+    table = np.random.default_rng(0).random((5, 5, 5, 3), dtype="float32")
+    arr = np.random.default_rng(1).integers(0, 65535, (3, 20, 30), dtype="uint16")
+    expected = interpolate(arr / 65535, table)
+    assert expected.shape == (3, 20, 30)
+    out = Lut3D(table)(arr)
+    assert np.abs(out.astype(int) - (expected * 65535).astype(int)).max() <= 1
+
+    # Lattice points and linear tables are exact
+    assert np.allclose(interpolate(np.array([0.5, 0.25, 1.0]), table), table[2, 1, 4])
+    identity = sample_pipeline(None, 3)
+    assert np.allclose(interpolate(arr / 65535, identity), arr / 65535)
+
+
+def test_export_cube(tmpdir, rgb16):
+    ops = "saturation 1.2, sigmoidal rgb 10 0.15"
+    path = export_cube(ops, str(tmpdir.join("look.cube")), 17)
+    table, title = read_cube(path)
+    assert title == ops
+    assert table.shape == (17, 17, 17, 3)
+    assert np.allclose(
+        table, Lut3D.from_operations(ops, 17, shaper=False).table, atol=1e-6
+    )
+
+    path = export_cube("gamma g 1.5", str(tmpdir.join("curve.cube")), one_d=True)
+    table, _ = read_cube(path)
+    assert table.shape == (1024, 3)
+    assert np.allclose(table[:, 0], np.linspace(0, 1, 1024), atol=1e-6)
+    assert np.allclose(table[:, 1], np.linspace(0, 1, 1024) ** (1 / 1.5), atol=1e-6)
+
+    with pytest.raises(ValueError, match="3D table"):
+        export_cube(ops, str(tmpdir.join("x.cube")), one_d=True)
+
+
+def test_lut_operation(tmpdir, rgb16):
+    ops = "saturation 1.2, sigmoidal rgb 10 0.15"
+    path = export_cube(ops, str(tmpdir.join("Look.cube")), 33)
+
+    [op] = _parse_operations("LUT {}".format(path))
+    assert op.name == "lut" and op.rgb_op
+    assert op.kwargs == {"path": path}
+    assert format_operations([op]) == "lut {}".format(path)
+
+    # The fast path matches the float operations
+    pipeline = ColorPipeline("gamma b 1.1 lut {}".format(path))
+    assert pipeline.lut3d().size == 33
+    assert pipeline.lut3d().shaper.ops_string == "gamma 3 1.1"
+    arr = to_math_type(rgb16)
+    for func in parse_operations(pipeline.ops_string):
+        arr = func(arr)
+    out = pipeline(rgb16, "uint8")
+    assert np.abs(out.astype(int) - scale_dtype(arr, "uint8")).max() <= 1
+
+    # and is close to the operations the file was made from
+    out = ColorPipeline("lut {}".format(path))(rgb16, "uint8")
+    assert np.abs(out.astype(int) - ColorPipeline(ops)(rgb16, "uint8")).max() <= 1
+
+    # The native engine can't run tables
+    pipeline = ColorPipeline("lut {} gamma 1 1.1".format(path), engine="native")
+    assert pipeline.lut3d() is None
+    with pytest.raises(ValueError, match="can't be compiled"):
+        compile_program(pipeline.ops_string)
+    assert pipeline(rgb16.astype("int16") // 2, "uint8").dtype == "uint8"
+
+    with pytest.raises(ValueError, match="lut takes"):
+        _parse_operations("lut")
+    with pytest.raises(ValueError, match="Can't read"):
+        _parse_operations("lut missing.cube")
+
+
+def test_lut_curve_operation(tmpdir, rgb16):
+    ops = "gamma g 1.5, sigmoidal rgb 10 0.15"
+    path = export_cube(ops, str(tmpdir.join("curve.cube")), 4096, one_d=True)
+    operations = _parse_operations("lut {}".format(path))
+    assert [op.bands for op in operations] == [{1}, {2}, {3}]
+    assert not any(op.rgb_op for op in operations)
+    assert format_operations(operations) == "lut {}".format(path)
+
+    # Per-band tables are used
+    pipeline = ColorPipeline("lut {}".format(path))
+    assert pipeline.table("uint16", "uint8", 3) is not None
+    out = pipeline(rgb16, "uint8")
+    assert np.abs(out.astype(int) - ColorPipeline(ops)(rgb16, "uint8")).max() <= 1
+
+
+def test_lut_cache_key(tmpdir):
+    path = str(tmpdir.join("look.cube"))
+    export_cube("saturation 1.2", path, 5)
+    key = TableCache.key("lut {}".format(path), "bands", "uint16")
+    export_cube("saturation 1.3", path, 5)
+    assert TableCache.key("lut {}".format(path), "bands", "uint16") != key
+
+
+def test_get_pipeline_modified_cube(tmpdir, rgb16):
+    path = str(tmpdir.join("look.cube"))
+    ops = "lut {}".format(path)
+    export_cube("saturation 1.2", path, 5)
+    before = get_pipeline(ops)(rgb16, "uint8")
+    assert get_pipeline(ops) is get_pipeline(ops)
+
+    export_cube("gamma rgb 2", path, 5)
+    os.utime(path, ns=(0, 0))
+    out = get_pipeline(ops)(rgb16, "uint8")
+    assert np.array_equal(out, ColorPipeline(ops)(rgb16, "uint8"))
+    assert not np.array_equal(out, before)
+
+
+def test_color_lut_cli(tmpdir):
+    path = str(tmpdir.join("look.cube"))
+    ops = "saturation 1.2 sigmoidal rgb 10 0.15"
+    runner = CliRunner()
+    result = runner.invoke(color_lut, ["export", "-s", "17", path, ops])
+    assert result.exit_code == 0
+    assert read_cube(path)[0].shape == (17, 17, 17, 3)
+
+    result = runner.invoke(color_lut, ["info", path])
+    assert result.exit_code == 0
+    assert "Title: {}".format(ops) in result.output
+    assert "Type: 3D" in result.output
+    assert "Size: 17" in result.output
+
+    result = runner.invoke(color_lut, ["export", "--1d", path, ops])
+    assert result.exit_code == 2
+    assert "3D table" in result.output
+
+    output = str(tmpdir.join("out.tif"))
+    result = runner.invoke(
+        color, ["-d", "uint8", "tests/rgb16.tif", output, "lut", path]
+    )
+    assert result.exit_code == 0
+    with rasterio.open(output) as out, rasterio.open("tests/rgb16.tif") as src:
+        expected = ColorPipeline(ops)(src.read(), "uint8")
+        assert np.abs(out.read().astype(int) - expected).max() <= 2
+
+    result = runner.invoke(color, ["tests/rgb16.tif", output, "lut", "nope.cube"])
+    assert result.exit_code == 2
+    assert "Can't read LUT file" in result.output
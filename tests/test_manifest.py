@@ -0,0 +1,205 @@
+import os
+import shutil
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from rio_color.manifest import (
+    formula_hash,
+    incremental_worker,
+    load_manifest,
+    manifest_path,
+    process_windows_incremental,
+    window_hash,
+    window_key,
+)
+from rio_color.scripts.cli import color
+from rio_color.workers import color_worker
+
+
+args = {"ops_string": "gamma 3 1.85 sigmoidal rgb 35 0.13", "out_dtype": "uint8"}
+
+
+def update(path, window, value):
+    """Change the data of a window of path."""
+    with rasterio.open(path, "r+") as dst:
+        arr = dst.read(window=window)
+        arr[:] = value
+        dst.write(arr, window=window)
+
+
+@pytest.fixture
+def src_path(tmpdir):
+    path = str(tmpdir.join("src.tif"))
+    shutil.copyfile("tests/rgb8.tif", path)
+    return path
+
+
+def test_window_key():
+    assert window_key(Window(64, 32, 16, 8)) == "32 64 8 16"
+
+
+def test_formula_hash(job):
+    _, opts = job("tests/rgb8.tif")
+    assert formula_hash(opts, args) == formula_hash(
+        opts, dict(args, ops_string="Gamma B 1.850 sigmoidal 3,2,1 35 0.13")
+    )
+    assert formula_hash(opts, args) != formula_hash(
+        opts, dict(args, ops_string="gamma 3 1.8 sigmoidal rgb 35 0.13")
+    )
+    assert formula_hash(opts, args) != formula_hash(
+        opts, dict(args, out_dtype="uint16")
+    )
+    assert formula_hash(opts, args) != formula_hash(
+        dict(opts, compress="deflate"), args
+    )
+
+
+def test_manifest_hashes(tmpdir, src_path, job):
+    output = str(tmpdir.join("out.tif"))
+    windows, opts = job(src_path)
+    run = (color_worker, src_path, output, windows, opts, args)
+    process_windows_incremental(*run)
+    hashes = load_manifest(manifest_path(output))["windows"]
+    assert len(hashes) == len(windows)
+
+    update(src_path, windows[3][0], 7)
+    process_windows_incremental(*run)
+    changed = load_manifest(manifest_path(output))["windows"]
+    assert [k for k in hashes if hashes[k] != changed[k]] == [window_key(windows[3][0])]
+
+
+def test_incremental_worker(src_path, job):
+    windows, _ = job(src_path)
+    window, ij = windows[3]
+    reads = []
+
+    class Src:
+        def read(self, *a, **kw):
+            reads.append(kw)
+            with rasterio.open(src_path) as src:
+                return src.read(*a, **kw)
+
+    digest, arr = incremental_worker(
+        [Src()], window, ij, {"worker": color_worker, "args": args, "previous": None}
+    )
+    with rasterio.open(src_path) as src:
+        assert digest == window_hash(src.read(window=window))
+        assert np.array_equal(arr, color_worker([src], window, ij, args))
+    # Read once for both the hash and the worker
+    assert len(reads) == 1
+
+    previous = {"worker": color_worker, "args": args, "previous": digest}
+    assert incremental_worker([Src()], window, ij, previous) == (digest, None)
+
+
+def test_load_manifest(tmpdir):
+    path = str(tmpdir.join("out.tif.manifest"))
+    assert load_manifest(path) is None
+    with open(path, "w") as f:
+        f.write("{torn")
+    assert load_manifest(path) is None
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_incremental(tmpdir, src_path, jobs, job, reference):
+    output = str(tmpdir.join("out.tif"))
+    windows, opts = job(src_path)
+
+    run = (color_worker, src_path, output, windows, opts, args)
+    assert process_windows_incremental(*run, jobs=jobs) == (len(windows), len(windows))
+    assert os.path.exists(manifest_path(output))
+    mtime = os.stat(output).st_mtime_ns
+
+    # Nothing changed, the output isn't touched
+    assert process_windows_incremental(*run, jobs=jobs) == (0, len(windows))
+    assert os.stat(output).st_mtime_ns == mtime
+
+    for i in (2, 40):
+        update(src_path, windows[i][0], 100)
+    assert process_windows_incremental(*run, jobs=jobs) == (2, len(windows))
+    with rasterio.open(output) as dst:
+        assert np.array_equal(dst.read(), reference(args["ops_string"], src_path))
+
+    # Other operations change every window
+    other = dict(args, ops_string="gamma rgb 1.5")
+    run = (color_worker, src_path, output, windows, opts, other)
+    assert process_windows_incremental(*run) == (len(windows), len(windows))
+    with rasterio.open(output) as dst:
+        assert np.array_equal(dst.read(), reference("gamma rgb 1.5", src_path))
+
+
+def test_incremental_missing_output(tmpdir, src_path, job, reference):
+    output = str(tmpdir.join("out.tif"))
+    windows, opts = job(src_path)
+    run = (color_worker, src_path, output, windows, opts, args)
+    process_windows_incremental(*run)
+
+    os.remove(output)
+    assert process_windows_incremental(*run) == (len(windows), len(windows))
+    with rasterio.open(output) as dst:
+        assert np.array_equal(dst.read(), reference(args["ops_string"], src_path))
+
+
+def test_incremental_interrupted(tmpdir, src_path, job, reference):
+    output = str(tmpdir.join("out.tif"))
+    windows, opts = job(src_path)
+    process_windows_incremental(color_worker, src_path, output, windows, opts, args)
+
+    def failing_worker(srcs, window, ij, args):
+        if ij[0] >= 5:
+            raise RuntimeError("killed")
+        return color_worker(srcs, window, ij, args)
+
+    for window, _ in windows[::7]:
+        update(src_path, window, 50)
+    with pytest.raises(RuntimeError):
+        process_windows_incremental(
+            failing_worker, src_path, output, windows, opts, args
+        )
+
+    # The previous manifest still lists the old hashes
+    count, _ = process_windows_incremental(
+        color_worker, src_path, output, windows, opts, args
+    )
+    assert count == len(windows[::7])
+    with rasterio.open(output) as dst:
+        assert np.array_equal(dst.read(), reference(args["ops_string"], src_path))
+
+
+def test_cli(tmpdir, src_path, job, reference):
+    output = str(tmpdir.join("out.tif"))
+    runner = CliRunner()
+    cmd = ["--incremental", "-d", "uint8", src_path, output, args["ops_string"]]
+
+    result = runner.invoke(color, cmd)
+    assert result.exit_code == 0
+    assert "Recomputed 224 of 224 windows" in result.output
+
+    windows, _ = job(src_path)
+    update(src_path, windows[0][0], 10)
+    result = runner.invoke(color, cmd)
+    assert result.exit_code == 0
+    assert "Recomputed 1 of 224 windows" in result.output
+    with rasterio.open(output) as dst, rasterio.open(src_path) as src:
+        assert np.array_equal(dst.read(), reference(args["ops_string"], src_path))
+        assert dst.colorinterp == src.colorinterp
+
+
+@pytest.mark.parametrize("option", ["--cog", "--checkpoint", "--resume"])
+def test_cli_incompatible(tmpdir, option):
+    result = CliRunner().invoke(
+        color,
+        [
+            "--incremental",
+            option,
+            "tests/rgb8.tif",
+            str(tmpdir.join("out.tif")),
+            "gamma rgb 1.5",
+        ],
+    )
+    assert result.exit_code == 2
+    assert "--incremental can't be combined" in result.output
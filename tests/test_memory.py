@@ -0,0 +1,142 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from rio_color.memory import (
+    atmos_pixel_bytes,
+    color_pixel_bytes,
+    fit_windows,
+    format_size,
+    parse_size,
+)
+from rio_color.pipeline import ColorPipeline, get_pipeline
+from rio_color.workers import atmos_worker
+
+
+def test_parse_size():
+    assert parse_size("100") == 100
+    assert parse_size("4K") == 4096
+    assert parse_size("512M") == 512 * 2**20
+    assert parse_size("1.5GB") == 3 * 2**29
+    assert parse_size(" 2 GiB ") == 2 * 2**30
+    for bad in ("", "2X", "-1G", "G"):
+        with pytest.raises(ValueError):
+            parse_size(bad)
+
+
+def test_format_size():
+    assert format_size(100) == "100 B"
+    assert format_size(1536) == "1.5 KiB"
+    assert format_size(3 * 2**20) == "3.0 MiB"
+    assert format_size(2**42) == "4096.0 GiB"
+
+
+def covered(windows, width, height):
+    mask = np.zeros((height, width), dtype=int)
+    for w, _ in windows:
+        mask[w.row_off : w.row_off + w.height, w.col_off : w.col_off + w.width] += 1
+    return (mask == 1).all()
+
+
+@pytest.mark.parametrize(
+    "budget, jobs, shape",
+    [
+        # whole block rows merged
+        (2**19, 1, (64, 438)),
+        # but kept to about four windows per job
+        (2**30, 1, (96, 438)),
+        # blocks merged along a block row
+        (2**18, 2, (32, 256)),
+        # blocks split into strips
+        (2**13, 1, (16, 32)),
+        (2**13, 2, (8, 32)),
+        (7000, 2, (6, 32)),
+    ],
+)
+def test_fit_windows(budget, jobs, shape):
+    windows = fit_windows(438, 500, (32, 32), 16, budget, jobs)
+    assert covered(windows, 438, 500)
+    w, _ = windows[0]
+    assert (w.height, w.width) == shape
+    assert all(jobs * w.width * w.height * 16 <= budget for w, _ in windows)
+    assert len(set(ij for _, ij in windows)) == len(windows)
+
+
+def test_fit_windows_uneven_blocks():
+    # strips that don't divide the block evenly never cross block rows
+    windows = fit_windows(100, 100, (30, 100), 1, 1100, 1)
+    assert covered(windows, 100, 100)
+    assert sorted(set(w.height for w, _ in windows)) == [10]
+    assert all(w.row_off // 30 == (w.row_off + w.height - 1) // 30 for w, _ in windows)
+
+
+def test_fit_windows_too_small():
+    with pytest.raises(ValueError, match="too small for 4 jobs"):
+        fit_windows(438, 500, (32, 32), 16, 2000, 4)
+
+
+def peak(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize(
+    "ops",
+    [
+        "gamma rgb 1.5",
+        "sigmoidal rgb 10 0.3",
+        "saturation 1.2",
+        "gamma 3 1.8 sigmoidal rgb 20 0.2 saturation 1.1",
+    ],
+)
+@pytest.mark.parametrize("count", [3, 4, 6])
+def test_color_pixel_bytes(ops, count):
+    # int16 isn't tabulated
+    arr = np.random.randint(0, 32768, size=(count, 64, 64)).astype("int16")
+
+    def run():
+        # the window read counts towards the working memory
+        ColorPipeline(ops)(arr.copy(), "uint8")
+
+    measured = peak(run)
+    estimate = color_pixel_bytes(ops, count, "int16", "uint8") * 64 * 64
+    assert measured <= estimate < 1.5 * measured
+
+
+def test_color_pixel_bytes_table():
+    # Lookup tables only need the input and the output
+    assert color_pixel_bytes("gamma rgb 1.5", 3, "uint8", "uint8") == 6
+    assert color_pixel_bytes("gamma rgb 1.5", 3, "uint16", "uint8") == 9
+
+
+def test_color_pixel_bytes_bands():
+    # Only the bands used by the operations are converted to floats
+    assert color_pixel_bytes("gamma 1 1.5", 4, "int16", "int16") == 16 + 2 * 8
+    assert color_pixel_bytes("gamma 1 1.5", 4, "int16", "uint8") == 12 + 3 * 8
+    # Per-band operations run on all their bands at once
+    assert color_pixel_bytes("gamma 12 1.5", 4, "int16", "int16") == 16 + 4 * 8
+
+
+@pytest.mark.parametrize("count", [3, 4])
+def test_atmos_pixel_bytes(count):
+    # int16 isn't tabulated
+    arr = np.random.randint(0, 32768, size=(count, 64, 64)).astype("int16")
+    src = type("Src", (), {"read": lambda self, window: arr.copy()})()
+    args = {"atmo": 0.03, "contrast": 10, "bias": 0.15, "out_dtype": "uint8"}
+
+    def run():
+        # Without the scratch buffers of an earlier pipeline
+        get_pipeline.cache_clear()
+        atmos_worker([src], None, None, args)
+
+    measured = peak(run)
+    estimate = atmos_pixel_bytes(count, "int16", "uint8") * 64 * 64
+    assert measured <= estimate < 1.5 * measured
+
+    # uint8 and uint16 go through lookup tables
+    assert atmos_pixel_bytes(count, "uint16", "uint8") == 3 * count
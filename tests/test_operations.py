@@ -6,9 +6,18 @@ from rio_color.operations import (
     sigmoidal,
     gamma,
     saturation,
+    stretch,
     simple_atmo,
     parse_operations,
     simple_atmo_opstring,
+    compile_program,
+    format_operations,
+    _parse_operations,
+    OP_GAMMA,
+    OP_SIGMOIDAL,
+    OP_INV_SIGMOIDAL,
+    OP_SATURATION,
+    OP_STRETCH,
 )
 
 
@@ -88,6 +97,33 @@ def test_gamma(arr):
         x = gamma(arr * -1, 2.2)
 
 
+def test_stretch(arr):
+    x = stretch(arr, 0.1, 0.3)
+    assert np.allclose(x, np.clip((arr - 0.1) / 0.2, 0, 1))
+    assert x.min() == 0 and x.max() == 1
+
+    low = np.array([0.0, 0.2, 0.3]).reshape(-1, 1, 1)
+    x = stretch(arr, low, 0.5)
+    assert np.allclose(x[1], np.clip((arr[1] - 0.2) / 0.3, 0, 1))
+
+    with pytest.raises(ValueError):
+        stretch(arr, 0.5, 0.5)
+
+
+def test_parse_percentiles():
+    (op,) = _parse_operations("stretch 21 2%,1% 98.5%")
+    assert op.kwargs == {"low": (1.0, 2.0), "high": 98.5}
+    assert format_operations([op]) == "stretch 12 1.0%,2.0% 98.5%"
+    for ops in ["stretch rgb 2%,0.1,3% 98%", "gamma rgb 2%", "stretch rgb 101% 2%"]:
+        with pytest.raises(ValueError):
+            _parse_operations(ops)
+    # Percentiles need to be resolved from statistics first
+    with pytest.raises(ValueError, match="resolve_percentiles"):
+        parse_operations("stretch rgb 2% 98%")
+    with pytest.raises(ValueError, match="resolve_percentiles"):
+        compile_program("stretch rgb 2% 0.9")
+
+
 def test_sat(arr):
     x = saturation(arr, 50)
     assert x[0][0][0] - 0.15860622 < 1e-4
@@ -182,8 +218,105 @@ def test_parse_bands(arr):
     fb = parse_operations("gamma Rg 0.95")[0]
     assert np.array_equal(fa(arr), fb(arr))
 
+    # Any band can be addressed, arrays must have them
+    f = parse_operations("gamma 7,8,9 1.05")[0]
+    with pytest.raises(ValueError, match="uses band 9"):
+        f(arr)
+    with pytest.raises(ValueError):
+        parse_operations("gamma 0 1.05")
     with pytest.raises(ValueError):
-        parse_operations("gamma 7,8,9 1.05")
+        parse_operations("gamma x 1.05")
+
+
+@pytest.fixture
+def arr8():
+    rng = np.random.default_rng(0)
+    return rng.random((12, 8, 8))
+
+
+def test_parse_band_values(arr8):
+    f = parse_operations("gamma 1234 1.1,1.0,0.95,1.2")[0]
+    expected = arr8.copy()
+    for b, g in zip(range(4), (1.1, 1.0, 0.95, 1.2)):
+        expected[b] = gamma(arr8[b], g)
+    assert np.allclose(f(arr8), expected, rtol=0, atol=1e-15)
+
+    # Values follow the bands as written
+    fa = parse_operations("sigmoidal 31 10,5 0.2,0.6")[0]
+    fb, fc = parse_operations("sigmoidal 3 10 0.2, sigmoidal 1 5 0.6")
+    assert np.allclose(fa(arr8), fc(fb(arr8)), rtol=0, atol=1e-15)
+
+
+def test_parse_bands_past_9(arr8):
+    f = parse_operations("gamma 9,10,12 1.5")[0]
+    out = f(arr8)
+    assert np.array_equal(out[[8, 9, 11]], gamma(arr8[[8, 9, 11]], 1.5))
+    assert np.array_equal(out[:8], arr8[:8])
+    assert np.array_equal(out[10], arr8[10])
+
+    # A single band past 9 keeps a trailing comma
+    f = parse_operations("gamma 10, 1.5, sigmoidal 12, 10 0.5")
+    assert [op.bands for op in _parse_operations("gamma 10, 1.5")] == [{10}]
+    out = f[1](f[0](arr8))
+    assert np.array_equal(out[9], gamma(arr8[9], 1.5))
+    assert np.array_equal(out[11], sigmoidal(arr8[11], 10, 0.5))
+    assert np.array_equal(out[:9], arr8[:9])
+
+
+def test_sigmoidal_band_values(arr8):
+    contrast = np.array([10, -5, 0, 20]).reshape(4, 1, 1)
+    bias = np.array([0.2, 0.5, 0.5, 0]).reshape(4, 1, 1)
+    out = sigmoidal(arr8[:4], contrast, bias)
+    for b in range(4):
+        expected = sigmoidal(arr8[b], contrast[b, 0, 0], bias[b, 0, 0])
+        assert np.allclose(out[b], expected, rtol=0, atol=1e-15)
+    with pytest.raises(ValueError):
+        sigmoidal(arr8[:2], contrast[:2], np.array([0.5, 1.5]).reshape(2, 1, 1))
+    with pytest.raises(ValueError):
+        gamma(arr8[:2], np.array([1.5, 0]).reshape(2, 1, 1))
+
+
+@pytest.mark.parametrize(
+    "ops",
+    [
+        "gamma 12 1.5,1.2,1.1",
+        "gamma 11 1.5,1.2",
+        "saturation 1.2,1.3",
+        "sigmoidal rgb 10,20 0.5",
+    ],
+)
+def test_parse_band_values_errors(ops):
+    with pytest.raises(ValueError):
+        parse_operations(ops)
+
+
+def test_format_operations():
+    assert format_operations(_parse_operations("gamma 2,1 1.5,2.0")) == (
+        "gamma 12 2.0,1.5"
+    )
+    assert format_operations(_parse_operations("gamma rg 1.5,1.5")) == "gamma 12 1.5"
+    assert format_operations(_parse_operations("sigmoidal 12,9 10 0.5,0.3")) == (
+        "sigmoidal 9,12 10.0 0.3,0.5"
+    )
+    ops = "gamma 1234 1.1,1.0,0.95,1.2, sigmoidal 10,11 10,20 0.2, saturation 1.1"
+    assert format_operations(_parse_operations(ops)) == format_operations(
+        _parse_operations(format_operations(_parse_operations(ops)))
+    )
+
+
+@pytest.mark.parametrize(
+    "ops,formatted",
+    [
+        ("gamma 10, 1.5", "gamma 10, 1.5"),
+        ("gamma 12,12 1.5", "gamma 12, 1.5"),
+        ("stretch 10, 0.1 0.9 gamma 3 2", "stretch 10, 0.1 0.9, gamma 3 2.0"),
+        ("sigmoidal 9,10 10 0.5", "sigmoidal 9,10 10.0 0.5"),
+    ],
+)
+def test_format_operations_band_past_9(ops, formatted):
+    operations = _parse_operations(ops)
+    assert format_operations(operations) == formatted
+    assert _parse_operations(formatted) == operations
 
 
 def test_parse_multi_saturation_first(arr):
@@ -203,3 +336,51 @@ def test_simple_atmos_opstring(arr):
     for op in parse_operations(ops):
         arr = op(arr)
     assert np.allclose(x, arr)
+
+
+def test_compile_program():
+    program, bands = compile_program("gamma b 2 sigmoidal rg 10 0.3 saturation 1.1")
+    assert bands == (1, 2, 3)
+    assert program.shape == (4, 6)
+    assert program[:, 0].tolist() == [
+        OP_GAMMA,
+        OP_SIGMOIDAL,
+        OP_SIGMOIDAL,
+        OP_SATURATION,
+    ]
+    assert program[:, 1].tolist() == [2, 0, 1, 0]
+    assert program[0, 2] == 0.5
+    assert program[3, 2] == 1.1
+
+    program, bands = compile_program("sigmoidal 3 -5 0.5, sigmoidal 3 0 0.5")
+    assert bands == (3,)
+    assert program[:, 0].tolist() == [OP_INV_SIGMOIDAL, OP_GAMMA]
+    assert program[:, 1].tolist() == [0, 0]
+    # zero contrast only checks the range
+    assert program[1, 2] == 1.0
+
+
+@pytest.mark.parametrize(
+    "ops", ["gamma 1 0", "gamma 1 -1", "sigmoidal 1 10 1.5", "gamma 1", "sigmoidal 2 3"]
+)
+def test_compile_program_errors(ops):
+    with pytest.raises(ValueError):
+        compile_program(ops)
+
+
+def test_compile_program_band_values():
+    program, bands = compile_program("gamma 31 2,4 sigmoidal 13 10,-5 0.3")
+    assert bands == (1, 3)
+    assert program[:, 0].tolist() == [
+        OP_GAMMA,
+        OP_GAMMA,
+        OP_SIGMOIDAL,
+        OP_INV_SIGMOIDAL,
+    ]
+    assert program[:, 1].tolist() == [0, 1, 0, 1]
+    assert program[:2, 2].tolist() == [0.25, 0.5]
+    assert program[2:, 2].tolist() == [10, -5]
+
+    program, _ = compile_program("stretch 12 0.1,0.2 0.6")
+    assert program[:, 0].tolist() == [OP_STRETCH, OP_STRETCH]
+    assert np.allclose(program[:, 2:4], [[0.1, 0.5], [0.2, 0.4]])
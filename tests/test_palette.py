@@ -0,0 +1,204 @@
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import ColorInterp
+
+from rio_color.palette import (
+    color_palette,
+    colormap_array,
+    has_palette,
+    palette_colors,
+)
+from rio_color.batch import run_batch
+from rio_color.pipeline import ColorPipeline
+from rio_color.scripts.cli import color
+
+ops = "gamma g 1.5 sigmoidal rgb 10 0.2 saturation 1.2"
+
+
+def make_paletted(path, nodata=None, compress="deflate"):
+    rng = np.random.default_rng(0)
+    colormap = {
+        i: tuple(int(v) for v in rng.integers(0, 256, 3)) + (255,) for i in range(200)
+    }
+    profile = dict(
+        driver="GTiff",
+        width=300,
+        height=200,
+        count=1,
+        dtype="uint8",
+        tiled=True,
+        blockxsize=128,
+        blockysize=128,
+        compress=compress,
+        nodata=nodata,
+    )
+    indices = rng.integers(0, 200, (1, 200, 300)).astype("uint8")
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(indices)
+        dst.write_colormap(1, colormap)
+    return indices, colormap
+
+
+@pytest.fixture
+def paletted(tmpdir):
+    path = str(tmpdir.join("paletted.tif"))
+    indices, colormap = make_paletted(path)
+    return path, indices, colormap
+
+
+def expanded(indices, colormap):
+    """The RGBA pixels of a paletted image."""
+    return np.take(colormap_array(colormap)[:, 0], indices[0], axis=1)
+
+
+def test_colormap_array():
+    arr = colormap_array({0: (1, 2, 3), 2: (4, 5, 6, 7)})
+    assert arr.shape == (4, 1, 3)
+    assert arr[:, 0].T.tolist() == [[1, 2, 3, 255], [0, 0, 0, 0], [4, 5, 6, 7]]
+
+
+def test_color_palette_copy(tmpdir, paletted):
+    src_path, indices, colormap = paletted
+    dst_path = str(tmpdir.join("out.tif"))
+    color_palette(src_path, dst_path, ops)
+
+    with rasterio.open(src_path) as src, rasterio.open(dst_path) as dst:
+        assert has_palette(dst)
+        assert dst.profile == src.profile
+        assert np.array_equal(dst.read(), indices)
+        colors = ColorPipeline(ops)(colormap_array(colormap), "uint8")
+        assert dst.colormap(1)[5] == tuple(colors[:, 0, 5])
+        assert np.array_equal(colormap_array(dst.colormap(1))[:, :, :200], colors)
+
+
+def test_color_palette_profile(tmpdir, paletted):
+    src_path, indices, colormap = paletted
+    dst_path = str(tmpdir.join("out.tif"))
+    with rasterio.open(src_path) as src:
+        opts = src.profile.copy()
+    opts.update(compress="lzw", blockxsize=64, blockysize=64)
+    color_palette(src_path, dst_path, ops, opts)
+
+    with rasterio.open(dst_path) as dst:
+        assert dst.compression.value == "LZW"
+        assert dst.block_shapes == [(64, 64)]
+        assert np.array_equal(dst.read(), indices)
+        assert has_palette(dst)
+
+
+@pytest.mark.parametrize("nodata", [None, 3])
+def test_color_palette_expand(tmpdir, nodata):
+    src_path = str(tmpdir.join("paletted.tif"))
+    indices, colormap = make_paletted(src_path, nodata=nodata)
+    dst_path = str(tmpdir.join("out.tif"))
+    color_palette(src_path, dst_path, ops, expand=True)
+
+    expected = ColorPipeline(ops)(expanded(indices, colormap), "uint8")
+    with rasterio.open(dst_path) as dst:
+        if nodata is None:
+            assert dst.count == 3
+            assert dst.colorinterp == (
+                ColorInterp.red,
+                ColorInterp.green,
+                ColorInterp.blue,
+            )
+            assert np.array_equal(dst.read(), expected[:3])
+        else:
+            assert dst.count == 4
+            assert dst.colorinterp[3] == ColorInterp.alpha
+            assert dst.nodata is None
+            arr = dst.read()
+            assert np.array_equal(arr[:3], expected[:3])
+            assert np.array_equal(arr[3] == 0, indices[0] == nodata)
+
+
+def test_palette_colors_uint16(paletted):
+    src_path, _, colormap = paletted
+    with rasterio.open(src_path) as src:
+        colors = palette_colors(src, "gamma rgb 1.0", "uint16")
+    assert colors.dtype == "uint16"
+    assert np.array_equal(
+        colors[:, :, :200], colormap_array(colormap)[:, :, :200].astype("uint16") * 257
+    )
+
+
+def test_color_palette_not_paletted(tmpdir):
+    with pytest.raises(ValueError, match="not a paletted raster"):
+        color_palette("tests/rgb8.tif", str(tmpdir.join("out.tif")), ops)
+
+
+def test_run_batch(tmpdir, paletted):
+    src_path, indices, colormap = paletted
+    template = str(tmpdir.join("{stem}_out.tif"))
+    summary = run_batch([src_path, "tests/rgb8.tif"], template, ops)
+    assert [item["windows"] for item in summary] == [0, 224]
+
+    # Indices are kept and the colormap is corrected
+    with rasterio.open(summary[0]["dst_path"]) as dst:
+        assert has_palette(dst)
+        assert np.array_equal(dst.read(), indices)
+        colors = ColorPipeline(ops)(colormap_array(colormap), "uint8")
+        assert np.array_equal(colormap_array(dst.colormap(1))[:, :, :200], colors)
+
+    summary = run_batch([src_path], template, ops, creation_options={"compress": "lzw"})
+    with rasterio.open(summary[0]["dst_path"]) as dst:
+        assert dst.compression.name == "lzw"
+        assert np.array_equal(dst.read(), indices)
+
+    with pytest.raises(ValueError, match="can't be converted to uint16"):
+        run_batch([src_path], template, ops, out_dtype="uint16")
+
+
+def test_cli(tmpdir, paletted):
+    src_path, indices, colormap = paletted
+    runner = CliRunner()
+
+    output = str(tmpdir.join("out.tif"))
+    result = runner.invoke(color, [src_path, output, ops])
+    assert result.exit_code == 0
+    with rasterio.open(output) as dst:
+        assert has_palette(dst)
+        assert np.array_equal(dst.read(), indices)
+
+    output = str(tmpdir.join("rgb.tif"))
+    result = runner.invoke(
+        color, ["--expand-palette", "-d", "uint16", src_path, output, ops]
+    )
+    assert result.exit_code == 0
+    with rasterio.open(output) as dst:
+        assert dst.dtypes == ("uint16",) * 3
+        expected = ColorPipeline(ops)(expanded(indices, colormap), "uint16")
+        assert np.array_equal(dst.read(), expected[:3])
+
+    output = str(tmpdir.join("cog.tif"))
+    result = runner.invoke(color, ["--cog", src_path, output, ops])
+    assert result.exit_code == 0
+    with rasterio.open(output) as dst:
+        assert has_palette(dst)
+        assert np.array_equal(dst.read(), indices)
+        # Overviews pick indices instead of averaging them
+        overview = dst.read(out_shape=(1, 50, 75))
+        assert np.isin(overview, indices).all()
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [
+        (["-d", "uint16"], "can't be converted to uint16"),
+        (["--checkpoint"], "don't apply to paletted rasters"),
+    ],
+)
+def test_cli_errors(tmpdir, paletted, args, message):
+    src_path, _, _ = paletted
+    result = CliRunner().invoke(
+        color, args + [src_path, str(tmpdir.join("o.tif")), ops]
+    )
+    assert result.exit_code == 2
+    assert message in result.output
+
+    result = CliRunner().invoke(
+        color, [src_path, str(tmpdir.join("o.tif")), "sigmoidal rgb 10 1.5"]
+    )
+    assert result.exit_code == 2
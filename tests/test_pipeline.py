@@ -0,0 +1,335 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from rio_color.operations import parse_operations
+from rio_color.pipeline import (
+    ColorPipeline,
+    _strips,
+    apply,
+    apply_few_colors,
+    apply_many,
+    few_colors,
+    get_pipeline,
+)
+from rio_color.utils import to_math_type, scale_dtype
+
+
+def reference(arr, ops, out_dtype):
+    arr = to_math_type(arr)
+    for func in parse_operations(ops):
+        arr = func(arr)
+    return scale_dtype(arr, out_dtype)
+
+
+def tile(dtype, shape=(3, 64, 64), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, np.iinfo(dtype).max, size=shape, endpoint=True).astype(dtype)
+
+
+@pytest.mark.parametrize(
+    "ops",
+    [
+        "gamma 3 1.85, gamma 1,2 1.95, sigmoidal 1,2,3 35 0.13",
+        "gamma g 0.99, gamma b 0.97, sigmoidal rgb 10.0 0.15",
+        "gamma 3 1.85, sigmoidal rgb 20 0.2, saturation 1.15",
+        "stretch 12 0.1,0.3 0.6,0.9 sigmoidal rgb 10 0.5",
+    ],
+)
+@pytest.mark.parametrize("in_dtype", ["uint8", "uint16", "int16"])
+@pytest.mark.parametrize("out_dtype", ["uint8", "uint16"])
+def test_pipeline_matches_operations(ops, in_dtype, out_dtype):
+    pipeline = ColorPipeline(ops)
+    for shape in [(3, 64, 64), (4, 17, 33)]:
+        arr = tile(in_dtype, shape)
+        out = pipeline(arr, out_dtype)
+        assert out.dtype == out_dtype
+        assert np.array_equal(out, reference(arr, ops, out_dtype))
+
+
+@pytest.mark.parametrize(
+    "ops", ["gamma 3 1.85", "gamma 1,3 1.2 sigmoidal 2 10 0.3", "saturation 1.2"]
+)
+@pytest.mark.parametrize("in_dtype", ["uint8", "uint16", "int16"])
+@pytest.mark.parametrize("out_dtype", ["uint8", "uint16"])
+def test_pipeline_untouched_bands(ops, in_dtype, out_dtype):
+    pipeline = ColorPipeline(ops)
+    arr = tile(in_dtype, (6, 17, 33))
+    out = pipeline(arr, out_dtype)
+    assert np.array_equal(out, reference(arr, ops, out_dtype))
+    if in_dtype == out_dtype:
+        assert np.array_equal(out[3:], arr[3:])
+
+
+def test_pipeline_bands():
+    assert ColorPipeline("gamma 3 1.85").bands == (3,)
+    assert ColorPipeline("gamma b 1.1 sigmoidal r 10 0.3").bands == (1, 3)
+    assert ColorPipeline("gamma 3 1.85 saturation 1.2").bands == (1, 2, 3)
+
+    pipeline = ColorPipeline("gamma 3 1.85")
+    pipeline._apply_float(tile("int16", (4, 8, 8)), "uint8")
+    # only the computed band gets a float scratch buffer
+    assert list(pipeline._local.buffers) == [(1, 8, 8)]
+
+    with pytest.raises(ValueError, match="band 3"):
+        pipeline._apply_float(tile("int16", (2, 8, 8)), "uint8")
+
+
+def test_pipeline_default_dtype():
+    arr = tile("uint16")
+    assert ColorPipeline("gamma rgb 1.5")(arr).dtype == np.uint16
+
+
+def test_pipeline_tables():
+    pipeline = ColorPipeline("gamma 1 1.5 sigmoidal rgb 10 0.5")
+    table = pipeline.table("uint8", "uint8", 4)
+    assert table.shape == (4, 256)
+    assert table is pipeline.table("uint8", "uint8", 4)
+    # untouched band is only rescaled
+    assert np.array_equal(table[3], np.arange(256))
+
+    assert pipeline.table("uint16", "uint8", 3).shape == (3, 65536)
+    assert pipeline.table("int16", "uint8", 3) is None
+    assert ColorPipeline("saturation 1.2").table("uint8", "uint8", 3) is None
+
+
+def test_pipeline_untabulated_values():
+    # some uint8 values are out of range after the first sigmoidal,
+    # the pipeline only fails if they occur in the input
+    ops = "sigmoidal rgb -10 0.3 gamma r 0.7"
+    pipeline = ColorPipeline(ops)
+    assert pipeline.table("uint8", "uint8", 3) is None
+
+    arr = np.full((3, 8, 8), 100, dtype="uint8")
+    assert np.array_equal(pipeline(arr), reference(arr, ops, "uint8"))
+    with pytest.raises(ValueError):
+        pipeline(tile("uint8"))
+
+
+def test_pipeline_errors():
+    with pytest.raises(ValueError):
+        ColorPipeline("foob 115")
+    with pytest.raises(ValueError):
+        ColorPipeline("saturation 1.1")(tile("uint8", (2, 8, 8)))
+
+
+def test_pipeline_output_is_not_scratch():
+    pipeline = ColorPipeline("saturation 1.2")
+    a = pipeline(tile("uint8", seed=1))
+    expected = a.copy()
+    pipeline(tile("uint8", seed=2))
+    assert np.array_equal(a, expected)
+
+
+@pytest.mark.parametrize("ops", ["gamma rgb 1.2", "saturation 0.8"])
+def test_pipeline_threads(ops):
+    pipeline = ColorPipeline(ops)
+    tiles = [tile("uint16", seed=i) for i in range(16)]
+    expected = [reference(t, ops, "uint8") for t in tiles]
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda t: pipeline(t, "uint8"), tiles * 4))
+    for i, out in enumerate(results):
+        assert np.array_equal(out, expected[i % 16])
+
+
+def test_get_pipeline():
+    assert get_pipeline("gamma r 1.1") is get_pipeline("gamma r 1.1")
+
+
+def test_strips():
+    assert _strips(10, 5, 1, 4) == [(0, 4), (4, 8), (8, 10)]
+    # at least four strips per worker
+    assert len(_strips(1000, 1000, 2)) == 8
+    # about a million pixels per strip
+    assert _strips(1000, 2**19, 1)[0] == (0, 2)
+
+
+@pytest.mark.parametrize(
+    "ops", ["gamma 3 1.85 sigmoidal rgb 35 0.13", "gamma 1 1.1 saturation 1.2"]
+)
+@pytest.mark.parametrize("processes", [False, True])
+def test_apply(ops, processes):
+    arr = tile("uint16", (4, 101, 67))
+    expected = get_pipeline(ops)(arr, "uint8")
+    for workers in (1, 3):
+        out = apply(arr, ops, "uint8", workers=workers, processes=processes)
+        assert out.dtype == np.uint8
+        assert np.array_equal(out, expected)
+    out = apply(arr, ops, workers=3, processes=processes, strip_rows=7)
+    assert np.array_equal(out, get_pipeline(ops)(arr))
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_apply_errors(processes):
+    # strips with out of range values raise as in serial execution
+    arr = np.full((3, 64, 8), 100, dtype="uint8")
+    arr[:, 40] = 255
+    with pytest.raises(ValueError):
+        apply(arr, "sigmoidal rgb -10 0.3 gamma r 0.7", workers=2, processes=processes)
+    with pytest.raises(ValueError):
+        apply(arr[0], "gamma 1 1.1", workers=2)
+
+
+@pytest.mark.parametrize(
+    "ops",
+    [
+        "gamma 3 1.85, sigmoidal rgb 35 0.13, saturation 1.15",
+        "stretch rgb 0.1,0.2,0.05 0.8 saturation 1.2",
+        "saturation 0.5 gamma b 0.8",
+        "sigmoidal rgb -10 0.3",
+        "sigmoidal 1 0 0.5 gamma 2 2",
+        "gamma 1 1.1 saturation 1.2",
+    ],
+)
+@pytest.mark.parametrize("in_dtype", ["uint8", "uint16", "int16", "int32"])
+@pytest.mark.parametrize("out_dtype", ["uint8", "uint16"])
+def test_native_engine(ops, in_dtype, out_dtype):
+    pipeline = ColorPipeline(ops, engine="native")
+    arr = tile(in_dtype, (5, 19, 23))
+    arr[:, 0, :4] = [0, 1, np.iinfo(in_dtype).max - 1, np.iinfo(in_dtype).max]
+    out = pipeline(arr, out_dtype)
+    expected = ColorPipeline(ops)(arr, out_dtype)
+    assert out.dtype == out_dtype
+    # C library and numpy transcendentals may differ in the last bit
+    assert np.abs(out.astype(int) - expected.astype(int)).max() <= 1
+    assert np.array_equal(out[3:], ColorPipeline(ops)(arr, out_dtype)[3:])
+
+
+def test_native_engine_errors():
+    # values out of range for the second operation
+    pipeline = ColorPipeline("sigmoidal rgb -10 0.3 gamma r 0.7", engine="native")
+    arr = np.linspace(0, 32767, 256).astype("int16").reshape(1, 1, 256)
+    with pytest.raises(ValueError, match="between 0 and 1"):
+        pipeline(arr.repeat(3, axis=0))
+    # invalid arguments raise when applied, as with the numpy engine
+    with pytest.raises(ValueError, match="gamma must be greater than 0"):
+        ColorPipeline("gamma 1 0", engine="native")(tile("int16"))
+    with pytest.raises(ValueError, match="band 3"):
+        ColorPipeline("gamma 3 1.1", engine="native")(tile("int16", (2, 8, 8)))
+    with pytest.raises(ValueError, match="Invalid engine"):
+        ColorPipeline("gamma 3 1.1", engine="fortran")
+
+
+def test_native_engine_read_only():
+    arr = np.broadcast_to(tile("int16", (3, 1, 9)), (3, 4, 9))
+    out = ColorPipeline("saturation 1.2", engine="native")(arr, "uint8")
+    assert np.array_equal(out, ColorPipeline("saturation 1.2")(arr, "uint8"))
+
+
+def test_apply_native_threads():
+    ops = "gamma 1 1.1 saturation 1.2"
+    arr = tile("uint16", (3, 64, 32))
+    out = apply(arr, ops, "uint8", workers=3, engine="native")
+    assert np.array_equal(out, get_pipeline(ops, "native")(arr, "uint8"))
+
+
+def few_colors_tile(dtype, count, shape=(4, 64, 64), seed=0):
+    rng = np.random.default_rng(seed)
+    colors = tile(dtype, (shape[0], count), seed)
+    return colors[:, rng.integers(0, count, shape[1:])]
+
+
+@pytest.mark.parametrize("count", [1, 3, 8])
+def test_few_colors(count):
+    arr = few_colors_tile("uint16", count)
+    colors, index = few_colors(arr)
+    assert colors.shape == (4, 1, count)
+    assert np.array_equal(colors[:, 0, index], arr)
+
+
+def test_few_colors_rejected():
+    assert few_colors(tile("uint16")) is None
+    assert few_colors(few_colors_tile("uint16", 9)) is None
+    # A color missed by the sample
+    arr = few_colors_tile("uint8", 2, (3, 100, 100))
+    arr[:, 50, 51] = (1, 2, 3)
+    assert few_colors(arr, samples=100) is None
+    assert few_colors(np.zeros((3, 0, 5), dtype="uint8")) is None
+
+
+@pytest.mark.parametrize("shape", [(3, 512, 512), (3, 256, 256), (3, 1, 4096)])
+def test_few_colors_sample_spread(shape):
+    class Compared(np.ndarray):
+        def __eq__(self, other):
+            raise AssertionError("pixels compared with the sampled colors")
+
+    # Uniform on the columns a flat stride of the block would sample
+    arr = tile("uint16", shape)
+    arr[:, :, :: max(1, shape[2] // 4)] = 7
+    assert few_colors(arr.view(Compared)) is None
+
+
+@pytest.mark.parametrize("count", [1, 5])
+@pytest.mark.parametrize("dtype", ["uint8", "uint16", "int16"])
+@pytest.mark.parametrize("out_dtype", ["uint8", "uint16"])
+@pytest.mark.parametrize(
+    "engine, lut_size", [("numpy", None), ("native", None), ("numpy", 17)]
+)
+def test_apply_few_colors(count, dtype, out_dtype, engine, lut_size):
+    pipeline = ColorPipeline(
+        "gamma g 1.85, sigmoidal rgb 35 0.13, saturation 1.15", engine, lut_size
+    )
+    arr = few_colors_tile(dtype, count)
+    if dtype == "int16":
+        arr = np.abs(arr)
+    out = apply_few_colors(pipeline, arr, out_dtype)
+    assert out.dtype == out_dtype
+    assert np.array_equal(out, pipeline(arr, out_dtype))
+
+
+def test_apply_few_colors_skipped():
+    arr = few_colors_tile("uint8", 1)
+    # Exact tables are as fast
+    assert apply_few_colors(ColorPipeline("gamma rgb 1.5"), arr) is None
+    assert apply_few_colors(ColorPipeline("saturation 1.5"), tile("uint8")) is None
+
+
+def test_apply_few_colors_invalid():
+    arr = np.full((3, 8, 8), -1, dtype="int16")
+    with pytest.raises(ValueError):
+        apply_few_colors(ColorPipeline("gamma r 1.5, saturation 1.5"), arr, "uint8")
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "uint16", "int16"])
+def test_apply_many(dtype):
+    pipelines = [
+        ColorPipeline("gamma rgb 1.5"),
+        ColorPipeline("gamma g 1.85, saturation 1.15"),
+        ColorPipeline("sigmoidal rgb 20 0.2, saturation 0.8"),
+        ColorPipeline("gamma b 0.9, saturation 1.2", lut_size=9),
+        ColorPipeline("gamma b 0.9, saturation 1.2", engine="native"),
+    ]
+    arr = np.abs(tile(dtype, (4, 64, 64)))
+    outs = apply_many(pipelines, arr, "uint8")
+    assert len(outs) == len(pipelines)
+    for pipeline, out in zip(pipelines, outs):
+        assert np.array_equal(out, pipeline(arr, "uint8"))
+    assert apply_many([], arr) == []
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "uint16", "int16"])
+@pytest.mark.parametrize("engine", ["numpy", "native"])
+def test_band_values(dtype, engine):
+    ops = (
+        "gamma 12345678 1.1,1.0,0.95,1.2,1.3,0.9,1.0,1.05, "
+        "sigmoidal 1,2,3,4,5,6,7,8 10,12,8,20,5,-5,0,10 "
+        "0.2,0.3,0.25,0.3,0.5,0.5,0.5,0.1"
+    )
+    arr = np.abs(tile(dtype, (9, 32, 32)))
+    out = ColorPipeline(ops, engine)(arr, "uint8")
+    expected = reference(arr, ops, "uint8")
+    assert np.abs(out.astype(int) - expected).max() <= (1 if engine == "native" else 0)
+    assert np.array_equal(out[8], reference(arr, "gamma 1 1.0", "uint8")[8])
+
+
+def test_evaluate_chunks():
+    ops = "gamma 13 1.2,0.9, sigmoidal rgb 10 0.2, saturation 1.2"
+    arr = tile("int16", (3, 50, 40))
+    pipeline = ColorPipeline(ops)
+    expected = pipeline(arr, "uint8")
+    # Chunks of 2 rows, and a last chunk of 0 rows
+    pipeline.chunk_values = 3 * 40 * 2
+    assert np.array_equal(pipeline(arr, "uint8"), expected)
+    pipeline.chunk_values = 1
+    assert np.array_equal(pipeline(arr, "uint8"), expected)
@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+
+from rio_color.pool import (
+    ResultSlots,
+    WindowGrid,
+    block_grid,
+    imap_windows,
+    result_bytes,
+    run_window,
+)
+from rio_color.workers import color_worker
+
+
+args = {"ops_string": "gamma 3 1.85 sigmoidal rgb 35 0.13", "out_dtype": "uint16"}
+
+
+def windows(path="tests/rgb8.tif"):
+    with rasterio.open(path) as src:
+        return [(window, ij) for ij, window in src.block_windows()]
+
+
+def tasks(path="tests/rgb8.tif"):
+    return [(ij, color_worker, path, window, ij, args) for window, ij in windows(path)]
+
+
+def expected():
+    return {task[0]: run_window(task)[2] for task in tasks()}
+
+
+def test_result_bytes():
+    assert result_bytes(windows(), 3, "uint16") == 32 * 32 * 3 * 2
+    with rasterio.open("tests/rgb8.tif") as src:
+        assert result_bytes(block_grid(src), 3, "uint16") == 32 * 32 * 3 * 2
+
+
+def test_block_grid():
+    with rasterio.open("tests/rgb8.tif") as src:
+        grid = block_grid(src)
+    assert list(grid) == windows()
+    assert len(grid) == len(windows())
+    assert grid[5] == windows()[5]
+    assert grid[-1] == windows()[-1]
+    assert grid[3:40:7] == windows()[3:40:7]
+    with pytest.raises(IndexError):
+        grid[len(grid)]
+
+
+def test_window_grid_uneven():
+    grid = WindowGrid.from_blocks(100, 70, (32, 64))
+    assert [(w.col_off, w.row_off, w.width, w.height) for w, _ in grid] == [
+        (0, 0, 64, 32),
+        (64, 0, 36, 32),
+        (0, 32, 64, 32),
+        (64, 32, 36, 32),
+        (0, 64, 64, 6),
+        (64, 64, 36, 6),
+    ]
+    assert [ij for _, ij in grid] == [(0, 0), (0, 1), (1, 0), (1, 1), (2, 0), (2, 1)]
+    assert grid.max_pixels() == 64 * 32
+
+
+def shm_names():
+    return set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+
+@pytest.mark.parametrize("size", [None, 32 * 32 * 3 * 2, 100])
+def test_imap_windows_shared(size):
+    before = shm_names()
+    reference = expected()
+    seen = set()
+    for ij, window, arr, _ in imap_windows(tasks(), jobs=2, result_size=size):
+        assert np.array_equal(arr, reference[ij])
+        seen.add(ij)
+    assert seen == set(reference)
+    assert shm_names() == before
+
+
+def slow_worker(srcs, window, ij, args):
+    # The first windows are slow, so later ones finish before them
+    if ij[0] == 0:
+        import time
+
+        time.sleep(0.05)
+    return color_worker(srcs, window, ij, args)
+
+
+@pytest.mark.parametrize("size", [None, 32 * 32 * 3 * 2])
+def test_imap_windows_ordered(size):
+    run = [(task[0], slow_worker, *task[2:]) for task in tasks()]
+    reference = expected()
+    keys = [ij for ij, _, _, _ in imap_windows(run, jobs=2, result_size=size)]
+    assert keys != [task[0] for task in run]
+
+    results = imap_windows(run, jobs=2, result_size=size, ordered=True)
+    keys = []
+    for ij, _, arr, _ in results:
+        assert np.array_equal(arr, reference[ij])
+        keys.append(ij)
+    assert keys == [task[0] for task in run]
+
+
+@pytest.mark.parametrize("size", [None, 32 * 32 * 3 * 2])
+def test_imap_windows_in_flight(size):
+    taken = []
+
+    def lazy():
+        for task in tasks():
+            taken.append(task[0])
+            yield task
+
+    for i, _ in enumerate(imap_windows(lazy(), jobs=2, result_size=size)):
+        # Tasks are only taken as results are consumed, two per job in
+        # flight and the next one waiting for a free place
+        assert len(taken) <= i + 5
+    assert len(taken) == len(tasks())
+
+
+def test_imap_windows_given_pool():
+    from multiprocessing import Pool
+
+    taken = []
+
+    def lazy():
+        for task in tasks():
+            taken.append(task[0])
+            yield task
+
+    reference = expected()
+    with Pool(4) as pool:
+        results = imap_windows(lazy(), pool=pool)
+        ij, _, arr, _ = next(results)
+        # Two per process of the pool in flight, not per job
+        assert len(taken) >= 8
+        assert np.array_equal(arr, reference[ij])
+        assert len(list(results)) == len(reference) - 1
+
+
+def test_imap_windows_shared_early_exit():
+    before = shm_names()
+    results = imap_windows(tasks(), jobs=2, result_size=32 * 32 * 3 * 2)
+    for i, (_, _, arr, _) in enumerate(results):
+        if i == 3:
+            break
+    results.close()
+    # the last result is still usable
+    assert arr.shape == (3, 32, 32)
+    del arr
+    assert shm_names() == before
+
+
+def test_result_slots():
+    slots = ResultSlots(2, 64)
+    try:
+        handed = list(zip(range(2), slots.tasks(["a", "b", "c"])))
+        assert [task[0] for _, task in handed] == [0, 1]
+        assert [task[3] for _, task in handed] == ["a", "b"]
+
+        # Too large for a slot, the result came back pickled
+        arr = np.ones((2, 2), dtype="uint8")
+        assert slots.result(0, arr) is arr
+    finally:
+        slots.close()
@@ -0,0 +1,122 @@
+import threading
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import rasterio
+
+from rio_color.lut import export_cube
+from rio_color.scripts.cli import color
+from rio_color.server import (
+    ColorServerError,
+    _absolute_luts,
+    color_array,
+    make_server,
+    parse_address,
+    status,
+    submit,
+    submit_array,
+)
+
+
+ops = "gamma 3 1.85, gamma 1,2 1.95, sigmoidal 1,2,3 35 0.13, saturation 1.15"
+
+
+@pytest.fixture(params=["tcp", "unix"])
+def address(request, tmpdir):
+    if request.param == "unix":
+        addr = "unix:" + str(tmpdir.join("color.sock"))
+    else:
+        addr = "127.0.0.1:0"
+    server = make_server(addr, jobs=2)
+    if request.param == "tcp":
+        addr = "127.0.0.1:{}".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield addr
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_parse_address():
+    assert parse_address("unix:/tmp/a.sock") == ("unix", "/tmp/a.sock")
+    assert parse_address("localhost:8000") == ("tcp", ("localhost", 8000))
+    assert parse_address("http://127.0.0.1:80") == ("tcp", ("127.0.0.1", 80))
+    assert parse_address(":80") == ("tcp", ("127.0.0.1", 80))
+    with pytest.raises(ValueError):
+        parse_address("localhost")
+
+
+def test_absolute_luts(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    export_cube("saturation 1.2", "look.cube", 5)
+    export_cube("gamma g 1.5", "curve.cube", 16, one_d=True)
+    path = str(tmpdir.join("look.cube"))
+    assert _absolute_luts("gamma 1 1.1, lut look.cube") == "gamma 1 1.1, lut " + path
+    assert _absolute_luts("lut curve.cube") == "lut " + str(tmpdir.join("curve.cube"))
+    assert _absolute_luts(ops) == ops
+
+
+def test_status(address):
+    assert status(address)["jobs"] == 2
+
+
+def test_submit(address, tmpdir):
+    local = str(tmpdir.join("local.tif"))
+    result = CliRunner().invoke(color, ["-d", "uint8", "tests/rgb8.tif", local, ops])
+    assert result.exit_code == 0
+
+    # the same pool serves several jobs, paths aren't templates
+    for name in ["remote.tif", "remote{0}}{name}.tif"]:
+        remote = str(tmpdir.join(name))
+        summary = submit(address, "tests/rgb8.tif", remote, ops, out_dtype="uint8")
+        assert summary["windows"] == 224
+        with rasterio.open(local) as a, rasterio.open(remote) as b:
+            assert np.array_equal(a.read(), b.read())
+            assert a.colorinterp == b.colorinterp
+
+
+def test_submit_errors(address, tmpdir):
+    with pytest.raises(ColorServerError, match="foob is not a valid operation"):
+        submit(address, "tests/rgb8.tif", str(tmpdir.join("x.tif")), "foob 1")
+    with pytest.raises(ColorServerError):
+        submit(address, "tests/missing.tif", str(tmpdir.join("x.tif")), ops)
+
+
+def test_submit_array(address):
+    with rasterio.open("tests/rgb16.tif") as src:
+        arr = src.read()
+    out = submit_array(address, arr, ops, out_dtype="uint8")
+    assert out.dtype == np.uint8
+    assert np.array_equal(out, color_array(arr, ops, "uint8"))
+
+    out = submit_array(address, arr, ops)
+    assert out.dtype == np.uint16
+
+
+def test_color_cli_server(address, tmpdir):
+    local = str(tmpdir.join("local.tif"))
+    remote = str(tmpdir.join("remote.tif"))
+    runner = CliRunner()
+    result = runner.invoke(color, ["tests/rgb8.tif", local, ops])
+    assert result.exit_code == 0
+    result = runner.invoke(color, ["--server", address, "tests/rgb8.tif", remote, ops])
+    assert result.exit_code == 0
+    with rasterio.open(local) as a, rasterio.open(remote) as b:
+        assert np.array_equal(a.read(), b.read())
+
+    result = runner.invoke(
+        color, ["--server", address, "tests/rgb8.tif", remote, "foob 1"]
+    )
+    assert result.exit_code == 2
+    assert "foob is not a valid operation" in result.output
+
+
+def test_color_cli_no_server(tmpdir):
+    result = CliRunner().invoke(
+        color,
+        ["--server", "127.0.0.1:1", "tests/rgb8.tif", str(tmpdir.join("x.tif")), ops],
+    )
+    assert result.exit_code == 1
+    assert "Could not connect" in result.output
@@ -0,0 +1,96 @@
+import json
+import os
+import subprocess
+import sys
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import rasterio
+
+from rio_color.scripts.cli import color_shard
+from rio_color.shard import load_manifest, merge_shards, plan_shards, write_vrt
+
+
+ops = "gamma 3 1.85 sigmoidal rgb 35 0.13 saturation 1.1"
+
+
+def test_plan_shards(tmpdir):
+    prefix = str(tmpdir.join("job"))
+    paths = plan_shards("tests/rgb8.tif", prefix, ops, 3, out_dtype="uint8")
+    assert paths == ["{}-{}.json".format(prefix, k) for k in range(3)]
+
+    manifests = [load_manifest(path) for path in paths]
+    # 16 block rows of 14 blocks
+    assert [len(m["windows"]) for m in manifests] == [70, 70, 84]
+    assert [m["row_off"] for m in manifests] == [0, 160, 320]
+    assert [m["height"] for m in manifests] == [160, 160, 180]
+    assert sum(len(m["windows"]) for m in manifests) == 224
+
+    with pytest.raises(ValueError):
+        plan_shards("tests/rgb8.tif", prefix, ops, 17)
+
+
+def test_shards_in_processes(tmpdir, job, reference):
+    prefix = str(tmpdir.join("job"))
+    runner = CliRunner()
+    result = runner.invoke(
+        color_shard, ["plan", "-n", "3", "-d", "uint8", "tests/rgb8.tif", prefix, ops]
+    )
+    assert result.exit_code == 0
+    manifests = result.output.split()
+    assert len(manifests) == 3
+
+    # merging before all parts exist fails
+    result = runner.invoke(
+        color_shard, ["merge"] + manifests + [str(tmpdir.join("out.tif"))]
+    )
+    assert result.exit_code == 2
+    assert "has not been processed" in result.output
+
+    code = "from rio_color.scripts.cli import color_shard; color_shard()"
+    procs = [
+        subprocess.Popen([sys.executable, "-c", code, "run", "-j", jobs, manifest])
+        for jobs, manifest in zip(["1", "2", "1"], manifests)
+    ]
+    assert [p.wait() for p in procs] == [0, 0, 0]
+
+    expected = reference(ops)
+    _, profile = job()
+
+    output = str(tmpdir.join("merged.tif"))
+    result = runner.invoke(color_shard, ["merge"] + manifests + [output])
+    assert result.exit_code == 0
+    with rasterio.open(output) as src:
+        assert np.array_equal(src.read(), expected)
+        assert src.transform == profile["transform"]
+        assert src.colorinterp == (
+            rasterio.enums.ColorInterp.red,
+            rasterio.enums.ColorInterp.green,
+            rasterio.enums.ColorInterp.blue,
+        )
+
+    vrt = str(tmpdir.join("merged.vrt"))
+    result = runner.invoke(color_shard, ["merge"] + manifests[::-1] + [vrt])
+    assert result.exit_code == 0
+    with rasterio.open(vrt) as src:
+        assert src.driver == "VRT"
+        assert np.array_equal(src.read(), expected)
+        assert src.transform == profile["transform"]
+        assert src.crs == profile["crs"]
+        assert src.colorinterp[2] == rasterio.enums.ColorInterp.blue
+
+
+def test_merge_incomplete(tmpdir):
+    prefix = str(tmpdir.join("job"))
+    paths = plan_shards("tests/rgb8.tif", prefix, ops, 2)
+    manifests = [load_manifest(path) for path in paths]
+    with pytest.raises(ValueError, match="shards 0 to 1"):
+        write_vrt(manifests[:1], str(tmpdir.join("out.vrt")))
+
+    other = dict(manifests[1], ops_string="gamma 1 2")
+    with pytest.raises(ValueError, match="different plans"):
+        merge_shards([manifests[0], other], str(tmpdir.join("out.tif")))
+
+    with open(paths[0]) as f:
+        assert json.load(f)["part_path"] == os.path.abspath(prefix + "-0.tif")
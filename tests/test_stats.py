@@ -0,0 +1,254 @@
+import os
+import shutil
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import rasterio
+
+from rio_color.cache import TableCache
+from rio_color.operations import gamma, sigmoidal
+from rio_color.pipeline import ColorPipeline
+from rio_color.scripts.cli import color
+from rio_color.stats import (
+    Histograms,
+    _sample_windows,
+    atmos_parameters,
+    collect_stats,
+    resolve_percentiles,
+)
+
+q = [0, 1, 2, 25, 50, 98, 99.5, 100]
+
+
+def expected(arr, q=q):
+    """Percentiles of every band of arr, between 0 and 1."""
+    return np.array(
+        [np.percentile(band, q, method="inverted_cdf") for band in arr]
+    ) / float(np.iinfo(arr.dtype).max)
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "uint16"])
+def test_histograms(dtype):
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 3000, (3, 100, 80)).astype(dtype)
+    hist = Histograms(3, dtype).update(arr)
+    assert hist.counts.sum() == arr.size
+    assert np.allclose(hist.percentiles(q), expected(arr))
+
+    # Streaming gives the same counts as a single update
+    streamed = Histograms(3, dtype)
+    for rows in np.array_split(arr, 7, axis=1):
+        streamed.merge(Histograms(3, dtype).update(rows))
+    assert np.array_equal(streamed.counts, hist.counts)
+
+
+def test_histograms_approximate():
+    rng = np.random.default_rng(0)
+    arr = rng.integers(-50, 2**20, (2, 50, 50)).astype("int32")
+    hist = Histograms(2, "int32")
+    assert hist.bins == 2**16
+    hist.update(arr)
+    # Within a bin, of 2**15 values
+    expected_values = expected(np.clip(arr, 0, None).astype("int32"))
+    assert np.abs(hist.percentiles(q) - expected_values).max() <= 2**15 / (2**31 - 1)
+
+
+def test_histograms_mask():
+    arr = np.arange(2 * 10 * 10, dtype="uint8").reshape(2, 10, 10)
+    mask = np.zeros((10, 10), dtype=bool)
+    mask[:5] = True
+    hist = Histograms(2, "uint8").update(arr, mask)
+    assert np.allclose(hist.percentiles(q), expected(arr[:, 5:]))
+
+    masked = np.ma.masked_array(arr, np.broadcast_to(mask, arr.shape))
+    assert np.array_equal(Histograms(2, "uint8").update(masked).counts, hist.counts)
+
+    assert np.isnan(Histograms(2, "uint8").percentiles(50)).all()
+    with pytest.raises(ValueError):
+        Histograms(3, "float32")
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+@pytest.mark.parametrize("path", ["tests/rgb8.tif", "tests/rgba8.tif"])
+def test_collect_stats(path, jobs):
+    hist = collect_stats(path, jobs=jobs)
+    with rasterio.open(path) as src:
+        arr = src.read(masked=True)
+    for b in range(arr.shape[0]):
+        values = arr[b].compressed()
+        assert hist.counts[b].sum() == values.size
+        assert np.allclose(hist.percentiles(q)[b], expected(values[np.newaxis])[0])
+
+
+def test_collect_stats_cache(tmpdir, table_cache_dir):
+    path = str(tmpdir.join("src.tif"))
+    shutil.copyfile("tests/rgb8.tif", path)
+    hist = collect_stats(path)
+    entries = TableCache(str(table_cache_dir)).entries()
+    assert [e["kind"] for e in entries] == ["stats"]
+    assert np.array_equal(collect_stats(path).counts, hist.counts)
+
+    # Changed files are read again
+    with rasterio.open(path, "r+") as dst:
+        dst.write(np.zeros((3, 500, 438), dtype="uint8"))
+    os.utime(path, ns=(0, 0))
+    assert collect_stats(path).percentiles(100).max() == 0
+    assert len(TableCache(str(table_cache_dir)).entries()) == 2
+
+
+def test_collect_stats_sampled(tmpdir):
+    windows, decimation = _sample_windows_of("tests/rgb8.tif", 50000)
+    # Blocks of 32 x 32 pixels
+    assert decimation == 1
+    assert len(windows) == 48
+
+    # From overviews when there are some
+    path = str(tmpdir.join("src.tif"))
+    shutil.copyfile("tests/rgb8.tif", path)
+    with rasterio.open(path, "r+") as dst:
+        dst.build_overviews([2, 4])
+    windows, decimation = _sample_windows_of(path, 50000)
+    assert decimation == 3
+    # Windows of 3 x 3 blocks
+    assert len(windows) == 6 * 5
+
+    whole = collect_stats("tests/rgb8.tif", cache=False).percentiles([2, 50, 98])
+    for src_path in ["tests/rgb8.tif", path]:
+        hist = collect_stats(src_path, max_pixels=50000, cache=False)
+        assert 20000 < hist.counts[0].sum() <= 50000
+        assert np.abs(hist.percentiles([2, 50, 98]) - whole).max() < 0.03
+
+
+def _sample_windows_of(path, max_pixels):
+    with rasterio.open(path) as src:
+        return _sample_windows(src, max_pixels)
+
+
+def test_resolve_percentiles():
+    ops = "gamma g 1.1, sigmoidal rgb 10 0.5"
+    assert resolve_percentiles(ops, "tests/rgb8.tif") == ops
+
+    ops = resolve_percentiles(
+        "stretch rgb 2% 98%, stretch 3 0.1 99%, sigmoidal rgb 10 0.5", "tests/rgb8.tif"
+    )
+    with rasterio.open("tests/rgb8.tif") as src:
+        arr = src.read()
+    low, high = expected(arr, [2, 98]).T
+    (stretch, stretch_b, _) = ColorPipeline(ops).operations
+    assert np.allclose(stretch.kwargs["low"], low)
+    assert np.allclose(stretch.kwargs["high"], high)
+    # Band 3 after the first stretch, 2% of its pixels at 1
+    stretched = np.clip((arr[2] / 255.0 - low[2]) / (high[2] - low[2]), 0, 1)
+    assert stretch_b.kwargs == {
+        "low": 0.1,
+        "high": np.percentile(stretched, 99, method="inverted_cdf"),
+    }
+
+
+def test_resolve_percentiles_after_operations():
+    with rasterio.open("tests/rgb8.tif") as src:
+        arr = src.read()
+    # Percentiles of the bands as they reach the stretch
+    ops = resolve_percentiles("gamma rgb 2, stretch rgb 2% 98%", "tests/rgb8.tif")
+    (_, stretch) = ColorPipeline(ops).operations
+    values = gamma(arr / 255.0, 2)
+    low, high = (
+        np.array(
+            [np.percentile(band, [2, 98], method="inverted_cdf") for band in values]
+        )
+    ).T
+    assert np.allclose(stretch.kwargs["low"], low)
+    assert np.allclose(stretch.kwargs["high"], high)
+
+    # And of the output of an earlier stretch with percentiles, which
+    # puts 2% of the pixels at 0
+    ops = resolve_percentiles("stretch 1 2% 98%, stretch 1 1% 50%", "tests/rgb8.tif")
+    (_, stretch) = ColorPipeline(ops).operations
+    assert stretch.kwargs["low"] == 0
+
+    # Bands untouched by operations mixing bands still can
+    ops = resolve_percentiles("saturation 1.2, stretch 4 2% 98%", "tests/rgba8.tif")
+    with pytest.raises(ValueError, match="can't follow saturation"):
+        resolve_percentiles("saturation 1.2, stretch rgb 2% 98%", "tests/rgb8.tif")
+
+
+def test_resolve_percentiles_errors(tmpdir):
+    with pytest.raises(ValueError, match="band 4"):
+        resolve_percentiles("stretch 4 2% 98%", "tests/rgb8.tif")
+
+    path = str(tmpdir.join("flat.tif"))
+    with rasterio.open(
+        path, "w", driver="GTiff", width=8, height=8, count=1, dtype="uint8"
+    ) as dst:
+        dst.write(np.full((1, 8, 8), 7, dtype="uint8"))
+    with pytest.raises(ValueError, match="same value"):
+        resolve_percentiles("stretch 1 2% 98%", path)
+
+
+def hazy(offsets, shape=(3, 100, 100)):
+    """A uint8 image with dark objects at offsets, by band."""
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 120, shape) + np.reshape(offsets, (-1, 1, 1))
+    return arr.astype("uint8")
+
+
+def test_atmos_parameters():
+    hist = Histograms(3, "uint8").update(hazy([20, 30, 45]))
+    params = atmos_parameters(hist)
+    red, _, blue = params["dark"]
+    assert red < blue
+    # The blue gamma of simple_atmo brings the dark blue down to red
+    assert blue ** (1 / (1 - params["atmo"])) == pytest.approx(red, abs=1e-3)
+
+    lo, hi = hist.percentiles([2, 98]).mean(axis=0)
+    assert lo < params["bias"] < hi
+    assert params["contrast"] > 0
+
+    # No haze if blue is no brighter than red
+    assert (
+        atmos_parameters(Histograms(3, "uint8").update(hazy([40, 30, 20])))["atmo"] == 0
+    )
+
+
+def test_atmos_parameters_contrast():
+    hist = Histograms(3, "uint8").update(hazy([0, 0, 0]))
+    params = atmos_parameters(hist, spread=0.8)
+    lo, hi = hist.percentiles([2, 98]).mean(axis=0)
+
+    def spread(contrast):
+        out = sigmoidal(np.array([lo, hi]), contrast, params["bias"])
+        return out[1] - out[0]
+
+    # The lowest contrast, in steps of 0.5, reaching the spread
+    assert spread(params["contrast"]) >= 0.8
+    assert spread(params["contrast"] - 0.5) < 0.8
+
+    # Already spread apart
+    assert atmos_parameters(hist, spread=0.1)["contrast"] == 0
+
+
+def test_atmos_parameters_errors():
+    with pytest.raises(ValueError, match="red, green and blue"):
+        atmos_parameters(Histograms(2, "uint8").update(hazy([0, 0], (2, 8, 8))))
+    with pytest.raises(ValueError, match="no valid pixels"):
+        atmos_parameters(Histograms(3, "uint8"))
+
+
+def test_cli(tmpdir):
+    output = str(tmpdir.join("out.tif"))
+    result = CliRunner().invoke(
+        color, ["-j", "2", "tests/rgb8.tif", output, "stretch rgb 1% 99%"]
+    )
+    assert result.exit_code == 0
+    assert "Operations: stretch 123 " in result.output
+    with rasterio.open(output) as dst:
+        arr = dst.read()
+    # At least 1% of each band is black and 1% white, more with ties
+    for band in arr:
+        assert 0.01 <= (band == 0).mean() < 0.05
+        assert 0.01 <= (band == 255).mean() < 0.05
+
+    result = CliRunner().invoke(color, ["tests/rgb8.tif", output, "stretch 4 1% 99%"])
+    assert result.exit_code == 2
+    assert "band 4" in result.output
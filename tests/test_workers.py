@@ -1,7 +1,11 @@
 import rasterio
 import numpy as np
+import pytest
 
-from rio_color.workers import atmos_worker, color_worker
+from rio_color.operations import simple_atmo
+from rio_color.pipeline import get_pipeline
+from rio_color.utils import scale_dtype, to_math_type
+from rio_color.workers import atmos_worker, color_worker, multi_color_worker
 
 
 def test_atmos():
@@ -40,6 +44,27 @@ def test_atmos():
         assert arr.max() > max_uint8
 
 
+@pytest.mark.parametrize(
+    "path", ["tests/rgb8.tif", "tests/rgba8.tif", "tests/rgb16.tif"]
+)
+@pytest.mark.parametrize("out_dtype", ["uint8", "uint16"])
+@pytest.mark.parametrize(
+    "params", [(0.03, 15, 0.5), (0.122, 41.5, 0.152), (0.3, -5, 0.4), (0, 0, 0.5)]
+)
+def test_atmos_simple_atmo(path, out_dtype, params):
+    # The pipeline gives the results of simple_atmo
+    atmo, contrast, bias = params
+    args = {"atmo": atmo, "contrast": contrast, "bias": bias, "out_dtype": out_dtype}
+    with rasterio.open(path) as src:
+        ij, window = list(src.block_windows())[77]
+        arr = atmos_worker([src], window, ij, args)
+        expected = scale_dtype(
+            simple_atmo(to_math_type(src.read(window=window)), *params), out_dtype
+        )
+    assert arr.dtype == out_dtype
+    assert np.abs(arr.astype(int) - expected).max() <= 1
+
+
 def test_color():
     i = 77
     args = {"ops_string": "gamma 3 0.95 gamma 1,2 0.99", "out_dtype": "uint8"}
@@ -70,3 +95,35 @@ def test_color():
         assert arr.max() <= 65535
         assert arr.max() > max_uint8
         assert arr.min() >= 0
+
+
+def test_color_uniform():
+    args = {"ops_string": "gamma g 1.5 saturation 1.2", "out_dtype": "uint8"}
+
+    with rasterio.open("tests/rgb8.tif") as src:
+        window = list(src.block_windows())[77][1]
+        arr = src.read(window=window)
+        arr[:] = arr[:, :1, :1]
+
+        class Uniform:
+            def read(self, window):
+                return arr.copy()
+
+        out = color_worker([Uniform()], window, None, args)
+        assert np.array_equal(out, get_pipeline(args["ops_string"])(arr, "uint8"))
+        assert (out == out[:, :1, :1]).all()
+
+
+def test_multi_color():
+    ops_strings = ["gamma rgb 1.5", "saturation 1.2", "gamma g 1.5 saturation 0.5"]
+    args = {"ops_strings": ops_strings, "out_dtype": "uint8"}
+
+    with rasterio.open("tests/rgba8.tif") as src:
+        ij, window = list(src.block_windows())[77]
+        arr = multi_color_worker([src], window, ij, args)
+        assert arr.shape == (12, 32, 32)
+        for i, ops_string in enumerate(ops_strings):
+            expected = color_worker(
+                [src], window, ij, {"ops_string": ops_string, "out_dtype": "uint8"}
+            )
+            assert np.array_equal(arr[4 * i : 4 * (i + 1)], expected)